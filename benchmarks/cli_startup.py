@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import sys, os, time, shutil, tempfile, subprocess, statistics, yaml
+
+"""
+Benchmark CLI cold-start time against fleet size.
+Each sample is a fresh interpreter which parses arguments, loads the config and resolves one node (without
+running a method), i.e. everything `tc <node> ssh` does before connecting.
+Usage: ./benchmarks/cli_startup.py [sizes...] (default: 10 100 1000)
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+
+# Load tiny-cluster.py (from within the working directory) and resolve a node, as the CLI would.
+CHILD = '''
+import sys, importlib.util
+sys.path.insert(0, sys.argv[1])
+spec = importlib.util.spec_from_file_location('tiny_cluster', sys.argv[1] + '/tiny-cluster.py')
+tc = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tc)
+cluster = tc.TinyCluster(['-c', 'bench', sys.argv[2], 'ssh', '-l', 'WARNING'])
+assert cluster.get_node(cluster.inventory.address_for(sys.argv[2]))
+'''
+
+# A context with `size` nodes, each with labels & a kiosk.
+def write_context(cwd, size):
+    nodes = {}
+    for i in range(size):
+        ip = f'10.{i // 65536}.{(i // 256) % 256}.{i % 256}'
+        nodes[ip] = {'name': f'node-{i}', 'labels': [f'tiny-cluster/rack={i % 8}'], 'kiosk': {'url_slug': f'n{i}'}}
+    ctx = {
+        'kubernetes': {'master': {'connect': 'ssh', 'username': 'pi', 'address': '10.0.0.0'}},
+        'nodes': nodes,
+        'defaults': {'kiosk': {'url_base': 'http://10.0.0.1:8123/lovelace/'}},
+    }
+    os.makedirs(f'{cwd}/contexts', exist_ok=True)
+    with open(f'{cwd}/contexts/bench.yaml', 'w') as f: yaml.dump(ctx, f)
+    shutil.copy(f'{ROOT}/defaults.yaml', f'{cwd}/defaults.yaml')
+
+# Milliseconds for one cold start.
+def sample(cwd, target):
+    start = time.time()
+    subprocess.run([sys.executable, '-c', CHILD, ROOT, target], cwd=cwd, check=True)
+    return (time.time() - start) * 1000
+
+def main(sizes):
+    print(f'{"nodes":>6}  {"uncached ms":>12}  {"cached ms":>10}')
+    for size in sizes:
+        cwd = tempfile.mkdtemp(prefix='tc-bench-')
+        try:
+            write_context(cwd, size)
+            target = f'node-{size - 1}'
+            uncached = []
+            for i in range(RUNS):
+                shutil.rmtree(f'{cwd}/.cache', ignore_errors=True)
+                uncached.append(sample(cwd, target))
+            cached = [sample(cwd, target) for i in range(RUNS)]
+            print(f'{size:>6}  {statistics.median(uncached):>12.0f}  {statistics.median(cached):>10.0f}')
+        finally:
+            shutil.rmtree(cwd, ignore_errors=True)
+
+if __name__ == "__main__":
+    main([int(s) for s in sys.argv[1:]] or [10, 100, 1000])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import sys, os, json, shutil, argparse, tempfile, importlib.util, yaml
+
+"""
+Benchmark the remote work which provisioning does, against fleet size, using the simulated transport.
+For each operation, a fresh cluster (with empty caches) runs it on every node of a freshly flashed fleet, and the
+commands, round trips & bytes of every instance (master included) are totalled, along with the simulated wall time
+of running the nodes one after another (see `simulation` in defaults.yaml for the latency model).
+Counts are deterministic (bytes nearly so): --save a baseline, then --check against it to catch regressions.
+Usage: ./benchmarks/provisioning.py [sizes...] [--latency SECONDS] [--save FILE] [--check FILE]
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COUNTS = ['commands', 'round_trips', 'bytes_sent', 'bytes_received']
+BYTES_TOLERANCE = 1.01 # Archives embed timestamps, so their compressed size varies slightly between runs.
+
+sys.path.insert(0, ROOT)
+spec = importlib.util.spec_from_file_location('tiny_cluster', f'{ROOT}/tiny-cluster.py')
+tc = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tc)
+
+# Each operation: (name, fn(cluster)).
+OPERATIONS = [
+    ('Master.create', lambda cluster: cluster.master.create()),
+    ('Node.create', lambda cluster: [node.create() for node in cluster.get_nodes()]),
+    ('Node.configure', lambda cluster: [node.configure() for node in cluster.get_nodes()]),
+    ('Node.join', lambda cluster: [node.join() for node in cluster.get_nodes()]),
+    ('Node.label', lambda cluster: [node.label() for node in cluster.get_nodes()]),
+]
+
+# A context with a master & `size` nodes, each with labels & a kiosk.
+def write_context(cwd, size, latency):
+    nodes = {}
+    for i in range(size):
+        ip = f'10.{i // 65536}.{(i // 256) % 256}.{i % 256 + 1}'
+        nodes[ip] = {'name': f'node-{i}', 'labels': [f'tiny-cluster/rack={i % 8}'], 'kiosk': {'url_slug': f'n{i}'}}
+    ctx = {
+        'kubernetes': {'master': {'connect': 'simulated', 'username': 'pi', 'address': '10.255.0.1',
+            'nfs': {'directory': '/mnt/tiny-cluster', 'allow_ips': {'*': ['rw', 'sync', 'no_subtree_check']}}}},
+        'nodes': nodes,
+        'defaults': {'kiosk': {'url_base': 'http://10.255.0.1:8123/lovelace/'}},
+    }
+    if latency != None: ctx['simulation'] = {'latency': latency}
+    os.makedirs(f'{cwd}/contexts', exist_ok=True)
+    with open(f'{cwd}/contexts/bench.yaml', 'w') as f: yaml.dump(ctx, f)
+    shutil.copy(f'{ROOT}/defaults.yaml', f'{cwd}/defaults.yaml')
+    shutil.copytree(f'{ROOT}/raspberry-pi', f'{cwd}/raspberry-pi')
+
+# Totals across every instance for one operation on a fresh cluster.
+def measure(cwd, fn):
+    shutil.rmtree(f'{cwd}/.cache', ignore_errors=True)
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'master', '-l', 'WARNING'])
+    fn(cluster)
+    cluster.close(save_trace=False) # The context is deleted once measured.
+    totals = {k: 0 for k in COUNTS + ['seconds']}
+    for instance in [cluster.master] + list(cluster.nodes.values()):
+        for k in totals: totals[k] += instance.transport.stats[k]
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser('provisioning.py')
+    parser.add_argument('sizes', type=int, nargs='*', default=[1, 10, 100])
+    parser.add_argument('--latency', type=float, help='Seconds per round trip (default: see defaults.yaml).')
+    parser.add_argument('--save', metavar='FILE', help='Write the counts to FILE (JSON).')
+    parser.add_argument('--check', metavar='FILE', help='Exit 1 if any count exceeds the one in FILE.')
+    opts = parser.parse_args()
+
+    cwd = os.getcwd()
+    results = {}
+    print(f'{"operation":<15} {"nodes":>6} {"commands":>9} {"trips":>7} {"trips/node":>10} '
+        f'{"KB sent":>9} {"KB recv":>8} {"sim s":>8}')
+    for size in opts.sizes:
+        tmp = tempfile.mkdtemp(prefix='tc-bench-')
+        try:
+            write_context(tmp, size, opts.latency)
+            os.chdir(tmp)
+            for name, fn in OPERATIONS:
+                t = measure(tmp, fn)
+                results[f'{name}@{size}'] = {k: t[k] for k in COUNTS}
+                print(f'{name:<15} {size:>6} {t["commands"]:>9} {t["round_trips"]:>7} '
+                    f'{t["round_trips"] / size:>10.1f} {t["bytes_sent"] / 1024:>9.1f} '
+                    f'{t["bytes_received"] / 1024:>8.1f} {t["seconds"]:>8.2f}')
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if opts.save:
+        with open(opts.save, 'w') as f: json.dump(results, f, indent=2, sort_keys=True)
+    if opts.check:
+        with open(opts.check, 'r') as f: baseline = json.load(f)
+        limit = lambda key, k: baseline[key][k] * (BYTES_TOLERANCE if k.startswith('bytes') else 1)
+        regressions = [f'{key} {k}: {baseline[key][k]} -> {results[key][k]}'
+            for key in results if key in baseline for k in COUNTS if results[key][k] > limit(key, k)]
+        for line in regressions: print(f'REGRESSION {line}')
+        if regressions: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
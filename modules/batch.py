@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import os, re, time, base64
+
+"""
+Gather many commands (and small file uploads) into one generated script, run in a single round trip.
+Each step reports its exit code and duration; the script stops at the first failing step.
+"""
+class Batch():
+    _marker = '__TINY_CLUSTER_STEP__'
+
+    def __init__(self, instance, name = 'batch'):
+        self.instance = instance
+        self.name = name
+        self.log = instance.log
+        self.steps = [] # (description, bash) tuples
+        self.results = []
+
+    # Queue a command.
+    def exec(self, cmd, desc = None):
+        self.steps.append((desc or cmd, cmd))
+        return self
+
+    # Queue writing some content (str or bytes) to a remote file.
+    def write(self, fp_remote, content, sudo = False, desc = None):
+        if type(content) == str: content = content.encode('utf-8')
+        data = base64.b64encode(content).decode('ascii')
+        tee = 'sudo tee' if sudo else 'tee'
+        cmd = f"echo '{data}' | base64 -d | {tee} {fp_remote} > /dev/null"
+        return self.exec(cmd, desc or f'write {fp_remote} ({len(content)} bytes)')
+
+    # Queue uploading a (small) local file.
+    def upload(self, fp_local, fp_remote, sudo = False):
+        with open(fp_local, 'rb') as f: content = f.read()
+        return self.write(fp_remote, content, sudo, f'upload {os.path.basename(fp_local)} to {fp_remote}')
+
+    # The bash script which runs every step & reports on each.
+    def _script(self):
+        lines = ['#!/bin/bash']
+        for i, step in enumerate(self.steps):
+            lines.append('_tc_start=$(date +%s%N)')
+            # Steps must not read stdin: that is where bash is reading this script from.
+            lines.append(f'{{\n{step[1]}\n}} < /dev/null')
+            lines.append('_tc_rc=$?')
+            lines.append(f'printf "\\n{self._marker} {i} %d %d\\n" $_tc_rc $(( ($(date +%s%N) - _tc_start) / 1000000 ))')
+            lines.append('if [ $_tc_rc -ne 0 ]; then exit $_tc_rc; fi')
+        return "\n".join(lines) + "\n"
+
+    # Parse the step markers out of the script's output.
+    def _parse(self, stdout):
+        matcher = re.compile(f'^{self._marker} (?P<i>[0-9]+) (?P<rc>-?[0-9]+) (?P<ms>-?[0-9]+)$')
+        results = []
+        for line in stdout.split('\n'):
+            match = matcher.match(line.strip())
+            if not match: continue
+            i = int(match.group('i'))
+            results.append({'step': self.steps[i][0], 'rc': int(match.group('rc')), 'ms': int(match.group('ms'))})
+        return results
+
+    # Run every queued step in one round trip. Raises on the first failing step.
+    def run(self, check = True):
+        if len(self.steps) <= 0: return []
+        self.log.debug(f'running {self.name} ({len(self.steps)} steps) in one round trip...')
+        tracer = self.instance.cluster.tracer
+        start = time.time()
+        with tracer.span(self.name, 'batch', self.instance.name) as span:
+            r = self.instance.exec('bash -s', check=False, capture_output=True, input=self._script())
+            self.results = self._parse(r.stdout)
+            span['steps'] = len(self.steps)
+        # Each step becomes a span, laid out in sequence within the batch's command.
+        for res in self.results:
+            self.log.debug(f'{self.name}: [{res["rc"]}] {res["ms"]}ms {res["step"]}')
+            tracer.add(res['step'][:120], 'batch_step', self.instance.name, start, res['ms'] / 1000, {'rc': res['rc']})
+            start += res['ms'] / 1000
+        if check and r.returncode != 0:
+            done = len(self.results)
+            if done > 0 and self.results[-1]['rc'] != 0:
+                failed = self.results[-1]
+                raise Exception(f'{self.name} failed at step {done}/{len(self.steps)} '
+                    f'(exit {failed["rc"]}): {failed["step"]}\n{r.stderr}')
+            raise Exception(f'{self.name} failed before step {done + 1}/{len(self.steps)} '
+                f'(exit {r.returncode}): {r.stderr}')
+        return self.results
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import os, io, time, shlex, tarfile
+
+"""
+A self-contained first-boot archive for one node, rendered locally from the merged config.
+Extracted onto the boot partition (or pushed once over SSH), its provision.sh converges the device on its own:
+hostname & static IP, SSH key, docker & kubeadm, kiosk packages & files, updates, kubelet labels,
+and (after the reboot which enables the cgroup boot flags) joining the cluster.
+"""
+class Bundle():
+    _dir = 'tiny-cluster' # Within the boot partition.
+    _boots = ['/boot', '/boot/firmware'] # Where the boot partition is mounted: older images, then Bookworm's.
+
+    # The kernel command line which runs firstrun.sh once, on the next boot (as Raspberry Pi Imager does).
+    # The path is the one the running system will see, so it depends on where the image mounts the boot partition.
+    @classmethod
+    def cmdline(cls, boot = '/boot'):
+        return f'systemd.run={boot}/{cls._dir}/firstrun.sh systemd.run_success_action=reboot ' \
+            'systemd.unit=kernel-command-line.target'
+
+    def __init__(self, node):
+        self.node = node
+        self.log = node.log
+        self.cluster = node.cluster
+
+    # The public key which ssh_copy_id would install (or None).
+    def _get_authorized_key(self, fp = '~/.ssh/id_rsa.pub'):
+        fp = os.path.expanduser(fp)
+        if not os.path.isfile(fp):
+            self.log.warning(f'no SSH key will be authorized because nothing exists at {fp}')
+            return None
+        with open(fp, 'r') as f: return f.read().strip()
+
+    # KUBELET_EXTRA_ARGS which register the node with its labels & taints (so no `label` step is needed).
+    # The device cannot be probed yet, so hardware labels & kubelet tuning are added by its first `configure`.
+    def _get_kubelet_args(self):
+        labels, taints = self.cluster.master._get_desired_labels(self.node, hardware=False)
+        args = []
+        if labels: args.append('--node-labels=' + ",".join([f'{k}={v}' for k, v in labels.items()]))
+        if taints:
+            args.append('--register-with-taints=' + ",".join(
+                [f'{ke.rsplit(":", 1)[0]}{"=" + v if v else ""}:{ke.rsplit(":", 1)[1]}' for ke, v in taints.items()]))
+        return " ".join(args)
+
+    # The join command, with a token valid for `bundle.token_ttl` (the card may be booted much later).
+    def _get_join_command(self):
+        if not self.cluster.master or not self.cluster.master.connect:
+            self.log.warning('there is no master; the bundle will not join a cluster.')
+            return None
+        return self.cluster.master._joins._mint(self.cluster.config['bundle']['token_ttl'])['command']
+
+    # A oneshot systemd unit which runs a script from the bundle once the network is up.
+    @staticmethod
+    def _get_unit(name, description, exec_start, after = 'network-online.target'):
+        return f'''cat > /etc/systemd/system/{name}.service <<EOT
+[Unit]
+Description={description}
+Wants=network-online.target
+After={after}
+[Service]
+Type=oneshot
+ExecStart={exec_start}
+[Install]
+WantedBy=multi-user.target
+EOT
+systemctl enable {name}.service'''
+
+    # Runs from the kernel command line on first boot, before the network is up: it only arranges for
+    # provision.sh to run on the next (normal) boot. systemd then reboots (see Bundle.cmdline).
+    def _get_firstrun(self):
+        return f'''#!/bin/bash
+# Generated by tiny-cluster for {self.node.name}: provision this device on the next boot.
+BUNDLE="$(cd "$(dirname "$0")" && pwd)"
+for f in {" ".join([f'{b}/cmdline.txt' for b in self._boots])}; do
+  if [ -f $f ]; then sed -i "s| systemd.run.*||g" $f; fi
+done
+{self._get_unit('tiny-cluster-provision', 'Provision this device for tiny-cluster', '/bin/bash $BUNDLE/provision.sh --reboot')}
+'''
+
+    # Converges the device (as root, with the network up), then reboots to apply the boot flags & static IP.
+    def _get_provision(self, kiosk, join):
+        node = self.node
+        user = node.cfg['username']
+        home = f'/home/{user}'
+        q = shlex.quote
+        network_args = " ".join([q(str(a)) for a in [node.name, node.address, node.cfg['dns'], node.cfg['interface']]])
+        lines = [
+            '#!/bin/bash',
+            f'# Generated by tiny-cluster for {node.name} ({node.address}): converge this device on its own.',
+            'set -e',
+            'BUNDLE="$(cd "$(dirname "$0")" && pwd)"',
+            'exec >> /var/log/tiny-cluster-provision.log 2>&1',
+            'echo "tiny-cluster provisioning started at $(date)"',
+            'systemctl disable tiny-cluster-provision.service 2>/dev/null || true',
+            '',
+            '# Files for the home directory, the SSH key, and system files.',
+            f'cp -r "$BUNDLE/home/." {home}/',
+            f'if [ -f "$BUNDLE/authorized_keys" ]; then',
+            f'  mkdir -p {home}/.ssh && touch {home}/.ssh/authorized_keys',
+            f'  grep -qxF -f "$BUNDLE/authorized_keys" {home}/.ssh/authorized_keys || '
+                f'cat "$BUNDLE/authorized_keys" >> {home}/.ssh/authorized_keys',
+            f'  chmod 700 {home}/.ssh && chmod 600 {home}/.ssh/authorized_keys',
+            'fi',
+            f'chown -R {user}:{user} {home}',
+            'systemctl enable ssh',
+            'if [ -d "$BUNDLE/root" ]; then cp -r "$BUNDLE/root/." / ; fi',
+            f'if [ -f {node._fp_apt_proxy_detect} ]; then chmod 755 {node._fp_apt_proxy_detect}; fi',
+            '',
+            f'cd {home}',
+            f'bash ./setup-network.sh {network_args}',
+            'bash ./setup-kubeadm.sh',
+        ]
+        apt = 'DEBIAN_FRONTEND=noninteractive apt-get -y -qq'
+        if kiosk: lines.append(f'{apt} install xscreensaver unclutter')
+        lines.append(f'{apt} update && {apt} upgrade')
+        if join:
+            # kubeadm needs the cgroup boot flags, so the join happens on the boot after this one.
+            lines += [
+                '',
+                '# Join the cluster on the next boot.',
+                'install -m 700 "$BUNDLE/join.sh" /usr/local/bin/tiny-cluster-join',
+                self._get_unit('tiny-cluster-join', 'Join the tiny-cluster Kubernetes cluster',
+                    '/usr/local/bin/tiny-cluster-join', 'network-online.target docker.service'),
+            ]
+        lines += [
+            '',
+            'echo "tiny-cluster provisioning finished at $(date)."',
+            'if [ "$1" = "--reboot" ]; then reboot; fi',
+        ]
+        return "\n".join(lines) + "\n"
+
+    # The script which joins the cluster (once), then disables itself.
+    def _get_join_script(self, join):
+        return f'''#!/bin/bash
+# Generated by tiny-cluster: join the cluster, unless already joined.
+exec >> /var/log/tiny-cluster-provision.log 2>&1
+if [ ! -f /etc/kubernetes/kubelet.conf ]; then
+  swapoff -a
+  {join}
+fi
+systemctl disable tiny-cluster-join.service
+'''
+
+    # Every file in the archive: {path: (content, mode)}. Paths are relative to the boot partition.
+    def files(self):
+        node = self.node
+        if node._is_master(): raise Exception('the master cannot be provisioned from a bundle; use `create`.')
+        d = self._dir
+        files = {'ssh': ('', 0o644)} # An empty "ssh" file on the boot partition enables the SSH server.
+        for fp, content in node._get_desired_files().items():
+            files[f'{d}/home/{fp}'] = (content, 0o755 if fp.endswith('.sh') else 0o644)
+        for fp in ['setup-network.sh', 'setup-kubeadm.sh']:
+            files[f'{d}/home/{fp}'] = (node._read_rp_file(fp), 0o755)
+        url = self.cluster.get_apt_cache_url()
+        for fp, content in (node._get_apt_proxy_files(url) if url else {}).items():
+            files[f'{d}/root{fp}'] = (content, 0o755 if fp == node._fp_apt_proxy_detect else 0o644)
+        kubelet_args = self._get_kubelet_args()
+        if kubelet_args: files[f'{d}/root/etc/default/kubelet'] = (f'KUBELET_EXTRA_ARGS={kubelet_args}\n', 0o644)
+        key = self._get_authorized_key()
+        if key: files[f'{d}/authorized_keys'] = (key + '\n', 0o644)
+        join = self._get_join_command()
+        if join: files[f'{d}/join.sh'] = (self._get_join_script(join), 0o700)
+        files[f'{d}/provision.sh'] = (self._get_provision(node.kiosk.cfg, join), 0o755)
+        files[f'{d}/firstrun.sh'] = (self._get_firstrun(), 0o755)
+        return files
+
+    # The archive (gzipped tar) as bytes.
+    def build(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for fp, (content, mode) in self.files().items():
+                data = content.encode('utf-8') if type(content) == str else content
+                info = tarfile.TarInfo(fp)
+                info.size = len(data)
+                info.mode = mode
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import os, time, yaml, select, struct, logging, ctypes, ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Block until any of a set of files changes: with inotify (through libc) where available, else by polling mtimes.
+Directories are watched rather than files, since editors usually replace a file rather than write it in place.
+"""
+class Watcher():
+    _mask = 0x8 | 0x80 | 0x100 | 0x200 # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _event = struct.Struct('iIII') # wd, mask, cookie, len (followed by the name)
+
+    def __init__(self, fps, poll = 2):
+        self.fps = [os.path.abspath(fp) for fp in fps]
+        self.poll = poll
+        self.fd = self._inotify()
+        self.kind = 'inotify' if self.fd != None else f'polling every {poll}s'
+        self.mtimes = self._mtimes()
+
+    def _inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0: return None
+            for d in set([os.path.dirname(fp) for fp in self.fps]):
+                if libc.inotify_add_watch(fd, d.encode(), self._mask) < 0:
+                    os.close(fd)
+                    return None
+            return fd
+        except (OSError, AttributeError): # Not Linux.
+            return None
+
+    def _mtimes(self):
+        return [os.stat(fp).st_mtime_ns if os.path.isfile(fp) else None for fp in self.fps]
+
+    # The names in a buffer of inotify events.
+    def _names(self, data):
+        names, i = [], 0
+        while i + self._event.size <= len(data):
+            length = self._event.unpack_from(data, i)[3]
+            i += self._event.size
+            names.append(data[i:i + length].rstrip(b'\0').decode())
+            i += length
+        return names
+
+    # Wait up to `timeout` seconds for a change. Returns True if a watched file changed.
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        basenames = [os.path.basename(fp) for fp in self.fps]
+        while time.time() < deadline:
+            remaining = deadline - time.time()
+            if self.fd != None:
+                if not select.select([self.fd], [], [], remaining)[0]: return False
+                if [n for n in self._names(os.read(self.fd, 65536)) if n in basenames]: return True
+            else:
+                time.sleep(min(self.poll, remaining))
+                mtimes = self._mtimes()
+                if mtimes != self.mtimes:
+                    self.mtimes = mtimes
+                    return True
+        return False
+
+"""
+Keep the nodes converged with the configuration while it is edited: watch the context & defaults YAML, diff each
+node's merged configuration against the one last applied to it (in .cache/<context>/applied.yaml), and run only
+the steps which the changed fields need, on the affected nodes in parallel. Nodes without an applied configuration
+(e.g., on the first run) are `configure`d; a node whose steps fail is retried on the next change or resync.
+"""
+class Controller():
+    # The steps which apply a change to each field; fields which are not listed need a full `configure`.
+    _field_steps = {
+        'labels': ['label'],
+        'taints': ['label'],
+        'kiosk': ['kiosk', 'files', 'reboot'], # The kiosk starts from autostart.sh, i.e., on boot.
+        'usb_ethernet': ['files', 'reboot'],
+        'hdmi': ['files', 'reboot'],
+        'nfs': ['nfs'],
+        'nfs_mount': ['nfs_mount'],
+        'kubelet': ['kubelet'],
+        'storage': ['storage', 'kubelet'], # The kubelet must tolerate zram swap.
+        'apt_cache': ['apt_proxy'],
+        'name': [], # Once the node has been re-created under its new name (see _pending_rename).
+        'dns': ['network', 'reboot'],
+        'interface': ['network', 'reboot'],
+        'connect': [],
+        'username': [],
+        'mac': [],
+    }
+    _order = ['network', 'apt_proxy', 'kiosk', 'files', 'nfs', 'nfs_mount', 'storage', 'kubelet', 'configure', 'label', 'reboot']
+
+    def __init__(self, cluster, cfg, parallel = 8):
+        self.cluster = cluster
+        self.cfg = cfg
+        self.parallel = max(1, int(parallel))
+        self.log = logging.getLogger('controller')
+        self.fp = os.path.join(cluster.cwd, '.cache', cluster.context, 'applied.yaml')
+        self.watcher = Watcher([cluster.fp_cfg, f'{cluster.cwd}/defaults.yaml'], cfg['poll'])
+
+    def _load(self):
+        if not os.path.isfile(self.fp): return {}
+        with open(self.fp, 'r') as stream: return yaml.safe_load(stream) or {}
+
+    def _save(self, applied):
+        os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+        with open(f'{self.fp}.tmp', 'w') as file: yaml.safe_dump(applied, file, default_flow_style=False)
+        os.replace(f'{self.fp}.tmp', self.fp)
+
+    # The configuration which determines a node's state (with the defaults merged in).
+    def _snapshot(self, node):
+        snapshot = {k: v for k, v in node.cfg.items() if k != 'address'}
+        snapshot['kiosk'] = node.kiosk.cfg
+        snapshot['storage'] = node.storage.cfg # i.e., with the profile's settings.
+        snapshot['apt_cache'] = self.cluster.get_apt_cache_url()
+        return yaml.safe_load(yaml.safe_dump(snapshot)) # Plain types, as they will be read back.
+
+    # The changed fields & the steps which apply them (in order).
+    def _plan(self, applied, desired):
+        if applied == None: return ['(new)'], ['configure']
+        fields = sorted([k for k in set(applied) | set(desired) if applied.get(k) != desired.get(k)])
+        steps = set()
+        for field in fields: steps.update(self._field_steps.get(field, ['configure']))
+        if 'configure' in steps: steps -= set(['apt_proxy', 'files', 'nfs', 'nfs_mount', 'storage', 'kubelet', 'label'])
+        return fields, [s for s in self._order if s in steps]
+
+    # Run the steps on a node. Returns True if all of them succeeded (never raises).
+    def _apply(self, node, steps):
+        fns = {
+            'network': node._setup_network,
+            'apt_proxy': node._configure_apt_proxy,
+            'kiosk': node.kiosk.setup,
+            'files': node._configure_files,
+            'nfs': node.configure_nfs,
+            'nfs_mount': node.configure_nfs_mount,
+            'storage': node.configure_storage,
+            'kubelet': node.configure_kubelet,
+            'configure': node.configure,
+            'label': node.label,
+            'reboot': node._reboot_if_changed,
+        }
+        node._facts = {} # Skip checks must see the node as it is now.
+        node._changed = False
+        try:
+            with self.cluster.tracer.span('reconcile', 'node', node.name, steps=steps), \
+                    node._operation_timeout(self.cluster.get_operation_timeout()):
+                for step in steps: fns[step]()
+            return True
+        except Exception as e:
+            node.log.error(f'reconcile failed (will retry on the next change): {e}')
+            return False
+
+    # The node's old name, if it was renamed but has not been re-created under the new one (i.e., its hostname).
+    # The kubelet stays registered (& credentialed) as the old name, so a rename means leaving the cluster.
+    def _pending_rename(self, node, applied):
+        old = (applied or {}).get('name')
+        if not old or old == node.name: return None
+        try:
+            return None if node._get_facts(['hostname'])['hostname'] == node.name else old
+        except Exception:
+            return old
+
+    # Bring every (selected) node whose configuration differs from the one last applied to it up to date.
+    def reconcile(self):
+        applied = self._load()
+        nodes = self.cluster._select_nodes()
+        plans = {}
+        for node in nodes:
+            desired = self._snapshot(node)
+            renamed = self._pending_rename(node, applied.get(node.address))
+            if renamed:
+                node.log.error(f'not reconciling: renamed from {renamed}, which the controller does not apply. '
+                    f'Run `kubectl delete node {renamed}`, then `tc {node.name} create --force` (or restore the name).')
+                continue
+            fields, steps = self._plan(applied.get(node.address), desired)
+            if len(steps) <= 0:
+                if fields: applied[node.address] = desired # Nothing to run for these fields.
+                continue
+            node.log.info(f'{", ".join(fields)} changed: {", ".join(steps)}')
+            plans[node] = (steps, desired)
+        for address in [a for a in applied if not a in self.cluster.inventory.nodes]:
+            self.log.info(f'{address} is no longer configured; forgetting it (it is left as it is).')
+            del applied[address]
+        if len(plans) <= 0:
+            self.log.debug('every node is up-to-date.')
+        elif self.cluster.opts.dry_run:
+            return plans
+        else:
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                results = list(pool.map(lambda node: self._apply(node, plans[node][0]), plans))
+            for node, ok in zip(plans, results):
+                if ok: applied[node.address] = plans[node][1]
+            failed = len([ok for ok in results if not ok])
+            self.log.info(f'reconciled {len(plans) - failed} node(s)' + (f'; {failed} failed.' if failed else '.'))
+        self._save(applied)
+        return plans
+
+    # Reconcile, then save the trace of the work done (so each cycle is reported as one run; see Tracer.rotate).
+    def _reconcile_cycle(self):
+        self.reconcile()
+        self.cluster.tracer.rotate(self.cluster._get_trace_dir(),
+            {'target': 'controller', 'method': 'reconcile', 'context': self.cluster.context})
+
+    # Reconcile, then again after each (debounced) change to the configuration, until interrupted.
+    def run(self):
+        if self.cluster.opts.dry_run:
+            self.reconcile()
+            return
+        self._reconcile_cycle()
+        self.log.info(f'watching {self.cluster.fp_cfg} ({self.watcher.kind})...')
+        while True:
+            if self.watcher.wait(self.cfg['resync']):
+                while self.watcher.wait(self.cfg['debounce']): pass # Wait for the edits to settle.
+                self.log.info('configuration changed; reconciling...')
+            try:
+                self.cluster.reload()
+            except Exception as e:
+                self.log.error(f'not reconciling; the configuration could not be loaded: {e}')
+                continue
+            self._reconcile_cycle()
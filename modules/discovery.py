@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import os, re, socket, asyncio, ipaddress, logging, subprocess, time
+
+"""
+Actively discover devices on the local network.
+Sweeps a CIDR range with many concurrent TCP probes (which also populate the kernel's neighbour table),
+then matches the neighbour table's MAC addresses against the given OUIs.
+"""
+class Discovery():
+    def __init__(self, ouis, cfg = {}, connect = None, neighbours = None):
+        self.log = logging.getLogger('discovery')
+        self.ouis = [o.lower() for o in ouis]
+        self.cidr = cfg.get('cidr') or self._guess_cidr()
+        self.ports = cfg.get('ports') or [22]
+        self.timeout = cfg.get('timeout') or 0.5
+        self.concurrency = cfg.get('concurrency') or 256
+        # The network is reached via these two functions, so a fake network may be substituted.
+        self.connect = connect or self._connect
+        self.neighbours = neighbours or self._neighbours
+        self.found = {} # IP address => MAC address
+
+    # The /24 around this machine's primary IPv4 address.
+    @staticmethod
+    def _guess_cidr():
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('10.255.255.255', 1)) # Nothing is sent; this only selects a route.
+            ip = s.getsockname()[0]
+        except OSError:
+            ip = '192.168.1.1'
+        finally:
+            s.close()
+        return str(ipaddress.ip_network(f'{ip}/24', strict=False))
+
+    # Returns True if the host answered at all (an open OR refused port both prove it is alive).
+    async def _connect(self, ip, port, timeout):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        except ConnectionRefusedError:
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass # e.g., reset by the host; it answered all the same.
+        return True
+
+    # Read the kernel neighbour (ARP) table as {ip: mac}.
+    @staticmethod
+    def _neighbours():
+        table = {}
+        if os.path.isfile('/proc/net/arp'):
+            with open('/proc/net/arp', 'r') as f:
+                for line in f.readlines()[1:]:
+                    cols = line.split()
+                    if len(cols) >= 4 and cols[2] != '0x0': table[cols[0]] = cols[3]
+            return table
+        # Non-Linux: fall back to the arp tool (which does not zero-pad octets).
+        addr_matcher = re.compile('.*\\((?P<ip>[0-9\\.]+)\\) at (?P<mac>[0-9a-fA-F:]+)')
+        out = subprocess.run('arp -an', shell=True, capture_output=True, text=True).stdout
+        for line in out.split('\n'):
+            match = addr_matcher.match(line)
+            if not match: continue
+            table[match.group('ip')] = ":".join([o.zfill(2) for o in match.group('mac').split(':')])
+        return table
+
+    # Record any neighbours with a matching OUI which have not yet been reported.
+    def _collect(self, on_found):
+        for ip, mac in self.neighbours().items():
+            mac = mac.lower()
+            if ip in self.found or not [o for o in self.ouis if mac.startswith(o)]: continue
+            self.found[ip] = mac
+            self.log.debug(f'found device on network: {ip} ({mac})')
+            if on_found: on_found(ip, mac)
+
+    async def _sweep(self, on_found):
+        hosts = [str(h) for h in ipaddress.ip_network(self.cidr, strict=False).hosts()]
+        sem = asyncio.Semaphore(self.concurrency)
+        last_collect = [0]
+
+        async def probe(ip):
+            async with sem:
+                for port in self.ports:
+                    if await self.connect(ip, port, self.timeout): break
+            # Stream results as the sweep progresses, without re-reading the table after every probe.
+            if time.time() - last_collect[0] > 0.1:
+                last_collect[0] = time.time()
+                self._collect(on_found)
+
+        self._collect(on_found) # Anything already in the table is reported immediately.
+        await asyncio.gather(*[probe(ip) for ip in hosts])
+        self._collect(on_found)
+
+    # Sweep the network, calling on_found(ip, mac) as each device is discovered. Returns sorted IPs.
+    def run(self, on_found = None):
+        self.log.info(f'scanning {self.cidr}...')
+        start = time.time()
+        asyncio.run(self._sweep(on_found))
+        self.log.debug(f'scanned {self.cidr} in {time.time() - start:.1f}s')
+        return sorted(self.found, key=lambda ip: ipaddress.ip_address(ip))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os, re, time, yaml, threading
+
+"""
+Gather facts about an instance's current state by running many probes in a single remote command
+"""
+class Facts():
+    _marker = '__TINY_CLUSTER_FACT__'
+
+    # Each probe is a bash snippet; its stdout is parsed into the fact's value.
+    _probes = {
+        'hostname': 'hostname',
+        'arch': 'uname -m',
+        'packages': "dpkg-query -W -f='${db:Status-Abbrev}|${Package}\\n' | grep '^ii' | cut -d'|' -f2",
+        'static_ips': "grep -E '^\\s*static ip_address=' /etc/dhcpcd.conf | cut -d= -f2",
+        'cgroups': "grep -c 'cgroup_enable=cpuset cgroup_enable=memory' /boot/cmdline.txt",
+        'kubelet_joined': 'test -f /etc/kubernetes/kubelet.conf && echo yes',
+        # The hash of the cluster CA's public key, as used by `kubeadm join --discovery-token-ca-cert-hash`.
+        'ca_hash': "openssl x509 -pubkey -noout -in /etc/kubernetes/pki/ca.crt | openssl pkey -pubin -outform der | "
+            "sha256sum | cut -d' ' -f1",
+        'exports': 'cat /etc/exports',
+        'hardware': "echo model=$(tr -d '\\0' < /proc/device-tree/model); echo cpus=$(nproc); "
+            "echo memory_mb=$(awk '/MemTotal/ {print int($2 / 1024)}' /proc/meminfo); "
+            "echo root=$(findmnt -no SOURCE /); echo root_mb=$(df -Pm / | awk 'NR == 2 {print $2}')",
+        'kubelet_args': 'cat /etc/default/kubelet',
+        'storage_files': 'sha256sum /usr/local/sbin/tiny-cluster-storage-* /etc/systemd/system/tiny-cluster-storage-* '
+            '/etc/systemd/journald.conf.d/tiny-cluster-storage.conf',
+        'storage_binds': 'grep x-tiny-cluster-storage /etc/fstab',
+        'nfs_threads': 'cat /proc/fs/nfsd/threads',
+        'nfs_mounts': "grep -E '^[^#]\\S+\\s+\\S+\\s+nfs4?\\s' /etc/fstab",
+        'nfs_mounted': 'findmnt -rn -t nfs,nfs4 -o TARGET',
+        'apt_age': 'echo $(( $(date +%s) - $(stat -c %Y /var/lib/apt/lists) ))',
+        'apt_upgradable': 'apt list --upgradable 2>/dev/null | grep -c upgradable',
+        'apt_proxy_files': 'sha256sum /etc/apt/apt.conf.d/01tiny-cluster-proxy /usr/local/bin/tiny-cluster-apt-proxy',
+        'checksums': 'cd ~ && sha256sum {checksum_files}',
+        'network': '/sbin/ip -o link show; echo; /sbin/ip -o addr show',
+        'bluetooth': 'hcitool dev | grep -o "[[:xdigit:]:]\\{11,17\\}"',
+    }
+    probe_names = list(_probes)
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.log = instance.log
+        self.cache = FactCache(instance)
+
+    # Parse `sha256sum` output into {path: checksum}
+    @staticmethod
+    def _parse_checksums(raw):
+        sums = {}
+        for line in raw.strip().split('\n'):
+            parts = line.split(None, 1)
+            if len(parts) == 2: sums[parts[1].strip()] = parts[0]
+        return sums
+
+    # Parse `ip -o link show` + `ip -o addr show` into {interface: {'inet': addr, 'inet6': addr}}
+    def _parse_network(self, raw):
+        if_matcher = re.compile('^(?P<num>[0-9]+):\s*(?P<interface>[^:@\s]+)[:@]')
+        addr_matcher = re.compile('^[0-9]+:\s*(?P<interface>\S+)\s+(?P<itype>inet6?)\s+(?P<addr>[^/\s]+)')
+        network = {}
+        for line in raw.split('\n'):
+            match = addr_matcher.match(line)
+            if match:
+                if match.group('interface') in network:
+                    network[match.group('interface')].setdefault(match.group('itype'), match.group('addr'))
+                continue
+            match = if_matcher.match(line)
+            if not match or match.group('interface') == 'lo': continue
+            network[match.group('interface')] = {}
+        return network
+
+    # Parse the key=value lines of the hardware probe into {'model', 'cpus', 'memory_mb', 'storage', 'root_mb'}
+    @staticmethod
+    def _parse_hardware(raw):
+        vals = dict([l.split('=', 1) for l in raw.split('\n') if '=' in l])
+        num = lambda k: int(vals[k]) if re.match('^[0-9]+$', vals.get(k) or '') else None
+        root = vals.get('root') or ''
+        storage = 'sd' if root.startswith('/dev/mmcblk') else 'nvme' if root.startswith('/dev/nvme') else \
+            'usb' if root.startswith('/dev/sd') else 'other'
+        return {'model': vals.get('model') or None, 'cpus': num('cpus'), 'memory_mb': num('memory_mb'),
+            'storage': storage, 'root_mb': num('root_mb')}
+
+    # Convert the raw stdout of a probe into a value.
+    def _parse(self, name, raw):
+        raw = raw.strip()
+        if name in ['packages', 'static_ips', 'nfs_mounts', 'nfs_mounted', 'storage_binds']:
+            return [l.strip() for l in raw.split('\n') if l.strip()]
+        if name in ['apt_age', 'apt_upgradable', 'cgroups', 'nfs_threads']:
+            return int(raw) if re.match('^[0-9]+$', raw) else None
+        if name == 'kubelet_joined':
+            return raw == 'yes'
+        if name == 'ca_hash':
+            return f'sha256:{raw}' if re.match('^[0-9a-f]{64}$', raw) else None
+        if name == 'network':
+            return self._parse_network(raw)
+        if name == 'hardware':
+            return self._parse_hardware(raw)
+        if name == 'bluetooth':
+            return raw.split('\n')[0] if raw else None
+        if name in ['checksums', 'storage_files', 'apt_proxy_files']:
+            return self._parse_checksums(raw)
+        return raw
+
+    # The script which runs every probe, each preceded by a marker line.
+    def _script(self, names, checksum_files):
+        lines = []
+        for name in names:
+            probe = self._probes[name].replace('{checksum_files}', " ".join(checksum_files))
+            lines.append(f'echo "{self._marker} {name}"')
+            lines.append(f'{{ {probe} ; }} 2>/dev/null < /dev/null')
+        return "\n".join(lines) + "\n"
+
+    # Run the named probes (default: all) in one round trip, returning a dict of facts.
+    # Facts with a TTL are served from the on-disk cache while fresh, unless refresh is set.
+    # checksum_files are paths (relative to the home directory) to sha256sum.
+    def gather(self, names = None, checksum_files = [], refresh = False):
+        names = list(names or self._probes)
+        if not checksum_files and 'checksums' in names: names.remove('checksums')
+        facts = {} if refresh else self.cache.get(names)
+        names = [n for n in names if not n in facts]
+        if len(names) <= 0: return facts
+        self.log.debug(f'gathering facts: {names}')
+        script = self._script(names, checksum_files)
+        with self.instance.cluster.tracer.span('gather facts', 'facts', self.instance.name) as span:
+            span['facts'] = names
+            r = self.instance.exec('bash -s', check=False, capture_output=True, input=script, idempotent=True)
+        probed = {}
+        name = None
+        raw = []
+        for line in (r.stdout + f'\n{self._marker} _end').split('\n'):
+            if line.startswith(f'{self._marker} '):
+                if name: probed[name] = self._parse(name, "\n".join(raw))
+                name = line[len(self._marker) + 1:].strip()
+                raw = []
+            elif name:
+                raw.append(line)
+        if len(probed) <= 0:
+            raise Exception(f'failed to gather facts: {r.stderr}')
+        self.cache.set(probed)
+        facts.update(probed)
+        return facts
+
+"""
+On-disk cache of facts, keyed by context and instance address, with a TTL per fact (see `facts` in defaults.yaml)
+"""
+class FactCache():
+    _lock = threading.Lock()
+
+    def __init__(self, instance):
+        cfg = instance.cluster.config.get('facts') or {}
+        self.ttls = cfg.get('ttl') or {}
+        address = instance.address or instance.name
+        cache_dir = os.path.join(instance.cluster.cwd, cfg.get('cache_dir') or '.cache')
+        self.fp = os.path.join(cache_dir, instance.cluster.context, 'facts', f'{address}.yaml')
+
+    def _load(self):
+        if not os.path.isfile(self.fp): return {}
+        with open(self.fp, 'r') as stream: return yaml.safe_load(stream) or {}
+
+    def _save(self, entries):
+        os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+        with open(f'{self.fp}.tmp', 'w') as file:
+            yaml.dump(entries, file, default_flow_style=False, sort_keys=False)
+        os.replace(f'{self.fp}.tmp', self.fp)
+
+    # Fresh cached values for any of the named facts.
+    def get(self, names):
+        names = [n for n in names if self.ttls.get(n)]
+        if len(names) <= 0: return {}
+        with self._lock: entries = self._load()
+        now = time.time()
+        return {n: entries[n]['value'] for n in names
+            if n in entries and now - entries[n]['at'] < self.ttls[n]}
+
+    # Store the values of any facts which have a TTL.
+    def set(self, facts):
+        facts = {n: facts[n] for n in facts if self.ttls.get(n)}
+        if len(facts) <= 0: return
+        with self._lock:
+            entries = self._load()
+            for n in facts: entries[n] = {'value': facts[n], 'at': time.time()}
+            self._save(entries)
+
+    # Forget the named facts (default: all of them).
+    def clear(self, names = None):
+        with self._lock:
+            entries = self._load()
+            for n in list(entries):
+                if names == None or n in names: del entries[n]
+            self._save(entries)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import logging, time, threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Run a single method against many instances through a bounded worker pool
+"""
+class Fleet():
+    def __init__(self, cluster, instances, parallel = 1):
+        self.cluster = cluster
+        self.instances = instances
+        self.parallel = max(1, int(parallel))
+        self.log = logging.getLogger('fleet')
+        self.results = []
+
+    # Parse "--selector" strings (key=value) and return the instances which match all of them.
+    # The "labels" key matches if the value is one of the node's labels; other keys compare config values.
+    @staticmethod
+    def select(instances, selectors):
+        matched = []
+        for instance in instances:
+            ok = True
+            for selector in selectors or []:
+                if not '=' in selector:
+                    raise Exception(f'invalid selector (expected key=value): {selector}')
+                key, value = selector.split('=', 1)
+                if key == 'labels':
+                    ok = value in (instance.cfg.get('labels') or [])
+                else:
+                    ok = str(instance.cfg.get(key)) == value
+                if not ok: break
+            if ok: matched.append(instance)
+        return matched
+
+    # Invoke the method on one instance (subclasses may wrap this with extra steps).
+    def _call(self, instance, method):
+        getattr(instance, method)()
+
+    # Whether remaining instances should be skipped rather than started.
+    def _aborted(self):
+        return False
+
+    # Call the method on one instance, recording success and wall time (never raises).
+    def _run_one(self, instance, method):
+        start = time.time()
+        res = {'name': instance.name, 'address': instance.address, 'status': 'ok', 'error': None}
+        if self._aborted():
+            res['status'] = 'skipped'
+        else:
+            try:
+                with self.cluster.tracer.span(method, 'node', instance.name), \
+                        instance._operation_timeout(self.cluster.get_operation_timeout()):
+                    self._call(instance, method)
+            except Exception as e:
+                res['status'] = 'FAILED'
+                lines = [l for l in str(e).strip().split('\n') if l]
+                res['error'] = lines[-1] if lines else type(e).__name__
+                instance.log.error(f'{method} failed: {e}')
+        res['seconds'] = time.time() - start
+        return res
+
+    # Run the method everywhere; returns True if every instance succeeded.
+    def run(self, method):
+        names = ", ".join([i.name for i in self.instances])
+        self.log.info(f'running {method} on {len(self.instances)} node(s) with parallel={self.parallel}: {names}')
+        if self.parallel > 1:
+            # Output from many nodes is interleaved (with node prefixes), so keep it terse.
+            self.cluster.quiet = True
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            self.results = list(pool.map(lambda i: self._run_one(i, method), self.instances))
+        self.print_summary(method)
+        return all([r['status'] == 'ok' for r in self.results])
+
+    # Tabular success/failure & wall time per node.
+    def print_summary(self, method):
+        rows = [('NODE', 'ADDRESS', 'STATUS', 'TIME', 'ERROR')]
+        for r in self.results:
+            rows.append((r['name'], str(r['address']), r['status'], f'{r["seconds"]:.1f}s', r['error'] or ''))
+        widths = [max([len(row[c]) for row in rows]) for c in range(len(rows[0]) - 1)]
+        print(f'\n{method} summary:')
+        for row in rows:
+            cols = [row[c].ljust(widths[c]) for c in range(len(widths))]
+            print('  '.join(cols + [row[-1]]).rstrip())
+        counts = {}
+        for r in self.results: counts[r['status']] = counts.get(r['status'], 0) + 1
+        print(", ".join([f'{counts[k]} {k}' for k in counts]))
+
+"""
+Roll a method across nodes: drain, run, wait for the node to come back (and report Ready), uncordon.
+No more than max_unavailable nodes are ever out of service, and the roll stops after max_failures failures.
+"""
+class Rolling(Fleet):
+    def __init__(self, cluster, instances, cfg):
+        super(Rolling, self).__init__(cluster, instances, cfg['max_unavailable'])
+        self.cfg = cfg
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def _aborted(self):
+        with self._lock: return self.failures >= self.cfg['max_failures']
+
+    def _call(self, instance, method):
+        registered = instance._get_cluster_labels() != None
+        try:
+            if registered: instance._drain(self.cfg['drain_timeout'])
+            boot_id = instance._get_boot_id()
+            instance._rebooted = False
+            getattr(instance, method)()
+            if instance._rebooted: instance._wait_for_reboot(boot_id, self.cfg['ready_timeout'])
+            if registered:
+                instance._wait_until_ready(self.cfg['ready_timeout'])
+                instance._uncordon()
+        except Exception:
+            with self._lock: self.failures += 1
+            if registered: instance.log.warning('leaving node cordoned because the rolling operation failed.')
+            raise
+
+    def run(self, method):
+        if not self.cluster.master: raise Exception('rolling operations require a Kubernetes master.')
+        # Nodes which are already unavailable count against the budget.
+        unavailable = self.cluster.master._get_unready_nodes()
+        budget = self.cfg['max_unavailable'] - len(unavailable)
+        if budget <= 0:
+            raise Exception(f'no capacity to roll: {len(unavailable)} node(s) already unavailable '
+                f'({", ".join(unavailable)}) with max_unavailable={self.cfg["max_unavailable"]}')
+        self.parallel = budget
+        return super(Rolling, self).run(method)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os, glob, yaml, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Pre-pull the container images of the bundled kubernetes/ workloads: each image is pulled once on the master
+(for each node architecture), then streamed (`docker save` | `docker load`) to the nodes which the workload's
+node affinity selects, several nodes at once. Nodes which already have the same image ID are skipped.
+"""
+class Prepull():
+    _platforms = {'armv6l': 'linux/arm/v6', 'armv7l': 'linux/arm/v7', 'aarch64': 'linux/arm64', 'x86_64': 'linux/amd64'}
+    _chunk = 1024 * 1024
+
+    def __init__(self, master, cfg = {}):
+        self.master = master
+        self.cluster = master.cluster
+        self.log = master.log
+        self.parallel = max(1, int(cfg.get('parallel') or 4))
+        self.dir = os.path.join(self.cluster.cwd, cfg.get('manifests') or 'kubernetes')
+
+    # Every pod template in the manifests: [{'name', 'images', 'terms', 'selector'}]
+    def _get_workloads(self):
+        workloads = []
+        for fp in sorted(glob.glob(os.path.join(self.dir, '*.yaml'))):
+            with open(fp, 'r') as stream: docs = list(yaml.safe_load_all(stream))
+            for doc in docs:
+                spec = ((doc or {}).get('spec') or {}).get('template', {}).get('spec')
+                if not spec: continue
+                containers = (spec.get('initContainers') or []) + (spec.get('containers') or [])
+                affinity = ((spec.get('affinity') or {}).get('nodeAffinity') or {})
+                required = affinity.get('requiredDuringSchedulingIgnoredDuringExecution') or {}
+                workloads.append({
+                    'name': doc['metadata']['name'],
+                    'images': [c['image'] for c in containers if c.get('image')],
+                    'terms': required.get('nodeSelectorTerms') or [],
+                    'selector': spec.get('nodeSelector') or {},
+                })
+        return workloads
+
+    # Whether a node with these labels may run a workload (terms are ORed; their expressions are ANDed).
+    @staticmethod
+    def _matches(workload, labels):
+        for key, value in workload['selector'].items():
+            if labels.get(key) != str(value): return False
+        def expression(e):
+            op, key, values = e['operator'], e['key'], [str(v) for v in e.get('values') or []]
+            if op == 'In': return labels.get(key) in values
+            if op == 'NotIn': return not labels.get(key) in values
+            if op == 'Exists': return key in labels
+            if op == 'DoesNotExist': return not key in labels
+            if op in ['Gt', 'Lt'] and key in labels and values:
+                try:
+                    return int(labels[key]) > int(values[0]) if op == 'Gt' else int(labels[key]) < int(values[0])
+                except ValueError:
+                    return False
+            return False
+        terms = workload['terms']
+        matched = [t for t in terms if all([expression(e) for e in t.get('matchExpressions') or []])]
+        return len(terms) <= 0 or len(matched) > 0
+
+    # The labels of each node: as registered with the master, or else as configured.
+    def _get_labels(self, nodes):
+        try:
+            registered = self.master._get_cluster_nodes()
+        except Exception as e:
+            self.log.warning(f'could not read node labels from the cluster; using the configuration: {e}')
+            registered = {}
+        labels = {}
+        for node in nodes:
+            if node.name in registered:
+                labels[node.name] = registered[node.name]['labels']
+            else:
+                labels[node.name] = dict(self.master._get_desired_labels(node)[0])
+                labels[node.name]['kubernetes.io/hostname'] = node.name
+        return labels
+
+    # {image: image ID} on an instance, for the given images (absent images are omitted), in one round trip.
+    @staticmethod
+    def _get_image_ids(instance, images):
+        script = "\n".join([f'echo "{i} $(sudo docker image inspect -f \'{{{{.Id}}}}\' {i} 2>/dev/null)"' for i in images])
+        r = instance.exec('bash -s', check=False, capture_output=True, input=script + "\n", idempotent=True)
+        ids = {}
+        for line in r.stdout.strip().split('\n'):
+            parts = line.split()
+            if len(parts) == 2: ids[parts[0]] = parts[1]
+        return ids
+
+    # Pull an image (for a platform) on the master, returning its ID & size in bytes.
+    def _pull(self, image, platform):
+        self.log.info(f'pulling {image} ({platform})...')
+        self.master.exec(f'sudo docker pull -q --platform {platform} {image}', capture_output=True, idempotent=True)
+        r = self.master.exec(f"sudo docker image inspect -f '{{{{.Id}}}} {{{{.Size}}}}' {image}",
+            capture_output=True, idempotent=True)
+        image_id, size = r.stdout.split()
+        return image_id, int(size)
+
+    # Stream the image from the master straight into the node's docker, logging progress.
+    def _stream(self, image, size, node):
+        node.log.info(f'loading {image} ({size / 1048576:.0f} MB)...')
+        save = self.master.transport.popen(f'sudo docker save {image}', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        load = node.transport.popen('sudo docker load -q',
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        sent, reported = 0, 0
+        with self.cluster.tracer.span(f'load {image}', 'transfer', node.name) as span:
+            try:
+                while True:
+                    chunk = save.stdout.read(self._chunk)
+                    if not chunk: break
+                    load.stdin.write(chunk)
+                    sent += len(chunk)
+                    if size and sent - reported >= size / 10:
+                        reported = sent
+                        node.log.info(f'{image}: {min(100, sent * 100 // size)}% ({sent / 1048576:.0f} MB)')
+            except BrokenPipeError:
+                pass
+            finally:
+                span['bytes_sent'] = sent
+            load.stdin.close()
+            if save.wait() != 0: raise Exception(f'docker save {image} failed: {save.stderr.read().decode()}')
+            if load.wait() != 0: raise Exception(f'docker load {image} failed: {load.stderr.read().decode()}')
+        node.log.info(f'{image} loaded.')
+
+    # The architecture of a node & the IDs of the given images on it.
+    def _probe(self, node, images):
+        return node._get_facts(['arch'])['arch'], self._get_image_ids(node, images)
+
+    # Pre-pull every image onto the nodes which need it. Returns True if all transfers succeeded.
+    def run(self):
+        workloads = self._get_workloads()
+        nodes = self.cluster.get_nodes()
+        labels = self._get_labels(nodes)
+        images = {} # node => [images]
+        for node in nodes:
+            for w in workloads:
+                if self._matches(w, labels[node.name]): images.setdefault(node, []).extend(w['images'])
+        if len(images) <= 0:
+            self.log.info(f'no node runs any of the workloads in {self.dir}.')
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            probed = dict(zip(images, pool.map(lambda n: self._probe(n, sorted(set(images[n]))), images)))
+        needs = {} # (image, platform) => [nodes]
+        for node, (arch, _) in probed.items():
+            platform = self._platforms.get(arch)
+            if not platform:
+                node.log.warning(f'unknown architecture "{arch}"; not pre-pulling.')
+                continue
+            for image in sorted(set(images[node])): needs.setdefault((image, platform), []).append(node)
+
+        ok = True
+        # Platforms are pulled one after another: a tag holds one platform's image at a time.
+        for (image, platform), targets in sorted(needs.items(), key=lambda kv: (kv[0][1], kv[0][0])):
+            image_id, size = self._pull(image, platform)
+            stale = [n for n in targets if probed[n][1].get(image) != image_id]
+            for n in targets:
+                if not n in stale: n.log.info(f'{image} already present; skipping.')
+            def load(node):
+                try:
+                    self._stream(image, size, node)
+                    return True
+                except Exception as e:
+                    node.log.error(f'failed to load {image}: {e}')
+                    return False
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                ok = all(list(pool.map(load, stale))) and ok
+        return ok
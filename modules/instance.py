@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
-import yaml, sys, argparse, os, re, logging, subprocess
+import yaml, sys, argparse, os, re, logging, subprocess, time
+from contextlib import contextmanager
+from modules.batch import *
+from modules.facts import *
+from modules.sync import *
+from modules.trace import *
+from modules.transport import *
+from modules.nfs import *
 
 """
 Manage a single machine/node/instance (abstract base class)
 """
 class Instance():
-    _network_interfaces = None
+    _apt_max_age = 24 * 60 * 60 # Package lists younger than this are not refreshed by `update`.
+    _slow_command = 10 # Seconds after which a streamed command's completion is logged (at INFO).
 
     def __init__(self, cluster, instance_name, instance_cfg):
         self.cluster = cluster
@@ -15,139 +23,263 @@ class Instance():
         self.connect = None
         self.address = None
         self.user_address = 'localhost'
+        self._facts = {}
+        self._changed = False # Set when a step actually modified this instance.
+        self._rebooted = False # Set when a reboot has been issued.
+        self._deadline = None # When the current operation must finish by (see _operation_timeout).
         if 'connect' in self.cfg and self.cfg['connect']:
             self.connect = self.cfg['connect']
-            if self.connect == 'ssh':
+            if self.connect in ['ssh', 'simulated']:
                 self.username = self.cfg['username']
                 self.address = self.cfg['address']
                 self.user_address = f'{self.cfg["username"]}@{self.cfg["address"]}'
-            elif self.connect:
+            elif self.connect == 'local':
+                self.address = self.cfg.get('address')
+            else:
                 raise Exception(f'unknown connection type: {self.connect}')
+        # --transport replaces the connection of every configured instance (e.g., to simulate a whole run).
+        override = getattr(cluster.opts, 'transport', None) if self.connect else None
+        self.transport = Transport.create(self, override or self.connect or 'local')
 
     def ssh(self):
-        return os.system(f'ssh -o "StrictHostKeyChecking=no" "{self.user_address}"')
+        return self.transport.interactive()
 
     # Execute a command on this instance.
-    def exec(self, cmd, check=True, capture_output=False):
-        capture_output = capture_output or self.cluster.quiet
-        args = self._get_proc_args(cmd)
-        self.log.debug(f'exec({args}), check={check}, capture_output={capture_output}')
-        r = subprocess.run(args, shell=True, check=False, capture_output=capture_output, text=True)
+    # Output which is not captured is streamed into this instance's log (at DEBUG) as it arrives; only its tail is kept.
+    # Commands time out after `exec.timeout` seconds (or the timeout given), and never outlive the operation.
+    # Idempotent commands are retried with exponential backoff if the connection fails or they time out.
+    def exec(self, cmd, check=True, capture_output=False, input=None, timeout=None, idempotent=False):
+        cfg = self.cluster.config.get('exec') or {}
+        retries = int(cfg.get('retries') or 0) if idempotent else 0
+        attempt = 0
+        while True:
+            try:
+                r = self._exec_once(cmd, capture_output, input, self._get_timeout(timeout))
+                if attempt >= retries or not self.transport.disconnected(r): break
+                reason = 'the connection failed'
+            except subprocess.TimeoutExpired as e:
+                tail = [l for l in ((e.stderr or '') + (e.output or '')).strip().split('\n') if l][-5:]
+                if attempt >= retries:
+                    raise Exception(f'timed out after {e.timeout:.1f}s: {cmd[:120]}\n' + "\n".join(tail))
+                reason = f'it timed out after {e.timeout:.1f}s'
+            delay = float(cfg.get('backoff') or 1) * 2 ** attempt
+            attempt += 1
+            self.log.warning(f'retrying in {delay:g}s ({attempt}/{retries}) because {reason}: {cmd[:80]}')
+            self.transport.close() # Never reuse a connection which may have dropped.
+            time.sleep(delay)
         if check:
             if capture_output and r.returncode != 0:
                 raise Exception(r.stderr)
             elif r.returncode != 0:
-                raise Exception('Proc failure.')
+                tail = (r.stderr.strip() or (r.stdout or '').strip()).split('\n')[-5:]
+                raise Exception(f'Proc failure (exit {r.returncode}).\n' + "\n".join(tail))
+        elif not capture_output and r.returncode != 0:
+            tail = (r.stderr.strip() or (r.stdout or '').strip()).split('\n')[-5:]
+            self.log.info(f'exit {r.returncode}: {cmd[:80]}\n' + "\n".join(tail))
         return r
 
-    # Get "args" to pass into the subprocess to run a command on this instance
-    def _get_proc_args(self, cmd):
-        if self.connect == 'ssh':
-            cmd = cmd.replace('"', '\\"')
-            return f'ssh -o "StrictHostKeyChecking=no" "{self.user_address}" "{cmd}"'
-        else:
-            return cmd
+    def _exec_once(self, cmd, capture_output, input, timeout):
+        stream = not capture_output
+        self.log.debug(f'exec({cmd}), capture_output={capture_output}, timeout={timeout}')
+        start = time.time()
+        with self.cluster.tracer.span(cmd[:120], 'command', self.name) as span:
+            r = self.transport.run(cmd, capture_output=capture_output, input=input, timeout=timeout,
+                on_line=(lambda line, is_stderr: self.log.debug(line)) if stream else None)
+            span['rc'] = r.returncode
+            span['bytes_sent'] = len(input) if input else 0
+            if capture_output: span['bytes_received'] = len(r.stdout) + len(r.stderr)
+        if capture_output and r.stdout and self.log.isEnabledFor(logging.DEBUG):
+            for line in r.stdout.rstrip().split('\n'): self.log.debug(line)
+        # Streamed output is logged at DEBUG; at INFO, a long command logs its end (and a failed one its tail; see exec).
+        if stream and r.returncode == 0 and time.time() - start >= self._slow_command:
+            self.log.info(f'finished in {time.time() - start:.0f}s: {cmd[:80]}')
+        return r
+
+    # The timeout for one command: the given (or default) timeout, limited by the operation's deadline.
+    def _get_timeout(self, timeout = None):
+        timeout = timeout or (self.cluster.config.get('exec') or {}).get('timeout')
+        if not self._deadline: return timeout
+        remaining = self._deadline - time.time()
+        if remaining <= 0: raise Exception('the operation ran out of time (see --timeout).')
+        return min(timeout, remaining) if timeout else remaining
+
+    # Limit every command run on this instance within the block to finish within `seconds` (if set).
+    # Nested operations share the outermost deadline.
+    @contextmanager
+    def _operation_timeout(self, seconds):
+        if not seconds or self._deadline:
+            yield
+            return
+        self._deadline = time.time() + seconds
+        try:
+            yield
+        finally:
+            self._deadline = None
+
+    # Facts about this instance (default: all of them), gathered once per run in a single round trip.
+    def _get_facts(self, names = None, refresh = False):
+        missing = [n for n in (names or Facts.probe_names) if refresh or not n in self._facts]
+        if len(missing) > 0:
+            checksum_files = list(self._get_desired_files()) if 'checksums' in missing else []
+            self._facts.update(Facts(self).gather(missing, checksum_files, refresh))
+        return self._facts
+
+    # Re-probe every fact, replacing the on-disk cache.
+    @traced()
+    def refresh_facts(self):
+        facts = self._get_facts(refresh=True)
+        for interface in facts['network']:
+            self.log.info(f'{interface} = {facts["network"][interface].get("inet")}')
+        if facts.get('bluetooth'): self.log.info(f'bluetooth = {facts["bluetooth"]}')
+
+    # Files which should exist on this instance, keyed by path relative to the home directory.
+    def _get_desired_files(self):
+        return {}
 
-    # SCP a file to/from the node.
-    def _scp(self, fp_from, fp_to):
-        cmd = f'scp "{fp_from}" "{fp_to}"'
-        self.log.debug(cmd)
-        return subprocess.run(cmd, shell=True, check=True, capture_output=self.cluster.quiet)
+    # True if a step may be skipped because its desired state is already satisfied (and not --force).
+    def _satisfied(self, satisfied, what):
+        if not satisfied or self.cluster.force: return False
+        self.log.info(f'{what} already up-to-date; skipping.')
+        return True
+
+    # Start a batch of commands which will run on this instance in a single round trip.
+    def _batch(self, name = 'batch'):
+        return Batch(self, name)
 
     # Upload a file from the local machine to the instance.
     def _upload(self, fp_local, fp_remote):
-        return self._scp(fp_local, f'{self.user_address}:{fp_remote}')
+        with self.cluster.tracer.span(f'upload {os.path.basename(fp_local)}', 'transfer', self.name) as span:
+            if os.path.isfile(fp_local): span['bytes_sent'] = os.path.getsize(fp_local)
+            return self.transport.upload(fp_local, fp_remote)
 
     # Download a file from the instance to the local machine.
     def _download(self, fp_remote, fp_local):
-        # self._sh(f'mkdir -p {os.path.dirname(fp_local)}')
-        return self._scp(f'{self.user_address}:{fp_remote}', fp_local)
+        with self.cluster.tracer.span(f'download {os.path.basename(fp_remote)}', 'transfer', self.name):
+            return self.transport.download(fp_remote, fp_local)
 
     # Install docker & kubeadm
+    @traced('step')
     def _setup_kubeadm(self):
+        facts = self._get_facts()
+        pkgs = facts['packages']
+        docker = 'docker-ce' in pkgs or 'docker.io' in pkgs
+        installed = docker and 'kubeadm' in pkgs and 'nfs-kernel-server' in pkgs and facts['cgroups']
+        if self._satisfied(installed, 'docker & kubeadm'): return
+        self._changed = True
         self.log.info('installing kubeadm, this may take a while...')
-        self._upload_rp_file('setup-kubeadm.sh')
+        self._sync_rp_files('setup-kubeadm.sh')
         self.exec(f'bash ./setup-kubeadm.sh')
 
     # https://vitux.com/install-nfs-server-and-client-on-ubuntu/
+    # The export options & the number of nfsd threads come from the NFS profile (see `nfs.profiles`).
+    @traced()
     def configure_nfs(self):
-        if not self.cfg['nfs'] or len(self.cfg['nfs']['directory']) <= 0: return
-        nfs_path = self.cfg['nfs']['directory']
-        self.log.info(f'installing nfs at {nfs_path}...')
-        self.exec(f'sudo mkdir -p {nfs_path}')
-        self.exec(f'sudo chown nobody:nogroup {nfs_path}')
-        self.exec(f'sudo chmod 777 {nfs_path}')
-        exports = ["# Generated by tiny-cluster"]
-        for ip in self.cfg['nfs']['allow_ips']:
-            permissions = ",".join(self.cfg['nfs']['allow_ips'][ip])
+        cfg = self.cfg.get('nfs')
+        if not cfg or len(cfg['directory']) <= 0: return
+        nfs_path = cfg['directory']
+        profile = NfsProfile(self.cluster, cfg.get('profile'))
+        exports = [f'# Generated by tiny-cluster ({profile.name} profile)']
+        for ip in cfg['allow_ips']:
+            permissions = ",".join(NfsProfile.merge(profile.export, cfg['allow_ips'][ip]))
             self.log.info(f'granting {permissions} to {ip} at {nfs_path}...')
             exports.append(f'{nfs_path} {ip}({permissions})')
         exports = "\n".join(exports)
-        self.exec(f'echo "{exports}" | sudo tee /etc/exports > /dev/null')
-        self.exec(f'sudo exportfs -a')
-        self.exec(f'sudo systemctl restart nfs-kernel-server')
+        facts = self._get_facts()
+        configured = facts['exports'] == exports and facts['nfs_threads'] == profile.threads
+        if self._satisfied(configured, 'nfs exports'): return
+        self._changed = True
+        self.log.info(f'installing nfs at {nfs_path} with {profile.threads} server threads...')
+        batch = self._batch('configure_nfs')
+        batch.exec(f'sudo mkdir -p {nfs_path}')
+        batch.exec(f'sudo chown nobody:nogroup {nfs_path}')
+        batch.exec(f'sudo chmod 777 {nfs_path}')
+        batch.write('/etc/exports', exports + "\n", sudo=True)
+        # Debian's init script reads RPCNFSDCOUNT; newer nfs-utils read /etc/nfs.conf.d.
+        batch.exec(f'sudo sed -i "s/^RPCNFSDCOUNT=.*/RPCNFSDCOUNT={profile.threads}/" /etc/default/nfs-kernel-server')
+        batch.exec('sudo mkdir -p /etc/nfs.conf.d')
+        batch.write('/etc/nfs.conf.d/tiny-cluster.conf', f'[nfsd]\nthreads={profile.threads}\n', sudo=True)
+        batch.exec(f'sudo exportfs -ra')
+        batch.exec(f'sudo systemctl restart nfs-kernel-server')
+        batch.run()
 
     # Get the path at which to store a local file.
-    def _upload_rp_file(self, fp_remote):
+    def _rp_file_path(self, fp_remote):
         fp_local = fp_remote
         if fp_local.startswith('.'): fp_local = fp_local[1:]
-        fp_local = f'{self.cluster.cwd}/raspberry-pi/{fp_local}'
-        return self._upload(fp_local, fp_remote)
+        return f'{self.cluster.cwd}/raspberry-pi/{fp_local}'
+
+    # Read one of the raspberry-pi/ files.
+    def _read_rp_file(self, fp_remote):
+        with open(self._rp_file_path(fp_remote), 'r') as f: return f.read()
+
+    # Sync raspberry-pi/ files to the home directory (only transferring those which changed).
+    def _sync_rp_files(self, *fps):
+        return Sync(self, {fp: self._read_rp_file(fp) for fp in fps}, [fp for fp in fps if fp.endswith('.sh')]).run(
+            force=self.cluster.force)
 
     # ensure all software is up-to-date
+    @traced()
     def update(self):
+        facts = self._get_facts()
+        fresh = facts['apt_age'] != None and facts['apt_age'] < self._apt_max_age
+        if self._satisfied(fresh and facts['apt_upgradable'] == 0, 'packages'): return
+        if facts['apt_upgradable']: self._changed = True
         self.log.info(f'updating packages...')
         self._apt(f'apt autoremove')
         self._apt('apt-get update')
         self._apt('apt-get upgrade')
 
     # Distribution upgrade
+    @traced()
     def upgrade(self):
         self.log.info(f'upgrading...')
         self._apt('apt-get dist-upgrade')
 
     # Reboot the instance
+    @traced()
     def reboot(self):
         self.log.info(f'rebooting...')
         self.exec('sudo reboot &')
+        self._rebooted = True
+        self.transport.close()
+
+    # The ID of the running kernel's boot (changes on every reboot), or None if unreachable.
+    # A device which is still going down (or coming up) may accept the connection but never answer.
+    def _get_boot_id(self):
+        try:
+            r = self._exec_once('cat /proc/sys/kernel/random/boot_id', True, None, self._get_timeout(30))
+        except subprocess.TimeoutExpired:
+            return None
+        return r.stdout.strip() if r.returncode == 0 else None
+
+    # Block until the instance is reachable again with a new boot ID.
+    @traced('step')
+    def _wait_for_reboot(self, boot_id, timeout):
+        self.log.info('waiting for reboot...')
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(5)
+            self.transport.close() # Never reuse a connection from before the reboot.
+            current = self._get_boot_id()
+            if current and current != boot_id:
+                self.log.info('back online.')
+                self._facts = {}
+                return
+        raise Exception(f'did not come back within {timeout}s of rebooting')
 
     # Copy SSH key from localhost
+    @traced()
     def ssh_copy_id(self, fp = '~/.ssh/id_rsa'):
-      if self.connect != 'ssh':
-          self.log.warning(f'will not add SSH key because connection type is {self.connect}')
-          return
-      fp = os.path.expanduser(fp)
-      if not os.path.isfile(fp):
-          self.log.warning(f'skipping adding SSH key because nothing exists at {fp}')
-          return
-      self.log.info(f'configuring SSH access for {fp} to {self.user_address}...')
-      subprocess.run(f'ssh-copy-id -i {fp} {self.user_address}', shell=True, check=True)
+      self.transport.copy_id(os.path.expanduser(fp))
 
     # Get the IPv4 address of a given interface
     def _get_network_address(self, interface, itype = 'inet'):
-        self.log.debug(f'examining interface {interface} for {itype}...')
-        cmd = f"/sbin/ifconfig {interface} | grep '{itype} ' || echo ''"
-        res = self.exec(cmd, capture_output=True).stdout
-        if len(res) <= 0: return None
-        net = [x for x in res.split(' ') if len(x) > 0]
-        if len(net) < 2 or net[0] != itype:
-            raise Exception(f'ifconfig returned unknown syntax: {res}')
-        return net[1]
+        network = self._get_facts(['network'])['network']
+        return network[interface].get(itype) if interface in network else None
 
     # Get the names of all network interfaces
     def _get_network_interfaces(self):
-        if self._network_interfaces: return self._network_interfaces
-        cmd = "/sbin/ip -o link show"
-        if_matcher = re.compile('(?P<num>[0-9]+):\s*(?P<interface>[0-9a-z]*):')
-        res = self.exec(cmd, capture_output=True).stdout.split('\n')
-        self._network_interfaces = []
-        for line in res:
-            match = if_matcher.match(line)
-            if not match or not match.group('interface'): continue
-            interface = match.group('interface')
-            if interface == 'lo': continue
-            self._network_interfaces.append(interface)
-        return self._network_interfaces
+        return list(self._get_facts(['network'])['network'])
 
     # Get the name of the first interface connected to the internet, or with an explicit IP.
     def _get_best_interface(self, ip_address = None):
@@ -159,6 +291,7 @@ class Instance():
                 return interface
         return None
 
+    @traced()
     def print_network_interfaces(self):
         for interface in self._get_network_interfaces():
             addr = self._get_network_address(interface)
@@ -167,7 +300,7 @@ class Instance():
     # Helper to build apt commands.
     def _apt(self, cmd, values = ''):
         flags = '-y -qq' if self.cluster.quiet else '-y'
-        return self.exec(f'sudo {cmd} {flags} {values}')
+        return self.exec(f'sudo {cmd} {flags} {values}', idempotent=True)
 
     # def configure(self):
     #     self.log.info('determining join command...')
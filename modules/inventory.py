@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import os, yaml, fcntl
+from contextlib import contextmanager
+from deepmerge import always_merger
+
+"""
+The inventory of nodes (and the master) in a context, indexed by name, address, label and MAC address.
+The context YAML file remains the source of truth which people edit (and so the import/export format).
+Changes are made under an exclusive lock on a sidecar file: the YAML is re-read, changed, and atomically
+replaced, so concurrent tiny-cluster processes never lose each other's changes.
+"""
+class Inventory():
+    def __init__(self, fp, nodes):
+        self.fp = fp
+        self.fp_lock = f'{fp}.lock'
+        self._index(nodes)
+
+    # Build the indexes from {address: node config}.
+    def _index(self, nodes):
+        self.nodes = {}
+        self.by_name = {}
+        self.by_label = {}
+        self.by_mac = {}
+        for address in nodes or {}: self._add(address, nodes[address] or {})
+
+    def _add(self, address, cfg):
+        name = cfg.get('name')
+        if name in self.by_name and self.by_name[name] != address:
+            raise Exception(f'the node name {name} is being claimed for {address}.\n'
+                f'It previously appeared for {self.by_name[name]}')
+        self._remove(address)
+        self.nodes[address] = cfg
+        if name: self.by_name[name] = address
+        for label in cfg.get('labels') or []: self.by_label.setdefault(label, set()).add(address)
+        if cfg.get('mac'): self.by_mac[cfg['mac'].lower()] = address
+
+    def _remove(self, address):
+        cfg = self.nodes.pop(address, None)
+        if not cfg: return
+        if self.by_name.get(cfg.get('name')) == address: del self.by_name[cfg['name']]
+        for label in cfg.get('labels') or []: self.by_label.get(label, set()).discard(address)
+        if cfg.get('mac') and self.by_mac.get(cfg['mac'].lower()) == address: del self.by_mac[cfg['mac'].lower()]
+
+    # The address of the node with a name (or None).
+    def address_for(self, name):
+        return self.by_name.get(name)
+
+    # The address of the node with a MAC address (or None).
+    def address_for_mac(self, mac):
+        return self.by_mac.get(mac.lower()) if mac else None
+
+    # The addresses of the nodes which have every one of the labels (all nodes, if none are given).
+    def find(self, labels = []):
+        if len(labels) <= 0: return list(self.nodes)
+        matched = set.intersection(*[self.by_label.get(label, set()) for label in labels])
+        return [address for address in self.nodes if address in matched]
+
+    # Hold an exclusive lock on the inventory while it is modified.
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+        with open(self.fp_lock, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not os.path.isfile(self.fp): return {}
+        with open(self.fp, 'r') as stream:
+            return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+
+    def _save(self, doc):
+        with open(f'{self.fp}.tmp', 'w') as file:
+            yaml.dump(doc, file, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), default_flow_style=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'{self.fp}.tmp', self.fp)
+
+    # Re-read the YAML, let fn change it, and write it back (all under the lock). Returns fn's result.
+    def _modify(self, fn):
+        with self._locked():
+            doc = self._load()
+            res = fn(doc)
+            self._save(doc)
+            return res
+
+    # Merge values into a node's configuration, omitting any which match the node defaults.
+    # Returns the node's configuration as written.
+    def update_node(self, address, values, defaults = {}):
+        values = {k: v for k, v in values.items() if k != 'address' and not (k in defaults and defaults[k] == v)}
+        def update(doc):
+            nodes = doc.setdefault('nodes', None) or {}
+            doc['nodes'] = nodes
+            cfg = always_merger.merge(nodes.get(address) or {}, values)
+            claimed = [a for a in nodes if a != address and (nodes[a] or {}).get('name') == cfg.get('name')]
+            if claimed: raise Exception(f'the node name {cfg.get("name")} is being claimed for {address}.\n'
+                f'It previously appeared for {claimed[0]}')
+            nodes[address] = cfg
+            return cfg
+        cfg = self._modify(update)
+        self._add(address, cfg)
+        return cfg
+
+    # Replace the master's configuration.
+    def update_master(self, values):
+        def update(doc):
+            doc['kubernetes'] = doc.get('kubernetes') or {}
+            doc['kubernetes']['master'] = values
+        self._modify(update)
+        return values
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import os, re, time, yaml, threading
+
+"""
+Hand out one `kubeadm join` command (and so one bootstrap token) to every node joining the master.
+The token is minted with a bounded TTL and reused for the rest of the run, and across runs until shortly before
+it expires, as long as the master's CA is unchanged. It is safe to call from many concurrent joins.
+"""
+class JoinCoordinator():
+    _margin = 300 # Seconds before expiry at which a token is no longer handed out.
+
+    def __init__(self, master):
+        self.master = master
+        self.log = master.log
+        self.ttl = int((master.cluster.config['kubernetes'] or {}).get('join_token_ttl') or 3600)
+        cfg = master.cluster.config.get('facts') or {}
+        cache_dir = os.path.join(master.cluster.cwd, cfg.get('cache_dir') or '.cache')
+        self.fp = os.path.join(cache_dir, master.cluster.context, 'join.yaml')
+        self._lock = threading.Lock()
+        self._ca_hash = None
+        self._cached = None # {'command', 'ca_hash', 'expires'}
+
+    # The "sha256:<hex>" hash of the master's CA public key (as in --discovery-token-ca-cert-hash).
+    def ca_hash(self):
+        with self._lock:
+            if not self._ca_hash: self._ca_hash = self.master._get_facts(['ca_hash'], refresh=True)['ca_hash']
+            return self._ca_hash
+
+    # The CA hash which a join command tells the node to trust.
+    @staticmethod
+    def _parse_ca_hash(command):
+        match = re.search('--discovery-token-ca-cert-hash\\s+(\\S+)', command)
+        return match.group(1) if match else None
+
+    def _valid(self, cached):
+        return cached and cached['expires'] - self._margin > time.time() and cached['ca_hash'] == self._ca_hash
+
+    def _load(self):
+        if not os.path.isfile(self.fp): return None
+        with open(self.fp, 'r') as stream: return yaml.safe_load(stream)
+
+    # The token is a credential, so the cache file is only readable by its owner.
+    def _save(self, cached):
+        os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+        fd = os.open(f'{self.fp}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file: yaml.dump(cached, file, default_flow_style=False)
+        os.replace(f'{self.fp}.tmp', self.fp)
+
+    # Create a new token (which is neither cached nor shared, unless the caller does so).
+    def _mint(self, ttl = None):
+        ttl = ttl or self.ttl
+        self.log.info(f'creating a join token (valid for {ttl}s)...')
+        r = self.master.exec(f'sudo kubeadm token create --ttl {ttl}s --print-join-command', capture_output=True)
+        command = r.stdout.strip()
+        if len(command) <= 0: raise Exception('failed to retrieve kubeadm join command')
+        return {'command': command, 'ca_hash': self._parse_ca_hash(command), 'expires': time.time() + ttl}
+
+    # A join command which is valid for at least a few more minutes.
+    def get(self):
+        self.ca_hash()
+        with self._lock:
+            if not self._valid(self._cached):
+                cached = self._load()
+                if not self._valid(cached):
+                    cached = self._mint()
+                    self._ca_hash = self._ca_hash or cached['ca_hash']
+                    self._save(cached)
+                else:
+                    self.log.debug('reusing the cached join token.')
+                self._cached = cached
+            return self._cached['command']
+
+    # Forget the current token (e.g., after it was rejected), so that the next `get` mints a new one.
+    def invalidate(self):
+        with self._lock:
+            self._cached = None
+            if os.path.isfile(self.fp): os.remove(self.fp)
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
-import yaml, sys, argparse, os, re, logging, subprocess
+import yaml, sys, argparse, os, re, logging, subprocess, json, time
+from modules.trace import *
 
 """
 Manage Kiosk settings
 """
 class Kiosk():
+    _fp_stats = '~/.cache/tiny-cluster/kiosk-stats.jsonl' # Written by the watchdog.
+
     def __init__(self, node, kiosk_cfg):
         self.cfg = kiosk_cfg
         self.node = node
@@ -18,32 +21,119 @@ class Kiosk():
             self.url += f'?{qps}'
         self.log.debug(f'loaded kiosk [{self.url}]')
 
+    @traced('step')
     def setup(self):
+        pkgs = self.node._get_facts()['packages']
         if self.cfg:
+            if self.node._satisfied('xscreensaver' in pkgs and 'unclutter' in pkgs, 'kiosk packages'): return
+            self.node._changed = True
             self.log.info(f'installing xscreensaver...')
             self.node._apt(f'apt-get install', 'xscreensaver unclutter')
         else:
+            if self.node._satisfied(not 'xscreensaver' in pkgs and not 'unclutter' in pkgs, 'kiosk removal'): return
+            self.node._changed = True
             self.log.info(f'removing xscreensaver...')
             self.node._apt(f'apt-get remove', 'xscreensaver unclutter')
             self.node.exec('rm .xscreensaver || true')
             self.node.exec(f'rm kiosk.sh || true')
 
-    def configure(self):
-        if not self.cfg: return
+    # The performance profile (see `kiosk.profiles`), or {} if none is chosen.
+    def _get_profile(self):
+        name = self.cfg.get('profile')
+        if not name: return {}
+        profiles = self.cfg.get('profiles') or {}
+        if not name in profiles:
+            raise Exception(f'unknown kiosk profile "{name}" (expected one of: {", ".join(profiles)})')
+        return profiles[name]
+
+    # chromium_flags, plus those of the performance profile, plus the debugging port if the watchdog is enabled.
+    def _get_chromium_flags(self):
+        flags = self.cfg['chromium_flags'].split()
+        p = self._get_profile()
+        if p.get('gpu_rasterization') == True: flags += ['--enable-gpu-rasterization', '--ignore-gpu-blocklist']
+        if p.get('gpu_rasterization') == False: flags.append('--disable-gpu-rasterization')
+        if p.get('gpu_memory_mb'): flags.append(f'--force-gpu-mem-available-mb={p["gpu_memory_mb"]}')
+        if p.get('renderer_process_limit'): flags.append(f'--renderer-process-limit={p["renderer_process_limit"]}')
+        if p.get('disk_cache_mb') != None: flags.append(f'--disk-cache-size={int(p["disk_cache_mb"] * 1048576)}')
+        if p.get('js_heap_mb'): flags.append(f'--js-flags=--max-old-space-size={p["js_heap_mb"]}')
+        if p.get('low_end_device'): flags.append('--enable-low-end-device-mode')
+        flags += p.get('flags') or []
+        if self._get_watchdog(): flags.append(f'--remote-debugging-port={self._get_watchdog()["port"]}')
+        return " ".join(flags)
 
-        self.node._upload_rp_file('kiosk.sh')
-        self.node.exec('chmod +x kiosk.sh')
+    # The watchdog configuration, or None if it is disabled.
+    def _get_watchdog(self):
+        watchdog = self.cfg.get('watchdog') or {}
+        return watchdog if watchdog.get('enabled') else None
 
-        self.node._autostart('xscreensaver &')
+    # Lines for the node's autostart.sh
+    def _get_autostart_lines(self):
+        if not self.cfg: return []
+        lines = ['xscreensaver &']
         if self.cfg['unclutter']:
-            self.node._autostart(f'unclutter -idle {self.cfg["unclutter"]} -root &')
+            lines.append(f'unclutter -idle {self.cfg["unclutter"]} -root &')
+        kiosk = f'{self.node.dir_home}/kiosk.sh "{self.url}" -f "{self._get_chromium_flags()}"'
+        w = self._get_watchdog()
+        if w:
+            opts = f'--port {w["port"]} --interval {w["interval"]} --stall-seconds {w["stall_seconds"]} ' \
+                f'--failures {w["failures"]} --keep {w["keep"]} --stats {self._fp_stats}'
+            if w.get('max_heap_mb'): opts += f' --max-heap-mb {w["max_heap_mb"]}'
+            if w.get('max_hours'): opts += f' --max-hours {w["max_hours"]}'
+            kiosk = f'python3 {self.node.dir_home}/kiosk-watchdog.py {opts} -- {kiosk} > /dev/null 2>&1 &'
+        lines.append(kiosk)
+        return lines
 
-        self.log.info(f'configuring xscreensaver...')
-        self.node._upload_rp_file('.xscreensaver')
+    # The watchdog's most recent records (see raspberry-pi/kiosk-watchdog.py).
+    def _get_stats(self, count):
+        r = self.node.exec(f'tail -n {count} {self._fp_stats} 2>/dev/null', check=False, capture_output=True,
+            idempotent=True)
+        records = []
+        for line in r.stdout.strip().split('\n'):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass # e.g., a line being written.
+        return records
 
-        xss = self.cfg['xscreensaver']
-        self.node.exec(f'sed -i "s/TIMEOUT/{xss["timeout"]}/g" .xscreensaver')
-        self.node.exec(f'sed -i "s/MODE/{xss["mode"]}/g" .xscreensaver')
+    # Summarize the watchdog's samples & restarts (the last `count` records).
+    def print_stats(self, count = 1440):
+        w = self._get_watchdog()
+        if not w: self.log.warning('the kiosk watchdog is not enabled (see kiosk.watchdog).')
+        records = self._get_stats(count)
+        samples = [r for r in records if not 'event' in r]
+        restarts = [r for r in records if r.get('event') == 'restart']
+        if len(records) <= 0:
+            print('no samples recorded yet.')
+            return
+        hours = (records[-1]['at'] - records[0]['at']) / 3600
+        print(f'samples: {len(samples)} over {hours:.1f}h')
+        heaps = [s['heap_mb'] for s in samples if s.get('heap_mb') != None]
+        if heaps:
+            limit = w.get('max_heap_mb') if w else None
+            print(f'JS heap: {heaps[-1]:.1f} MB now, {max(heaps):.1f} MB peak' +
+                (f' (restart above {limit} MB)' if limit else ''))
+        loads = [s['load_s'] for s in samples if s.get('load_s') != None]
+        if loads: print(f'page load: {loads[-1]:.2f}s (latest), {max(loads):.2f}s (slowest)')
+        frames = sorted([s['frame_ms'] for s in samples if s.get('frame_ms') != None])
+        if frames: print(f'frame: {frames[len(frames) // 2]:.0f} ms median, {frames[-1]:.0f} ms slowest')
+        stalled = len([s for s in samples if s.get('stalled')])
+        errors = len([s for s in samples if s.get('error')])
+        print(f'stalled samples: {stalled}, unreachable: {errors}')
+        if samples and samples[-1].get('browser_s') != None:
+            print(f'browser up: {samples[-1]["browser_s"] / 3600:.1f}h')
+        print(f'restarts: {len(restarts)}')
+        for r in restarts:
+            print(f'  {time.strftime("%Y-%m-%d %H:%M", time.localtime(r["at"]))}  {r["reason"]}')
 
-        self.log.info(f'setting kiosk url: "{self.url}"...')
-        self.node._autostart(f'{self.node.dir_home}/kiosk.sh "{self.url}" -f "{self.cfg["chromium_flags"]}"')
+    # Kiosk files (relative to the home directory), with the xscreensaver template rendered locally.
+    def _get_desired_files(self):
+        if not self.cfg: return {}
+        xss = self.cfg['xscreensaver']
+        xscreensaver = self.node._read_rp_file('.xscreensaver')
+        xscreensaver = xscreensaver.replace('TIMEOUT', str(xss['timeout'])).replace('MODE', str(xss['mode']))
+        files = {
+            'kiosk.sh': self.node._read_rp_file('kiosk.sh'),
+            '.xscreensaver': xscreensaver,
+        }
+        if self._get_watchdog(): files['kiosk-watchdog.py'] = self.node._read_rp_file('kiosk-watchdog.py')
+        return files
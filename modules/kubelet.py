@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import re, copy
+from deepmerge import always_merger
+
+"""
+Kubelet settings sized to a node's hardware (model, RAM, CPUs & root storage, from its facts): the `kubelet.tiers`
+entry for its RAM, adjusted for its storage, then overridden by the node's own `kubelet` configuration.
+They are written as KUBELET_EXTRA_ARGS (in /etc/default/kubelet), which kubeadm's systemd drop-in passes to kubelet.
+"""
+class KubeletTuning():
+    fp = '/etc/default/kubelet'
+    # Labels which tiny-cluster derives from the hardware (and keeps up-to-date, like configured labels).
+    label_keys = ['tiny-cluster/model', 'tiny-cluster/memory-mb', 'tiny-cluster/cpus', 'tiny-cluster/storage']
+
+    def __init__(self, node):
+        self.node = node
+        self.log = node.log
+        self.cfg = node.cluster.config.get('kubelet') or {}
+        self.overrides = node.cfg.get('kubelet') or {}
+        self._hardware = None
+        self._unreachable = False
+
+    # {'model', 'cpus', 'memory_mb', 'storage' (sd, usb, nvme or other), 'root_mb'}, from the `hardware` fact.
+    def get_hardware(self):
+        if self._hardware == None: self._hardware = self.node._get_facts(['hardware'])['hardware']
+        return self._hardware
+
+    # The labels for this node's hardware, or None if it cannot be determined (e.g., the node is unreachable).
+    def get_labels(self):
+        if self._unreachable: return None
+        try:
+            hw = self.get_hardware()
+        except Exception as e:
+            self.log.warning(f'hardware unknown, so hardware labels are left as they are: {e}')
+            self._unreachable = True
+            return None
+        labels = {}
+        # Label values are at most 63 alphanumerics, dashes, dots & underscores: "Raspberry Pi 4 Model B Rev 1.4"
+        # becomes "raspberry-pi-4-model-b".
+        model = re.sub('[^a-z0-9]+', '-', re.sub(' Rev [0-9.]+$', '', hw['model'] or '').lower())[:63].strip('-')
+        if model: labels['tiny-cluster/model'] = model
+        if hw['memory_mb']: labels['tiny-cluster/memory-mb'] = str(hw['memory_mb'])
+        if hw['cpus']: labels['tiny-cluster/cpus'] = str(hw['cpus'])
+        labels['tiny-cluster/storage'] = hw['storage']
+        return labels
+
+    # The settings for this node: the largest tier which its RAM reaches, then storage & node overrides.
+    def get_settings(self):
+        hw = self.get_hardware()
+        tiers = sorted(self.cfg.get('tiers') or [], key=lambda t: t['memory_mb'])
+        fits = [t for t in tiers if t['memory_mb'] <= (hw['memory_mb'] or 0)]
+        settings = copy.deepcopy(fits[-1] if fits else tiers[0] if tiers else {})
+        settings.pop('memory_mb', None)
+        always_merger.merge(settings, copy.deepcopy((self.cfg.get('storage') or {}).get(hw['storage']) or {}))
+        return always_merger.merge(settings, copy.deepcopy(self.overrides))
+
+    # The kubelet command-line flags for the settings.
+    def get_args(self):
+        s = self.get_settings()
+        kv = lambda d, sep: ",".join([f'{k}{sep}{v}' for k, v in d.items()])
+        args = []
+        if s.get('max_pods'): args.append(f'--max-pods={s["max_pods"]}')
+        if s.get('system_reserved'): args.append(f'--system-reserved={kv(s["system_reserved"], "=")}')
+        if s.get('kube_reserved'): args.append(f'--kube-reserved={kv(s["kube_reserved"], "=")}')
+        if s.get('eviction_hard'): args.append(f'--eviction-hard={kv(s["eviction_hard"], "<")}')
+        if s.get('image_gc_high'): args.append(f'--image-gc-high-threshold={s["image_gc_high"]}')
+        if s.get('image_gc_low'): args.append(f'--image-gc-low-threshold={s["image_gc_low"]}')
+        if s.get('cpu_manager_policy'): args.append(f'--cpu-manager-policy={s["cpu_manager_policy"]}')
+        if self.node.storage.cfg.get('zram'): args.append('--fail-swap-on=false') # See StorageProfile.
+        return args + list(s.get('extra_args') or [])
+
+    # The contents of /etc/default/kubelet.
+    def get_file(self):
+        return f'KUBELET_EXTRA_ARGS={" ".join(self.get_args())}\n'
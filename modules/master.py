@@ -1,70 +1,253 @@
 #!/usr/bin/env python3
-import yaml, sys, argparse, os, re, logging, subprocess, socket
+import yaml, sys, argparse, os, re, logging, subprocess, socket, json
 from modules.instance import *
+from modules.join import *
+from modules.images import *
+from modules.kubelet import *
 
 """
 Master node
 """
 class Master(Instance):
+    _master_taints = ['node-role.kubernetes.io/master:NoSchedule', 'node-role.kubernetes.io/control-plane:NoSchedule']
+
     def __init__(self, cluster, master_cfg):
         super(Master, self).__init__(cluster, 'master', master_cfg)
+        self._joins = JoinCoordinator(self)
         self.log.debug(f'loaded master at {self.user_address}')
 
-    # Command for a node to join this cluster.
+    # Command for a node to join this cluster (one token is shared by every join; see JoinCoordinator).
+    @traced('step')
     def _get_join_command(self):
-        return self.exec('sudo kubeadm token create --print-join-command', capture_output=True).stdout
+        return self._joins.get()
+
+    # Names of the nodes which are not currently Ready (including cordoned nodes).
+    def _get_unready_nodes(self):
+        r = self.exec('kubectl get nodes --no-headers', capture_output=True, idempotent=True)
+        unready = []
+        for line in r.stdout.strip().split('\n'):
+            cols = line.split()
+            if len(cols) >= 2 and cols[1] != 'Ready': unready.append(cols[0])
+        return unready
 
+    @traced()
     def print_join_command(self):
         print(self._get_join_command())
 
+    # Install apt-cacher-ng on the apt cache host (the master, unless `apt_cache.node` names a node).
+    @traced()
+    def install_apt_cache(self):
+        host = self.cluster.get_apt_cache_host()
+        host.log.info('installing apt-cacher-ng...')
+        batch = host._batch('apt_cache')
+        batch.exec('sudo DEBIAN_FRONTEND=noninteractive apt-get install -y -qq apt-cacher-ng')
+        batch.exec(f'sudo sed -i "s/^#* *Port:.*/Port: {self.cluster.config["apt_cache"]["port"]}/" '
+            '/etc/apt-cacher-ng/acng.conf')
+        batch.exec('sudo systemctl enable apt-cacher-ng && sudo systemctl restart apt-cacher-ng')
+        batch.run()
+        host.log.info(f'apt cache is running at {self.cluster.get_apt_cache_url()}')
+
+    # Print how much traffic the apt cache has served vs. fetched from upstream.
+    @traced()
+    def apt_cache_stats(self):
+        host = self.cluster.get_apt_cache_host()
+        # Log lines are: time|flag|bytes|client|path, where flag O = served to a node and I = fetched upstream.
+        # Rotated logs are gzipped (zcat -f passes the others through); the glob is expanded as root.
+        # Piped to `bash -s`, so that the fields are expanded by awk on the host (not by the local shell).
+        script = """sudo sh -c 'zcat -f /var/log/apt-cacher-ng/apt-cacher.log* 2>/dev/null' | \\
+  awk -F'|' '{ n[$2]++; b[$2] += $3 } END { print n["O"]+0, b["O"]+0, n["I"]+0, b["I"]+0 }'
+"""
+        r = host.exec('bash -s', capture_output=True, input=script)
+        served, served_bytes, fetched, fetched_bytes = [int(float(x)) for x in r.stdout.split()]
+        mb = 1024 * 1024
+        hit_rate = 1 - (fetched_bytes / served_bytes) if served_bytes > 0 else 0
+        print(f'requests served: {served} ({served_bytes / mb:.1f} MB)')
+        print(f'fetched upstream: {fetched} ({fetched_bytes / mb:.1f} MB)')
+        print(f'byte hit rate: {hit_rate * 100:.1f}% ({max(0, served_bytes - fetched_bytes) / mb:.1f} MB saved)')
+
+    # Benchmark the NFS export from every node which mounts it (or only from --parallel N of them), all at once.
+    @traced()
+    def nfs_bench(self):
+        nodes = [n for n in self.cluster._select_nodes() if n._get_nfs_mount()]
+        if self.cluster.opts.parallel: nodes = nodes[:self.cluster.opts.parallel]
+        if len(nodes) <= 0: raise Exception('no node mounts an NFS export (see `nfs_mount`).')
+        bench = NfsBench(self.cluster, nodes, self.cluster.config['nfs']['bench'])
+        bench.run()
+        bench.print_summary()
+        if len(bench.results) < len(nodes):
+            raise Exception(f'the benchmark failed on {len(nodes) - len(bench.results)} node(s).')
+
+    # Pull the images of the kubernetes/ workloads once, and stream them to the nodes which will run them.
+    @traced()
+    def prepull(self):
+        if not Prepull(self, self.cluster.config.get('prepull') or {}).run():
+            raise Exception('some images could not be loaded onto their nodes.')
+
     # If the master is ALSO a node, returns that node. Otherwise, none.
     @property
     def _node(self):
-        if not self.address in self.cluster.nodes: return None
-        return self.cluster.nodes[self.address]
+        return self.cluster.get_node(self.address)
 
     # Create the Kubernetes cluster via Kubeadm, and run all install/config steps
+    @traced()
     def create(self):
         self.ssh_copy_id()
         self._setup_kubeadm()
+        self._init()
+        self.create_context()
+        self.install_network_add_on()
+        self.configure_nfs()
+        self.untaint()
+
+    # Initialize the control plane (unless this master already runs one).
+    @traced('step')
+    def _init(self):
         init_flags = f'--apiserver-advertise-address={self.address} --upload-certs'
         if self.cluster.network['add-on'] == 'flannel':
             init_flags += ' --pod-network-cidr=' + self.cluster.network['ip-range']
+        if self._satisfied(self._get_facts()['kubelet_joined'], 'kubeadm init'): return
         self.log.info('creating cluster with kubeadm...')
         self.exec(f'sudo swapoff -a && sudo kubeadm init {init_flags}')
-        self.create_context()
-        self.install_network_add_on()
-        self.configure_nfs()
-        self.untaint()
+
+    # Add the steps of `create` to a Scheduler, returning the step after which nodes may join.
+    # The master is untainted & labeled before the network add-on, i.e., before any node can have joined.
+    def _add_create_steps(self, scheduler):
+        prep = None
+        if not self._node: prep = scheduler.add('master:update', self.update) # A master node updates itself.
+        scheduler.add('master:kubeadm', self._setup_kubeadm, [prep])
+        scheduler.add('master:init', self._init, ['master:kubeadm'])
+        scheduler.add('master:context', self.create_context, ['master:init'])
+        scheduler.add('master:untaint', self.untaint, ['master:context'])
+        scheduler.add('master:nfs', self.configure_nfs, ['master:kubeadm'])
+        return scheduler.add('master:network', self.install_network_add_on, ['master:untaint'])
 
     # Create and download a context config file for this cluster.
+    @traced()
     def create_context(self):
         name = self.cluster.context
         fp = f'.kube/{name}.conf'
         self.log.info(f'creating cluster config file: {fp}...')
         cf =  f'/home/{self.username}/{fp}'
-        self.exec(f'mkdir -p /home/{self.username}/.kube')
-        self.exec(f'sudo cp /etc/kubernetes/admin.conf {cf} && sudo chmod +rw {cf}')
-        self.exec(f'sed -i s/kubernetes/{name}/g {cf}')
-        self.exec(f'ln -sf {cf} /home/{self.username}/.kube/config')
+        batch = self._batch('create_context')
+        batch.exec(f'mkdir -p /home/{self.username}/.kube')
+        batch.exec(f'sudo cp /etc/kubernetes/admin.conf {cf} && sudo chmod +rw {cf}')
+        batch.exec(f'sed -i s/kubernetes/{name}/g {cf}')
+        batch.exec(f'ln -sf {cf} /home/{self.username}/.kube/config')
+        batch.run()
         self._download(cf, f'$HOME/{fp}')
 
+    @traced()
     def set_context(self):
         name = self.cluster.context
         self.log.debug(f'setting context to {name}...')
-        self.exec(f'kubectl config set current-context {name}-admin@{name}')
+        self.exec(f'kubectl config set current-context {name}-admin@{name}', idempotent=True)
 
-    # Remove the master-node taint.
+    # Label the control plane, and remove the master-node taint (if the master is also a node).
+    @traced()
     def untaint(self):
         n = self._node
-        self.exec(f'kubectl label $(kubectl get nodes -o name) tiny-cluster/master=true --overwrite')
+        batch = self._batch('untaint')
+        batch.exec(f'kubectl label $(kubectl get nodes -o name) tiny-cluster/master=true --overwrite')
         if not n:
             self.log.debug(f'leaving master node tainted because it is not a node')
-            return
-        self.log.info(f'untaining master node "{n.name}"...')
-        self.exec(f'kubectl taint nodes {n.name} node-role.kubernetes.io/master-')
+        else:
+            self.log.info(f'untaining master node "{n.name}"...')
+            batch.exec(f'kubectl taint nodes {n.name} node-role.kubernetes.io/master- || true')
+        batch.run()
+
+    # The labels & taints of every registered node, from a single query.
+    # {name: {'labels': {key: value}, 'taints': {'key:Effect': value}}}
+    def _get_cluster_nodes(self):
+        r = self.exec('kubectl get nodes -o json', capture_output=True, idempotent=True)
+        nodes = {}
+        for item in json.loads(r.stdout)['items']:
+            taints = {f'{t["key"]}:{t["effect"]}': t.get('value') for t in item['spec'].get('taints') or []}
+            nodes[item['metadata']['name']] = {'labels': item['metadata'].get('labels') or {}, 'taints': taints}
+        return nodes
+
+    # The labels & taints a node should have, according to its configuration (and hardware, unless not `hardware`).
+    # Taints are written as key=value:Effect (or key:Effect).
+    def _get_desired_labels(self, node, hardware = True):
+        labels = (node.kubelet.get_labels() or {}) if hardware else {}
+        for label in node.cfg['labels'] or []:
+            key, _, value = label.partition('=')
+            labels[key] = value
+        if node._is_master(): labels['tiny-cluster/master'] = 'true'
+        taints = {}
+        for taint in node.cfg.get('taints') or []:
+            kv, _, effect = taint.rpartition(':')
+            if not kv: raise Exception(f'invalid taint on {node.name} (expected key=value:Effect): {taint}')
+            key, _, value = kv.partition('=')
+            taints[f'{key}:{effect}'] = value or None
+        return labels, taints
+
+    # Whether tiny-cluster may remove a label or taint which is not in the configuration.
+    def _is_managed(self, key):
+        prefixes = (self.cluster.config['kubernetes'] or {}).get('managed_label_prefixes') or []
+        return len([p for p in prefixes if key.startswith(p)]) > 0
+
+    # The changes (as diff lines) and kubectl commands which bring one node's labels & taints to the desired state.
+    def _diff_labels(self, node, current):
+        labels, taints = self._get_desired_labels(node)
+        diff, add, remove = [], [], []
+        for key, value in labels.items():
+            if key in current['labels'] and current['labels'][key] == value and not self.cluster.force: continue
+            if key in current['labels'] and current['labels'][key] != value:
+                diff.append(f'~ {node.name}: label {key}={current["labels"][key]} -> {value}')
+            else:
+                diff.append(f'+ {node.name}: label {key}={value}')
+            add.append(f'{key}={value}')
+        # Hardware labels are kept while the hardware is unknown (e.g., the node is unreachable).
+        keep = KubeletTuning.label_keys if node.kubelet.get_labels() == None else []
+        for key in current['labels']:
+            if key in labels or key in keep or not self._is_managed(key): continue
+            diff.append(f'- {node.name}: label {key}={current["labels"][key]}')
+            remove.append(f'{key}-')
+        cmds = []
+        if add or remove: cmds.append(f'kubectl label nodes {node.name} {" ".join(add + remove)} --overwrite')
+
+        add, remove = [], []
+        for key_effect, value in taints.items():
+            if key_effect in current['taints'] and current['taints'][key_effect] == value and not self.cluster.force:
+                continue
+            key, effect = key_effect.rsplit(':', 1)
+            diff.append(f'+ {node.name}: taint {key}{"=" + value if value else ""}:{effect}')
+            add.append(f'{key}{"=" + value if value else ""}:{effect}')
+        unwanted = self._master_taints if node._is_master() else []
+        for key_effect in current['taints']:
+            if key_effect in taints or not (key_effect in unwanted or self._is_managed(key_effect)): continue
+            diff.append(f'- {node.name}: taint {key_effect}')
+            remove.append(f'{key_effect}-')
+        if add or remove: cmds.append(f'kubectl taint nodes {node.name} {" ".join(add + remove)} --overwrite')
+        return diff, cmds
+
+    # Make the labels & taints of the cluster's nodes (default: every configured node) match the configuration.
+    # Current state is read in one query and every change is applied in one batch; --dry-run only prints the diff.
+    def _reconcile_labels(self, nodes = None):
+        nodes = self.cluster.get_nodes() if nodes == None else nodes
+        current = self._get_cluster_nodes()
+        diff = []
+        batch = self._batch('reconcile_labels')
+        for node in nodes:
+            if not node.name in current:
+                node.log.warning('not registered with the master; not labeling.')
+                continue
+            node_diff, cmds = self._diff_labels(node, current[node.name])
+            diff += node_diff
+            for cmd in cmds: batch.exec(cmd)
+        for line in diff:
+            if self.cluster.opts.dry_run: print(line)
+            else: self.log.info(line)
+        if len(diff) <= 0: self.log.info('labels & taints already up-to-date.')
+        elif not self.cluster.opts.dry_run: batch.run()
+        return diff
+
+    @traced()
+    def reconcile_labels(self):
+        self._reconcile_labels()
 
     # Install the networking add-on, if requested
+    @traced()
     def install_network_add_on(self):
         ao = self.cluster.network['add-on']
         if not ao: return
@@ -76,7 +259,7 @@ class Master(Instance):
         else:
             raise Exception(f'Unsupported network add-on: {ao}')
         self.log.info(f'installing network add on: {af}')
-        self.exec(f'kubectl apply -f "{af}"')
+        self.exec(f'kubectl apply -f "{af}"', idempotent=True)
 
     # https://kubernetes.io/docs/setup/production-environment/tools/kubeadm/install-kubeadm/
     # https://medium.com/@kvaps/creating-high-available-baremetal-kubernetes-cluster-with-kubeadm-and-keepalived-simplest-guide-71766d5e25ae
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import re, time, logging
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+A named NFS performance profile (see `nfs.profiles` in defaults.yaml): the server's nfsd thread count, the export
+options, and the options with which nodes mount the export. Options in a configuration override the profile's.
+"""
+class NfsProfile():
+    # Options which cancel each other out (besides "x" vs. "no_x" / "nox").
+    _opposites = [['sync', 'async'], ['rw', 'ro'], ['hard', 'soft'], ['root_squash', 'no_root_squash', 'all_squash']]
+
+    def __init__(self, cluster, name = None):
+        cfg = cluster.config.get('nfs') or {}
+        self.name = name or cfg.get('profile')
+        profiles = cfg.get('profiles') or {}
+        if not self.name in profiles:
+            raise Exception(f'unknown nfs profile "{self.name}" (expected one of: {", ".join(profiles)})')
+        profile = profiles[self.name]
+        self.threads = int(profile['threads'])
+        self.export = list(profile.get('export') or [])
+        self.mount = list(profile.get('mount') or [])
+
+    # The key of an option, for overriding: "rsize=65536" -> "rsize", "no_wdelay" -> "wdelay", "async" -> "sync".
+    @classmethod
+    def _key(cls, option):
+        key = option.split('=', 1)[0]
+        for group in cls._opposites:
+            if key in group: return group[0]
+        return re.sub('^no_?', '', key)
+
+    # base, with each of the overrides replacing any option with the same key.
+    @classmethod
+    def merge(cls, base, overrides):
+        keys = [cls._key(o) for o in overrides or []]
+        return [o for o in base if not cls._key(o) in keys] + list(overrides or [])
+
+"""
+Measure an NFS export from many nodes at once: each node writes, reads back and then creates/stats/removes many small
+files in its own directory under its mount. Every node waits for a shared start time (by its own clock, so clocks
+should be in sync, e.g., by NTP) before it begins. Aggregates are the total work over the slowest node's time, so they
+are what the server sustained with every node busy.
+"""
+class NfsBench():
+    _script = '''set -e
+D={dir}/.tiny-cluster-bench/{name}
+now() {{ date +%s%N; }}
+rm -rf $D && mkdir -p $D
+while [ $(now) -lt {start} ] && [ $SECONDS -le {wait} ]; do sleep 0.01; done
+t0=$(now)
+dd if=/dev/zero of=$D/data bs=1M count={mb} conv=fsync status=none
+t1=$(now)
+sync && echo 3 | sudo tee /proc/sys/vm/drop_caches > /dev/null
+t2=$(now)
+dd if=$D/data of=/dev/null bs=1M status=none
+t3=$(now)
+for i in $(seq 1 {files}); do echo x > $D/f$i; done
+stat $D/f* > /dev/null
+rm -f $D/f*
+t4=$(now)
+rm -rf $D
+echo "write=$((t1 - t0)) read=$((t3 - t2)) meta=$((t4 - t3)) late=$((t0 - {start}))"
+'''
+
+    def __init__(self, cluster, nodes, cfg):
+        self.cluster = cluster
+        self.nodes = nodes
+        self.mb = int(cfg['size_mb'])
+        self.files = int(cfg['files'])
+        self.start_delay = float(cfg['start_delay'])
+        self.log = logging.getLogger('nfs-bench')
+        self.results = {}
+
+    # Seconds for each phase on one node (or None if it failed).
+    def _run_one(self, node, start):
+        mount = node._get_nfs_mount()
+        script = self._script.format(dir=mount['at'], name=node.name, mb=self.mb, files=self.files,
+            start=int(start * 1e9), wait=int(self.start_delay) + 5)
+        try:
+            with self.cluster.tracer.span('nfs-bench', 'node', node.name):
+                r = node.exec('bash -s', capture_output=True, input=script)
+            times = {k: max(int(v) / 1e9, 1e-6) for k, v in re.findall('(write|read|meta)=([0-9]+)', r.stdout)}
+            if len(times) < 3: raise Exception(f'unexpected output: {r.stdout.strip()}')
+            late = re.search('late=(-?[0-9]+)', r.stdout)
+            if late and abs(int(late.group(1))) > 1e9:
+                node.log.warning(f'started {int(late.group(1)) / 1e9:+.1f}s from the shared start time '
+                    f'(is its clock in sync? or raise nfs.bench.start_delay)')
+            return times
+        except Exception as e:
+            node.log.error(f'nfs benchmark failed: {e}')
+            return None
+
+    # Run on every node at once (each starting start_delay seconds from now, once all have connected);
+    # returns {name: {'write', 'read', 'meta'} seconds} for those which succeeded.
+    def run(self):
+        self.log.info(f'benchmarking from {len(self.nodes)} node(s): {self.mb} MB each, {self.files} small files...')
+        start = time.time() + self.start_delay
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as pool:
+            results = dict(zip([n.name for n in self.nodes], pool.map(lambda n: self._run_one(n, start), self.nodes)))
+        self.results = {name: r for name, r in results.items() if r}
+        return self.results
+
+    def print_summary(self):
+        if len(self.results) <= 0: return
+        ops = self.files * 3 # create, stat & unlink each file.
+        rows = [('NODE', 'WRITE MB/s', 'READ MB/s', 'META ops/s')]
+        for name, r in self.results.items():
+            rows.append((name, f'{self.mb / r["write"]:.1f}', f'{self.mb / r["read"]:.1f}', f'{ops / r["meta"]:.0f}'))
+        n = len(self.results)
+        slowest = {k: max([r[k] for r in self.results.values()]) for k in ['write', 'read', 'meta']}
+        rows.append((f'aggregate ({n})', f'{n * self.mb / slowest["write"]:.1f}',
+            f'{n * self.mb / slowest["read"]:.1f}', f'{n * ops / slowest["meta"]:.0f}'))
+        widths = [max([len(row[c]) for row in rows]) for c in range(len(rows[0]))]
+        for row in rows: print('  '.join([row[c].ljust(widths[c]) for c in range(len(row))]).rstrip())
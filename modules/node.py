@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
-import yaml, sys, argparse, os, re, logging, subprocess
+import yaml, sys, argparse, os, re, logging, subprocess, hashlib, json, time, copy
 from deepmerge import always_merger
 from modules.kiosk import *
 from modules.instance import *
+from modules.bundle import *
+from modules.kubelet import *
+from modules.storage import *
 
 """
 Manage a Node (each instance of this class controls a single device)
 """
 class Node(Instance):
     _fp_autostart = '~/.config/lxsession/LXDE-pi/autostart'
-    _bluetooth_mac = None
+    _fp_apt_proxy = '/etc/apt/apt.conf.d/01tiny-cluster-proxy'
+    _fp_apt_proxy_detect = '/usr/local/bin/tiny-cluster-apt-proxy'
+    _cluster_labels = None
 
     def __init__(self, cluster, node_cfg):
         if not 'name' in node_cfg:
@@ -22,6 +27,8 @@ class Node(Instance):
         # self.dir_backup = f'{self.cluster.cwd}/raspberry-pi/backup/{self.name}'
         self.dir_home = f'/home/{self.cfg["username"]}'
         self.kiosk = Kiosk(self, self._get_merged_config('kiosk'))
+        self.storage = StorageProfile(self)
+        self.kubelet = KubeletTuning(self)
         self.log.debug(f'loaded node {self.user_address} [{self.name}.local]')
 
     # Merge the default config & this node config (or return None if not configured for this node)
@@ -31,7 +38,7 @@ class Node(Instance):
         if self.cfg[key] == False or self.cfg[key] == None:
             self.log.debug(f'{key} disabled')
             return None
-        cfg = dict(self.cluster.config['defaults'][key])
+        cfg = copy.deepcopy(self.cluster.config['defaults'][key]) # Nested defaults must not be merged into.
         if type(self.cfg[key]) == dict or type(self.cfg[key]) == list:
             cfg = always_merger.merge(cfg, self.cfg[key])
         return cfg
@@ -46,49 +53,219 @@ class Node(Instance):
 
     # Return the MAC addr of the bluetooth, if available
     def _get_bt_mac_addr(self):
-        if not self._bluetooth_mac:
-            cmd = 'hcitool dev | grep -o "[[:xdigit:]:]\\\{11,17\\\}"'
-            self._bluetooth_mac = self.exec(cmd, capture_output=True).stdout
-        return self._bluetooth_mac
+        return self._get_facts(['bluetooth'])['bluetooth']
 
-    # Add a bash line to the autostart file
-    def _autostart(self, bash):
-        self.log.info(f'adding startup command `{bash}`...')
-        bash = bash.replace('\'', '\\\'')
-        self.exec(f'echo \'{bash}\' >> autostart.sh')
+    # Flags passed to startup.sh at boot.
+    def _get_startup_flags(self):
+        startup_flags = []
+        if not self.cfg['usb_ethernet']: startup_flags.append('--no-usb_ethernet')
+        if not self.cfg['hdmi']: startup_flags.append('--no-hdmi')
+        return " ".join(startup_flags)
+
+    # Files which should exist on this node (relative to the home directory), rendered locally.
+    def _get_desired_files(self):
+        autostart = self._read_rp_file('autostart.sh')
+        for bash in self.kiosk._get_autostart_lines():
+            autostart += f'{bash}\n'
+        files = {
+            'autostart.sh': autostart,
+            'startup.sh': self._read_rp_file('startup.sh'),
+            self._fp_autostart[2:]: f'@bash /home/pi/startup.sh {self._get_startup_flags()}\n',
+        }
+        files.update(self.kiosk._get_desired_files())
+        return files
 
     # Write all the configuration values.
+    @traced()
     def configure(self):
         self.log.info('configuring...')
-        self._upload_rp_file('autostart.sh')
-        self._upload_rp_file('startup.sh')
-        self.exec('chmod +x autostart.sh')
+        self._configure_files()
+        self._configure_apt_proxy()
+        self.configure_nfs()
+        self.configure_nfs_mount()
+        self.configure_storage()
+        if self._is_master(): self.configure_kubelet()
+        else: self.join() # Which tunes the kubelet first.
+        self.label()
 
-        startup_flags = []
-        if not self.cfg['usb_ethernet']: startup_flags.append('--no-usb_ethernet')
-        if not self.cfg['hdmi']: startup_flags.append('--no-hdmi')
-        startup_flags = " ".join(startup_flags)
+    # Write the files (see _get_desired_files) whose contents differ on the node.
+    @traced('step')
+    def _configure_files(self):
+        sync = Sync(self, self._get_desired_files(), ['autostart.sh', 'startup.sh', 'kiosk.sh'])
+        stale = sync.stale(self._get_facts()['checksums'])
+        if self._satisfied(len(stale) <= 0, 'configuration files'): return
+        self._changed = True
+        if self.cluster.force: stale = list(sync.files)
+        for fp in stale: self.log.info(f'writing {fp}...')
+        sync.push(stale)
 
-        self.exec(f'mkdir -p {os.path.dirname(self._fp_autostart)}')
-        self.exec(f'echo "@bash /home/pi/startup.sh {startup_flags}" > {self._fp_autostart}')
+    # The NFS export which this node mounts (see `nfs_mount` in defaults.yaml), or None.
+    # {'source': 'server:/directory', 'at': mountpoint, 'options': [...]}; options come from the NFS profile.
+    def _get_nfs_mount(self):
+        cfg = self.cfg.get('nfs_mount')
+        if not cfg: return None
+        cfg = cfg if type(cfg) == dict else {}
+        master = self.cluster.master
+        server_nfs = (master.cfg.get('nfs') or {}) if master else {}
+        server = cfg.get('server') or (master.address if master else None)
+        directory = cfg.get('directory') or server_nfs.get('directory')
+        if not server or not directory:
+            raise Exception(f'nfs_mount on {self.name} needs a server & directory (or a master which exports one).')
+        profile = NfsProfile(self.cluster, cfg.get('profile') or server_nfs.get('profile'))
+        # x-tiny-cluster is ignored by mount; it marks the fstab line as ours.
+        options = NfsProfile.merge(profile.mount, cfg.get('options')) + ['_netdev', 'x-tiny-cluster']
+        return {'source': f'{server}:{directory}', 'at': cfg.get('at') or directory, 'options': options}
 
-        self.kiosk.configure()
+    # Mount the NFS export (see _get_nfs_mount) now & on every boot, or stop mounting it.
+    @traced('step')
+    def configure_nfs_mount(self):
+        mount = self._get_nfs_mount()
+        facts = self._get_facts()
+        ours = [l for l in facts['nfs_mounts'] if 'x-tiny-cluster ' in l]
+        batch = self._batch('nfs_mount')
+        if not mount:
+            if not ours: return
+            self.log.info('removing nfs mount...')
+            for line in ours: batch.exec(f'sudo umount -l {line.split()[1]} || true')
+            batch.exec("sudo sed -i '/ nfs .*x-tiny-cluster /d' /etc/fstab")
+            batch.run()
+            return
+        line = f'{mount["source"]} {mount["at"]} nfs {",".join(mount["options"])} 0 0'
+        configured = ours == [line] and mount['at'] in facts['nfs_mounted']
+        if self._satisfied(configured, 'nfs mount'): return
+        self.log.info(f'mounting {mount["source"]} at {mount["at"]}...')
+        batch.exec("sudo sed -i '/ nfs .*x-tiny-cluster /d' /etc/fstab")
+        batch.exec(f'echo "{line}" | sudo tee -a /etc/fstab > /dev/null')
+        batch.exec(f'sudo mkdir -p {mount["at"]}')
+        # Remount, so that changed options take effect.
+        batch.exec(f'(sudo umount {mount["at"]} 2>/dev/null || true) && sudo mount {mount["at"]}')
+        batch.run()
 
-        self.configure_nfs()
-        if not self._is_master(): self.join()
-        self.label()
+    # Size the kubelet's reservations, eviction thresholds, max pods & image GC to this node (see KubeletTuning).
+    @traced('step')
+    def configure_kubelet(self):
+        facts = self._get_facts()
+        contents = self.kubelet.get_file()
+        if self._satisfied((facts['kubelet_args'] or '').strip() == contents.strip(), 'kubelet tuning'): return
+        hw = self.kubelet.get_hardware()
+        self.log.info(f'tuning kubelet for {hw["model"] or "unknown model"} ({hw["memory_mb"]} MB, {hw["cpus"]} CPUs, '
+            f'{hw["storage"]} storage): {" ".join(self.kubelet.get_args())}')
+        batch = self._batch('kubelet')
+        batch.write(KubeletTuning.fp, contents, sudo=True)
+        # A running kubelet is restarted (checked on the node, as it may have joined since facts were gathered).
+        # It refuses to start if its CPU manager policy differs from the one in its saved state.
+        batch.exec('if [ -f /etc/kubernetes/kubelet.conf ]; then '
+            'sudo rm -f /var/lib/kubelet/cpu_manager_state && sudo systemctl restart kubelet; fi')
+        batch.run()
+        self._facts['kubelet_args'] = contents
+
+    # Install the storage profile (see StorageProfile), and remove whatever a previous profile installed but this one
+    # does not. Relocated container data is left where it is when `data_root` is unset.
+    @traced('step')
+    def configure_storage(self):
+        facts = self._get_facts()
+        files = self.storage.get_files()
+        checksums = {fp: hashlib.sha256(c.encode('utf-8')).hexdigest() for fp, c in files.items()}
+        binds = self.storage.get_binds()
+        configured = facts['storage_files'] == checksums and set(binds) <= set(facts['storage_binds'])
+        if self._satisfied(configured, 'storage profile'): return
+        self._changed = True
+        self.storage.save_baseline()
+        self.log.info(f'applying storage profile {self.storage.name or "(none)"}...')
+        unit = lambda fp: os.path.basename(fp) if fp.startswith('/etc/systemd/system/') else None
+        batch = self._batch('storage')
+        for fp in [fp for fp in facts['storage_files'] if not fp in files]:
+            if unit(fp): batch.exec(f'sudo systemctl disable --now {unit(fp)} || true')
+            batch.exec(f'sudo rm -f {fp}')
+        for fp, content in files.items():
+            if fp == StorageProfile.fp_journald: batch.exec(f'sudo mkdir -p {os.path.dirname(fp)}')
+            batch.write(fp, content, sudo=True)
+            if fp.startswith('/usr/'): batch.exec(f'sudo chmod +x {fp}')
+        batch.exec('sudo systemctl daemon-reload')
+        for name in self.storage.get_units():
+            # Restarting the zram unit applies new parameters; /var/log is only remounted, to keep its contents.
+            verb = 'restart' if name == 'zram.service' else 'start'
+            batch.exec(f'sudo systemctl enable tiny-cluster-storage-{name} && '
+                f'sudo systemctl {verb} tiny-cluster-storage-{name}')
+        if self.storage.cfg.get('log'):
+            batch.exec(f'sudo mount -o remount,size={self.storage.cfg["log"]["size"]} /var/log')
+        # Loggers reopen their files (i.e., in RAM) & journald reads its limits.
+        batch.exec('sudo systemctl restart systemd-journald && (sudo systemctl restart rsyslog 2>/dev/null || true)')
+        batch.run()
+        if binds and not set(binds) <= set(facts['storage_binds']):
+            self._sync_rp_files('relocate-data.sh')
+            self.exec(f'sudo bash ./relocate-data.sh {self.storage.cfg["data_root"]}')
+        self._facts.pop('storage_files', None)
+        self._facts.pop('storage_binds', None)
+
+    # The kiosk watchdog's samples (JS heap, page load, frames) & browser restarts (see Kiosk.print_stats).
+    @traced()
+    def kiosk_stats(self):
+        if not self.kiosk.cfg: raise Exception('the kiosk is not enabled on this node.')
+        self.kiosk.print_stats()
+
+    # How much each disk is written to (MB/hour), before the storage profile was first applied vs. now.
+    @traced()
+    def io_report(self):
+        self.storage.print_report()
+
+    # Point apt at the fleet's package cache (see `apt_cache` in defaults.yaml), or stop doing so.
+    # apt falls back to direct downloads whenever the cache is unreachable.
+    @traced('step')
+    def _configure_apt_proxy(self):
+        url = self.cluster.get_apt_cache_url()
+        current = self._get_facts()['apt_proxy_files']
+        if not url:
+            if not current: return
+            self.log.info('removing apt cache proxy...')
+            self.exec(f'sudo rm -f {self._fp_apt_proxy} {self._fp_apt_proxy_detect}')
+            self._facts.pop('apt_proxy_files', None)
+            return
+        files = self._get_apt_proxy_files(url)
+        checksums = {fp: hashlib.sha256(c.encode('utf-8')).hexdigest() for fp, c in files.items()}
+        # The detection script holds the cache's address, so a new host or port rewrites it too.
+        if self._satisfied(current == checksums, 'apt cache proxy'): return
+        self.log.info(f'using apt cache proxy at {url}...')
+        batch = self._batch('apt_proxy')
+        batch.write(self._fp_apt_proxy_detect, files[self._fp_apt_proxy_detect], sudo=True)
+        batch.exec(f'sudo chmod +x {self._fp_apt_proxy_detect}')
+        batch.write(self._fp_apt_proxy, files[self._fp_apt_proxy], sudo=True)
+        batch.run()
+        self._facts.pop('apt_proxy_files', None)
+
+    # The apt configuration & detection script which use the cache at url (when it is reachable).
+    def _get_apt_proxy_files(self, url):
+        host, port = url.split('//')[1].split(':')
+        detect = f'''#!/bin/bash
+# Generated by tiny-cluster: use the fleet's apt cache when it is reachable.
+if timeout 1 bash -c "</dev/tcp/{host}/{port}" 2>/dev/null; then echo "{url}"; else echo DIRECT; fi
+'''
+        return {
+            self._fp_apt_proxy_detect: detect,
+            self._fp_apt_proxy: f'Acquire::http::Proxy-Auto-Detect "{self._fp_apt_proxy_detect}";\n',
+        }
 
     # Set hostname & IP
+    @traced('step')
     def _setup_network(self):
+        facts = self._get_facts()
+        static_ips = [ip.split('/')[0] for ip in facts['static_ips']]
+        configured = facts['hostname'] == self.name and self.cfg['address'] in static_ips
+        if self._satisfied(configured, 'hostname & static IP'): return
+        self._changed = True
         self.log.info('setting up network interface...')
-        self._upload_rp_file('setup-network.sh')
+        self._sync_rp_files('setup-network.sh')
         args = f'"{self.name}" "{self.cfg["address"]}" "{self.cfg["dns"]}" "{self.cfg["interface"]}"'
         self.exec(f'bash ./setup-network.sh {args}')
+        FactCache(self).clear(['network'])
+        self._facts.pop('network', None)
 
     # EVERYTHING (setup node from scratch)
+    @traced()
     def create(self):
         self.ssh_copy_id()
 
+        self._configure_apt_proxy()
         if self._is_master():
             self.log.info('master node; skipping network & kubeadm setup.')
         else:
@@ -98,27 +275,159 @@ class Node(Instance):
 
         self.configure()
         self.update()
-        self.reboot()
+        self._reboot_if_changed()
+
+    # Reboot, unless no step changed anything.
+    def _reboot_if_changed(self):
+        if self._changed or self.cluster.force:
+            self.reboot()
+        else:
+            self.log.info('node was already converged; not rebooting.')
+
+    # Add the steps of `create` (except ssh_copy_id & the reboot) to a Scheduler, returning their names.
+    # Package installs on one node share the dpkg lock, so they form a chain; the rest only waits for facts.
+    # Nothing waits on the master except join & label, which need the `ready` step (see Master._add_create_steps).
+    def _add_create_steps(self, scheduler, ready):
+        n = self.name
+        step = lambda name, fn, deps = []: scheduler.add(f'{n}:{name}', fn, [f'{n}:facts'] + deps)
+        steps = [scheduler.add(f'{n}:facts', self._get_facts)]
+        steps.append(step('apt_proxy', self._configure_apt_proxy))
+        if self._is_master():
+            kubeadm = 'master:kubeadm'
+        else:
+            steps.append(step('network', self._setup_network))
+            kubeadm = step('kubeadm', self._setup_kubeadm, [f'{n}:apt_proxy'])
+            steps.append(kubeadm)
+        steps.append(step('kiosk', self.kiosk.setup, [kubeadm]))
+        steps.append(step('update', self.update, [f'{n}:kiosk']))
+        steps.append(step('files', self._configure_files))
+        steps.append(step('nfs', self.configure_nfs, [kubeadm]))
+        steps.append(step('nfs_mount', self.configure_nfs_mount, [kubeadm, 'master:nfs']))
+        steps.append(step('storage', self.configure_storage, [kubeadm])) # Relocating data needs docker.
+        if self._is_master():
+            steps.append(step('kubelet', self.configure_kubelet, [ready, f'{n}:storage'])) # After kubeadm init.
+            steps.append(step('label', self.label, [ready, f'{n}:update']))
+        else:
+            steps.append(step('kubelet', self.configure_kubelet, [kubeadm, f'{n}:storage']))
+            steps.append(step('join', self.join, [ready, f'{n}:update', f'{n}:kubelet']))
+            steps.append(step('label', self.label, [f'{n}:join']))
+        return steps
+
+    # Where this node's first-boot bundle is written. It holds a join token, so it is kept out of the repository.
+    def _get_bundle_path(self):
+        return f'{self.cluster.cwd}/.cache/{self.cluster.context}/bundles/{self.name}.tar.gz'
+
+    # Render everything this node needs into a first-boot archive (see Bundle).
+    @traced()
+    def bundle(self):
+        data = Bundle(self).build()
+        fp = self._get_bundle_path()
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        fd = os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f: f.write(data)
+        self.log.info(f'''wrote {fp} ({len(data)} bytes).
+To provision a freshly flashed SD card, extract it onto the boot partition:
+    tar -xzf {fp} -C /path/to/boot
+and append this to the single line in the boot partition's cmdline.txt:
+    {Bundle.cmdline()}
+(On images which mount the boot partition at /boot/firmware, such as Bookworm's, append this instead:
+    {Bundle.cmdline('/boot/firmware')})
+Or, to provision a device which is already reachable over SSH: tc {self.name} install-bundle''')
+        return fp
+
+    # Push the bundle in one transfer and run it on the device (in the background; the device reboots when done).
+    # Both steps go through `bash -s`, so that the boot partition is found on the device (not by the local shell).
+    @traced()
+    def install_bundle(self):
+        fp = self.bundle()
+        with open(fp, 'rb') as f: data = f.read()
+        self.log.info('installing bundle; progress is logged to /var/log/tiny-cluster-provision.log on the device.')
+        tmp = f'/tmp/{Bundle._dir}-bundle.tar.gz'
+        batch = Batch(self, 'install_bundle')
+        batch.write(tmp, data, desc=f'upload {os.path.basename(fp)} to {tmp}')
+        batch.exec('B=/boot; if [ -d /boot/firmware ]; then B=/boot/firmware; fi; '
+            f'sudo tar -xzf {tmp} -C $B --no-same-owner && rm -f {tmp} && '
+            f'sudo systemd-run --unit=tiny-cluster-provision --collect bash $B/{Bundle._dir}/provision.sh --reboot',
+            'extract the bundle onto the boot partition & start provisioning')
+        with self.cluster.tracer.span('bundle', 'transfer', self.name) as span:
+            span['bytes_sent'] = len(data)
+            batch.run()
+        self._changed = True
 
     # Is this node also the master?
     def _is_master(self):
         return self.user_address == self.cluster.master.user_address
 
+    # The node's labels according to the Kubernetes master (or None if it is not registered).
+    def _get_cluster_labels(self, refresh = False):
+        if refresh or self._cluster_labels == None:
+            r = self.cluster.master.exec(f'kubectl get node {self.name} -o json', check=False, capture_output=True,
+                idempotent=True)
+            if r.returncode != 0: return None
+            self._cluster_labels = json.loads(r.stdout)['metadata'].get('labels', {})
+        return self._cluster_labels
+
     # (Re)join the Kubernetes cluster
+    # A kubelet which already trusts this master's CA is left alone (kubelet re-registers a deleted node on restart).
+    @traced()
     def join(self):
         if not self.cluster.master:
             self.log.error('Nothing to join: there is no master Kubernetes node.')
             return
-        self.log.info('leaving cluster...')
-        self.exec('sudo kubeadm reset -f || true')
+        joins = self.cluster.master._joins
+        self.configure_kubelet() # Before joining, so the kubelet starts with it.
+        facts = self._get_facts()
+        if self._satisfied(facts['kubelet_joined'] and facts['ca_hash'] == joins.ca_hash(), 'cluster membership'):
+            if self._get_cluster_labels() == None:
+                self.log.info('not registered with the master; restarting kubelet...')
+                self.exec('sudo systemctl restart kubelet')
+            return
+        self._changed = True
+        if facts['kubelet_joined'] or self.cluster.force:
+            self.log.info('leaving cluster...')
+            self.exec('sudo kubeadm reset -f || true')
 
         self.log.info('joining cluster...')
-        cmd = self.cluster.master._get_join_command()
-        if len(cmd) <= 0: raise Exception('failed to retrieve kubeadm join command')
-        self.exec(f'sudo {cmd}')
+        # kubeadm refuses to join with swap enabled, unless told that the kubelet tolerates it (see StorageProfile).
+        flags = ' --ignore-preflight-errors=Swap' if self.storage.cfg.get('zram') else ''
+        r = self.exec(f'sudo {self.cluster.master._get_join_command()}{flags}', check=False, capture_output=True)
+        if r.returncode != 0:
+            # The cached token may have been deleted on the master; retry once with a new one.
+            self.log.warning('join failed; retrying with a new token...')
+            joins.invalidate()
+            self.exec('sudo kubeadm reset -f || true')
+            self.exec(f'sudo {self.cluster.master._get_join_command()}{flags}')
+        self._cluster_labels = None
+        self._facts.pop('ca_hash', None)
+
+    # Evict workloads and mark the node unschedulable.
+    @traced('step')
+    def _drain(self, timeout):
+        self.log.info('draining...')
+        self.cluster.master.exec(f'kubectl drain {self.name} --ignore-daemonsets --delete-emptydir-data '
+            f'--force --timeout={timeout}s', capture_output=True)
+
+    # Mark the node schedulable again.
+    @traced('step')
+    def _uncordon(self):
+        self.log.info('uncordoning...')
+        self.cluster.master.exec(f'kubectl uncordon {self.name}', capture_output=True, idempotent=True)
+
+    # Block until the master reports that this node's kubelet is Ready.
+    @traced('step')
+    def _wait_until_ready(self, timeout):
+        self.log.info('waiting for kubelet to report Ready...')
+        jp = '{.status.conditions[?(@.type==\'Ready\')].status}'
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            r = self.cluster.master.exec(f"kubectl get node {self.name} -o jsonpath=\"{jp}\"",
+                check=False, capture_output=True)
+            if r.returncode == 0 and r.stdout.strip() == 'True': return
+            time.sleep(5)
+        raise Exception(f'kubelet not Ready within {timeout}s')
 
-    # Add Kubernetes labels to the node.
+    # Make the node's Kubernetes labels & taints match its configuration (see Master.reconcile_labels).
+    @traced()
     def label(self):
-        for label in self.cfg['labels']:
-            self.log.info(f'applying label "{label}"...')
-            self.cluster.master.exec(f'kubectl label nodes {self.name} {label} --overwrite')
+        self.cluster.master._reconcile_labels([self])
+        self._cluster_labels = None
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import logging, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+"""
+Run steps as a dependency graph: each step starts as soon as all of the steps it depends on have succeeded,
+with up to `parallel` steps running at once. When a step fails, everything which depends on it is skipped.
+"""
+class Scheduler():
+    def __init__(self, parallel = 8):
+        self.parallel = max(1, int(parallel))
+        self.log = logging.getLogger('scheduler')
+        self.steps = {} # name => (fn, [dependency names])
+        self.results = {} # name => {'status', 'seconds', 'error'}
+
+    # Add a step. fn is called with no arguments.
+    def add(self, name, fn, deps = []):
+        if name in self.steps: raise Exception(f'duplicate step: {name}')
+        self.steps[name] = (fn, [d for d in deps if d])
+        return name
+
+    # Raise if any dependency is unknown or the graph has a cycle.
+    def _validate(self):
+        for name in self.steps:
+            for dep in self.steps[name][1]:
+                if not dep in self.steps: raise Exception(f'step {name} depends on unknown step {dep}')
+        visiting, done = set(), set()
+        def visit(name, path):
+            if name in done: return
+            if name in visiting: raise Exception(f'dependency cycle: {" -> ".join(path + [name])}')
+            visiting.add(name)
+            for dep in self.steps[name][1]: visit(dep, path + [name])
+            visiting.remove(name)
+            done.add(name)
+        for name in self.steps: visit(name, [])
+
+    def _run_step(self, name):
+        start = time.time()
+        res = {'status': 'ok', 'error': None}
+        try:
+            self.steps[name][0]()
+        except Exception as e:
+            res['status'] = 'FAILED'
+            lines = [l for l in str(e).strip().split('\n') if l]
+            res['error'] = lines[-1] if lines else type(e).__name__
+            self.log.error(f'{name} failed: {e}')
+        res['seconds'] = time.time() - start
+        return res
+
+    # Run every step; returns True if all of them succeeded.
+    def run(self):
+        self._validate()
+        start = time.time()
+        pending = dict(self.steps)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            while pending or running:
+                waiting = len(pending)
+                for name in list(pending):
+                    deps = pending[name][1]
+                    if [d for d in deps if d in self.results and self.results[d]['status'] != 'ok']:
+                        self.results[name] = {'status': 'skipped', 'error': 'a dependency failed', 'seconds': 0}
+                        del pending[name]
+                    elif len([d for d in deps if not d in self.results]) <= 0:
+                        self.log.debug(f'starting {name}')
+                        running[pool.submit(self._run_step, name)] = name
+                        del pending[name]
+                if not running:
+                    # Skipping a step may unblock (i.e., skip) steps checked before it; otherwise nothing can start.
+                    if len(pending) < waiting: continue
+                    raise Exception(f'no step can start: {", ".join(pending)}')
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self.results[running.pop(future)] = future.result()
+        self.print_summary(time.time() - start)
+        return len([r for r in self.results.values() if r['status'] != 'ok']) <= 0
+
+    # Tabular status & wall time per step.
+    def print_summary(self, seconds):
+        rows = [('STEP', 'STATUS', 'TIME', 'ERROR')]
+        for name in self.steps:
+            r = self.results[name]
+            rows.append((name, r['status'], f'{r["seconds"]:.1f}s', r['error'] or ''))
+        widths = [max([len(row[c]) for row in rows]) for c in range(len(rows[0]) - 1)]
+        print('\nsummary:')
+        for row in rows:
+            cols = [row[c].ljust(widths[c]) for c in range(len(widths))]
+            print('  '.join(cols + [row[-1]]).rstrip())
+        print(f'finished in {seconds:.1f}s')
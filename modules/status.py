@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import os, json, time, logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+"""
+Fleet telemetry: sample every node concurrently (one remote command each) and render a table or JSON.
+The previous samples are cached on disk, so each snapshot shows deltas (and CPU usage) since the last one.
+"""
+class Status():
+    # Each line of output is key=value.
+    _script = '''echo "temp=$(cat /sys/class/thermal/thermal_zone0/temp)"
+echo "throttled=$(vcgencmd get_throttled | cut -d= -f2)"
+echo "load=$(cut -d' ' -f1-3 /proc/loadavg)"
+echo "cpus=$(nproc)"
+echo "cpu=$(head -n1 /proc/stat | cut -d' ' -f2-)"
+echo "mem=$(awk '/^MemTotal/ { t = $2 } /^MemAvailable/ { a = $2 } END { print t, a }' /proc/meminfo)"
+echo "disk=$(df -Pk / | awk 'NR == 2 { print $2, $4 }')"
+echo "uptime=$(cut -d' ' -f1 /proc/uptime)"
+echo "kubelet=$(systemctl is-active kubelet)"
+echo "docker=$(systemctl is-active docker)"
+echo "chromium=$(pgrep -c chromium)"
+'''
+    # Bits of `vcgencmd get_throttled`: the low bits are current, the same bits << 16 have occurred since boot.
+    _throttle_flags = {0: 'UNDERVOLT', 1: 'CAPPED', 2: 'THROTTLED', 3: 'SOFTTEMP'}
+
+    def __init__(self, cluster, nodes, parallel = 8):
+        self.cluster = cluster
+        self.nodes = nodes
+        self.parallel = max(1, int(parallel))
+        self.log = logging.getLogger('status')
+        self.fp = os.path.join(cluster.cwd, '.cache', cluster.context, 'status.json')
+        self.previous = self._load()
+        self.samples = {}
+
+    def _load(self):
+        if not os.path.isfile(self.fp): return {}
+        with open(self.fp, 'r') as f: return json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+        with open(f'{self.fp}.tmp', 'w') as f: json.dump(dict(self.previous, **self.samples), f)
+        os.replace(f'{self.fp}.tmp', self.fp)
+
+    @staticmethod
+    def _numbers(raw):
+        try:
+            return [float(x) for x in raw.split()]
+        except ValueError:
+            return []
+
+    # Parse the script's output into a sample (None for anything which could not be read).
+    def _parse(self, node, raw, prev):
+        vals = dict([line.split('=', 1) for line in raw.strip().split('\n') if '=' in line])
+        s = {'at': time.time(), 'address': node.address}
+        temp = self._numbers(vals.get('temp', ''))
+        s['temp_c'] = round(temp[0] / 1000, 1) if temp else None
+        try:
+            throttled = int(vals.get('throttled', ''), 16)
+        except ValueError:
+            throttled = None
+        s['throttled'] = throttled
+        s['throttle_now'] = [f for b, f in self._throttle_flags.items() if throttled and throttled & (1 << b)]
+        s['throttle_since_boot'] = [f for b, f in self._throttle_flags.items()
+            if throttled and throttled & (1 << (b + 16))]
+        load = self._numbers(vals.get('load', ''))
+        s['load'] = load if len(load) == 3 else None
+        cpus = self._numbers(vals.get('cpus', ''))
+        s['cpus'] = int(cpus[0]) if cpus else None
+        s['cpu_jiffies'] = self._numbers(vals.get('cpu', ''))
+        s['cpu_pct'] = None
+        if prev and prev.get('cpu_jiffies') and len(prev['cpu_jiffies']) == len(s['cpu_jiffies']) > 4:
+            # Columns are user, nice, system, idle, iowait, ...: busy = total - idle - iowait.
+            delta = [a - b for a, b in zip(s['cpu_jiffies'], prev['cpu_jiffies'])]
+            if sum(delta) > 0: s['cpu_pct'] = round(100 * (1 - (delta[3] + delta[4]) / sum(delta)), 1)
+        mem = self._numbers(vals.get('mem', ''))
+        s['mem_total_mb'] = round(mem[0] / 1024) if len(mem) == 2 else None
+        s['mem_used_pct'] = round(100 * (1 - mem[1] / mem[0]), 1) if len(mem) == 2 and mem[0] else None
+        disk = self._numbers(vals.get('disk', ''))
+        s['disk_free_gb'] = round(disk[1] / 1048576, 1) if len(disk) == 2 else None
+        s['disk_used_pct'] = round(100 * (1 - disk[1] / disk[0]), 1) if len(disk) == 2 and disk[0] else None
+        uptime = self._numbers(vals.get('uptime', ''))
+        s['uptime_s'] = int(uptime[0]) if uptime else None
+        s['kubelet'] = vals.get('kubelet') or None
+        s['docker'] = vals.get('docker') or None
+        chromium = self._numbers(vals.get('chromium', ''))
+        s['kiosk'] = None if not node.kiosk.cfg else ('up' if chromium and chromium[0] > 0 else 'down')
+        return s
+
+    # Sample one node (never raises).
+    def _sample(self, node):
+        try:
+            with self.cluster.tracer.span('status', 'node', node.name):
+                r = node.exec('bash -s', check=False, capture_output=True, input='exec 2>/dev/null\n' + self._script)
+            if r.returncode != 0 and not r.stdout: raise Exception(r.stderr.strip() or f'exit {r.returncode}')
+            return self._parse(node, r.stdout, self.samples.get(node.name) or self.previous.get(node.name))
+        except Exception as e:
+            lines = [l for l in str(e).strip().split('\n') if l]
+            return {'at': time.time(), 'address': node.address, 'error': lines[-1] if lines else type(e).__name__}
+
+    # Sample every node concurrently, calling on_sample(name) as each arrives.
+    def collect(self, on_sample = None):
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            futures = {pool.submit(self._sample, node): node.name for node in self.nodes}
+            for future in as_completed(futures):
+                name = futures[future]
+                if name in self.samples: self.previous[name] = self.samples[name]
+                self.samples[name] = future.result()
+                if on_sample: on_sample(name)
+        self._save()
+        return self.samples
+
+    # A value, with its change since the previous sample.
+    @staticmethod
+    def _delta(value, prev, fmt, unit = ''):
+        if value == None: return '?'
+        text = f'{value:{fmt}}{unit}'
+        if prev != None and value != prev: text += f' ({value - prev:+{fmt}})'
+        return text
+
+    @staticmethod
+    def _duration(seconds):
+        if seconds == None: return '?'
+        if seconds >= 86400: return f'{seconds // 86400}d{(seconds % 86400) // 3600}h'
+        return f'{seconds // 3600}h{(seconds % 3600) // 60}m'
+
+    # One table row for a node.
+    def _row(self, name):
+        s = self.samples.get(name) or self.previous.get(name)
+        if not s: return (name, '...')
+        if 'error' in s: return (name, f'UNREACHABLE: {s["error"]}')
+        p = self.previous.get(name) if name in self.samples else None
+        p = p if p and not 'error' in p else {}
+        throttle = ",".join(s['throttle_now']) or ('ok' if s['throttled'] != None else '?')
+        if s['throttle_since_boot'] and not s['throttle_now']:
+            throttle = 'was ' + ",".join(s['throttle_since_boot']).lower()
+        load = s['load'][0] if s['load'] else None
+        return (
+            name,
+            self._delta(s['temp_c'], p.get('temp_c'), '.1f', 'C'),
+            throttle,
+            self._delta(load, (p.get('load') or [None])[0], '.2f') + (f'/{s["cpus"]}' if s['cpus'] else ''),
+            '?' if s['cpu_pct'] == None else f'{s["cpu_pct"]:.0f}%',
+            self._delta(s['mem_used_pct'], p.get('mem_used_pct'), '.0f', '%'),
+            self._delta(s['disk_free_gb'], p.get('disk_free_gb'), '.1f', 'G'),
+            self._duration(s['uptime_s']),
+            s['kubelet'] or '?',
+            s['docker'] or '?',
+            s['kiosk'] or '-',
+        )
+
+    # The table of every node's most recent sample.
+    def render(self):
+        rows = [('NODE', 'TEMP', 'THROTTLING', 'LOAD', 'CPU', 'MEM', 'DISK FREE', 'UP', 'KUBELET', 'DOCKER', 'KIOSK')]
+        rows += [self._row(node.name) for node in self.nodes]
+        widths = [max([len(row[c]) for row in rows if len(row) > c + 1] + [0]) for c in range(len(rows[0]) - 1)]
+        lines = []
+        for row in rows:
+            cols = [row[c].ljust(widths[c]) for c in range(len(row) - 1)]
+            lines.append('  '.join(cols + [row[-1]]).rstrip())
+        return "\n".join(lines)
+
+    # Every node's most recent sample, as JSON (e.g., for a Home Assistant command_line sensor).
+    def to_json(self):
+        return json.dumps({n.name: {k: v for k, v in (self.samples.get(n.name) or {}).items() if k != 'cpu_jiffies'}
+            for n in self.nodes})
+
+    # Print one snapshot, or (with an interval) keep refreshing until interrupted.
+    def run(self, as_json = False, interval = None):
+        while True:
+            if as_json:
+                self.collect()
+                print(self.to_json(), flush=True)
+            else:
+                redraw = lambda name = None: print('\033[H\033[J' + self.render(), flush=True)
+                if interval: redraw()
+                self.collect(redraw if interval else None)
+                if not interval: print(self.render())
+            if not interval: return
+            time.sleep(interval)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import os, re, copy, time, yaml
+from deepmerge import always_merger
+
+"""
+A node's storage profile (see `storage` in defaults.yaml), which cuts the writes that stall and wear out SD cards:
+swap compressed in RAM (zram), /var/log in RAM (flushed to the card on a timer & at shutdown), journald limits, and
+optionally the container runtimes' data moved to attached storage. Rendered as files & units which
+Node.configure_storage installs, all named tiny-cluster-storage-* so that they can be found (and removed) again.
+"""
+class StorageProfile():
+    _bin = '/usr/local/sbin/tiny-cluster-storage'
+    _unit = '/etc/systemd/system/tiny-cluster-storage'
+    fp_journald = '/etc/systemd/journald.conf.d/tiny-cluster-storage.conf'
+    bind_tag = 'x-tiny-cluster-storage' # Marks the fstab lines of relocated data (ignored by mount).
+
+    def __init__(self, node):
+        self.node = node
+        cfg = node.cfg.get('storage')
+        if cfg and type(cfg) != dict: cfg = {'profile': cfg}
+        cfg = cfg or {}
+        profiles = (node.cluster.config.get('storage') or {}).get('profiles') or {}
+        self.name = cfg.get('profile')
+        if self.name and not self.name in profiles:
+            raise Exception(f'unknown storage profile "{self.name}" (expected one of: {", ".join(profiles)})')
+        base = copy.deepcopy(profiles[self.name]) if self.name else {}
+        self.cfg = always_merger.merge(base, {k: copy.deepcopy(v) for k, v in cfg.items() if k != 'profile'})
+
+    def _get_unit(self, description, exec_start, exec_stop = None, extra = '', install = 'multi-user.target'):
+        stop = f'ExecStop={exec_stop}\n' if exec_stop else ''
+        return f'''[Unit]
+Description={description} (tiny-cluster)
+{extra}[Service]
+Type=oneshot
+RemainAfterExit=yes
+ExecStart={exec_start}
+{stop}[Install]
+WantedBy={install}
+'''
+
+    # The units to enable (& start), in order: the last part of each unit's name.
+    def get_units(self):
+        units = []
+        if self.cfg.get('zram'): units.append('zram.service')
+        if self.cfg.get('log'): units += ['log.service', 'flush.timer']
+        return units
+
+    # {path: contents} of every file the profile installs.
+    def get_files(self):
+        files = {}
+        zram = self.cfg.get('zram')
+        if zram:
+            files[f'{self._bin}-zram'] = self.node._read_rp_file('zram.sh')
+            args = f'{zram["percent"]} {zram["algorithm"]} {zram["priority"]} {zram["swappiness"]}'
+            files[f'{self._unit}-zram.service'] = self._get_unit('Compressed swap in RAM',
+                f'{self._bin}-zram start {args}', f'{self._bin}-zram stop', 'After=local-fs.target\n')
+        log = self.cfg.get('log')
+        if log:
+            files[f'{self._bin}-log'] = self.node._read_rp_file('log2ram.sh')
+            # Mounted before anything logs, and unmounted (i.e., flushed) after everything has stopped.
+            extra = 'DefaultDependencies=no\nAfter=local-fs.target\nRequiresMountsFor=/var/log\n' \
+                'Before=sysinit.target systemd-journald.service rsyslog.service syslog.target shutdown.target\n' \
+                'Conflicts=shutdown.target\n'
+            files[f'{self._unit}-log.service'] = self._get_unit('/var/log in RAM',
+                f'{self._bin}-log start {log["size"]}', f'{self._bin}-log stop', extra, 'sysinit.target')
+            files[f'{self._unit}-flush.service'] = \
+                f'[Unit]\nDescription=Flush /var/log to disk (tiny-cluster)\n[Service]\nType=oneshot\n' \
+                f'ExecStart={self._bin}-log flush\n'
+            minutes = log['flush_minutes']
+            files[f'{self._unit}-flush.timer'] = f'[Unit]\nDescription=Flush /var/log to disk (tiny-cluster)\n' \
+                f'[Timer]\nOnBootSec={minutes}min\nOnUnitActiveSec={minutes}min\n[Install]\nWantedBy=timers.target\n'
+        journald = self.cfg.get('journald')
+        if journald:
+            files[self.fp_journald] = "[Journal]\n" + "".join([f'{k}={v}\n' for k, v in journald.items()])
+        return files
+
+    # The /etc/fstab lines which bind the container runtimes' data to `data_root` (if set).
+    def get_binds(self):
+        root = self.cfg.get('data_root')
+        if not root: return []
+        return [f'{root}/{d} /var/lib/{d} none bind,{self.bind_tag} 0 0' for d in ['docker', 'containerd']]
+
+    # Where the write rates measured before the profile was first applied are kept.
+    def _get_baseline_path(self):
+        cluster = self.node.cluster
+        return os.path.join(cluster.cwd, '.cache', cluster.context, 'io', f'{self.node.address}.yaml')
+
+    # Megabytes written to each whole disk since boot, from /proc/diskstats (sectors are 512 bytes):
+    # {'at', 'uptime' (seconds), 'written_mb': {disk: MB}}, or None if the output could not be parsed.
+    def sample(self):
+        r = self.node.exec('cat /proc/uptime /proc/diskstats', capture_output=True, idempotent=True)
+        lines = r.stdout.strip().split('\n')
+        if len(lines) < 2 or not re.match('^[0-9.]+ ', lines[0]): return None
+        written = {}
+        for line in lines[1:]:
+            cols = line.split()
+            if len(cols) >= 10 and re.match('^(mmcblk[0-9]+|sd[a-z]+|nvme[0-9]+n[0-9]+)$', cols[2]):
+                written[cols[2]] = round(int(cols[9]) * 512 / 1024 / 1024, 1)
+        return {'at': time.time(), 'uptime': float(lines[0].split()[0]), 'written_mb': written}
+
+    # Record the current write rates as the baseline, unless one was already recorded.
+    def save_baseline(self):
+        fp = self._get_baseline_path()
+        if os.path.isfile(fp): return
+        try:
+            sample = self.sample()
+        except Exception as e:
+            self.node.log.warning(f'could not measure disk writes before applying the storage profile: {e}')
+            return
+        if not sample: return
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with open(fp, 'w') as f: yaml.safe_dump(sample, f, default_flow_style=False)
+
+    def load_baseline(self):
+        fp = self._get_baseline_path()
+        if not os.path.isfile(fp): return None
+        with open(fp, 'r') as f: return yaml.safe_load(f)
+
+    # Print the write rate (MB/hour, averaged since boot) of each disk: before the profile, and now.
+    def print_report(self):
+        now = self.sample()
+        if not now: raise Exception('could not read /proc/diskstats.')
+        before = self.load_baseline()
+        rate = lambda s, disk: s['written_mb'][disk] / max(s['uptime'] / 3600, 1 / 60)
+        rows = [('DISK', 'BEFORE MB/h', 'NOW MB/h', 'CHANGE')]
+        for disk in sorted(now['written_mb']):
+            r_now = rate(now, disk)
+            if before and disk in before['written_mb']:
+                r_before = rate(before, disk)
+                change = f'{(r_now - r_before) / r_before * 100:+.0f}%' if r_before > 0 else '-'
+                rows.append((disk, f'{r_before:.1f}', f'{r_now:.1f}', change))
+            else:
+                rows.append((disk, '-', f'{r_now:.1f}', '-'))
+        widths = [max([len(row[c]) for row in rows]) for c in range(len(rows[0]))]
+        for row in rows: print('  '.join([row[c].ljust(widths[c]) for c in range(len(row))]).rstrip())
+        print(f'(averaged over {now["uptime"] / 3600:.1f}h since boot' +
+            (f'; baseline over {before["uptime"] / 3600:.1f}h)' if before else '; no baseline was recorded)'))
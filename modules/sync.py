@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import io, time, base64, hashlib, tarfile
+from modules.facts import *
+
+"""
+Content-addressed file sync: compare local content against remote checksums (fetched in one call),
+then transfer only the files which differ, together in a single archive stream.
+Paths are relative to the instance's home directory; content is final (templates are rendered locally).
+"""
+class Sync():
+    def __init__(self, instance, files, executable = []):
+        self.instance = instance
+        self.log = instance.log
+        self.files = {fp: (c.encode('utf-8') if type(c) == str else c) for fp, c in files.items()}
+        self.executable = executable
+
+    # Remote checksums of every file, in one round trip.
+    def _fetch_checksums(self):
+        r = self.instance.exec(f'cd ~ && sha256sum {" ".join(self.files)} 2>/dev/null',
+            check=False, capture_output=True, idempotent=True)
+        return Facts._parse_checksums(r.stdout)
+
+    # Paths whose remote content differs from the local content.
+    def stale(self, checksums = None):
+        if checksums == None: checksums = self._fetch_checksums()
+        return [fp for fp in self.files if checksums.get(fp) != hashlib.sha256(self.files[fp]).hexdigest()]
+
+    # Transfer the given paths in one gzipped tar stream.
+    def push(self, paths):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for fp in paths:
+                info = tarfile.TarInfo(fp)
+                info.size = len(self.files[fp])
+                info.mode = 0o755 if fp in self.executable else 0o644
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(self.files[fp]))
+        data = base64.b64encode(buf.getvalue()).decode('ascii')
+        self.log.debug(f'syncing {len(paths)} file(s) in {len(data)} bytes: {", ".join(paths)}')
+        with self.instance.cluster.tracer.span('sync', 'transfer', self.instance.name) as span:
+            span['files'] = paths
+            span['bytes_sent'] = len(data)
+            self.instance.exec('cd ~ && base64 -d | tar -xzf - --no-same-owner', capture_output=True, input=data,
+                idempotent=True)
+
+    # Push whatever differs (or everything, if forced). Returns the paths which were transferred.
+    def run(self, checksums = None, force = False):
+        paths = list(self.files) if force else self.stale(checksums)
+        if len(paths) > 0: self.push(paths)
+        return paths
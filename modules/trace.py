@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os, json, time, glob, threading, functools, collections
+from contextlib import contextmanager
+
+"""
+Record nested, timed spans (per node, method, step and command) for a run.
+Spans are written in the Chrome trace format (chrome://tracing, Perfetto), with one row per node.
+"""
+class Tracer():
+    _history = 50 # Past runs to keep for `tc report`
+    _max_spans = 100000 # Spans kept in memory; beyond this, the oldest are dropped (e.g., by `status --watch`).
+
+    def __init__(self):
+        self.events = collections.deque(maxlen=self._max_spans)
+        self.start = time.time()
+        self._tids = {}
+        self._lock = threading.Lock()
+
+    # One row (thread ID) per node, so each node's spans nest on their own line.
+    def _tid(self, node):
+        node = node or 'tiny-cluster'
+        with self._lock:
+            if not node in self._tids: self._tids[node] = len(self._tids) + 1
+            return self._tids[node]
+
+    # Time a block. The yielded dict is recorded as the span's args, so callers may add exit codes, bytes, etc.
+    @contextmanager
+    def span(self, name, cat, node = None, **args):
+        start = time.time()
+        try:
+            yield args
+        except Exception as e:
+            args['error'] = str(e).strip().split('\n')[-1][:200]
+            raise
+        finally:
+            self.add(name, cat, node, start, time.time() - start, args)
+
+    # Record a span which has already completed.
+    def add(self, name, cat, node, start, seconds, args = {}):
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': self._tid(node),
+            'ts': int((start - self.start) * 1e6), 'dur': int(seconds * 1e6), 'args': args}
+        with self._lock: self.events.append(event)
+
+    # Write the trace to fp (if given) and to the history directory (pruning old runs).
+    def save(self, fp, dir_history, metadata = {}):
+        with self._lock:
+            events = list(self.events)
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': node}}
+                for node, tid in self._tids.items()]
+        if len(events) <= 0: return
+        trace = {'traceEvents': names + events, 'metadata': dict(metadata, start=self.start)}
+        fps = [fp] if fp else []
+        if dir_history:
+            os.makedirs(dir_history, exist_ok=True)
+            ms = int(self.start * 1000)
+            while os.path.exists(os.path.join(dir_history, f'{ms}.json')): ms += 1 # e.g., quick controller cycles.
+            fps.append(os.path.join(dir_history, f'{ms}.json'))
+        for fp in fps:
+            with open(fp, 'w') as file: json.dump(trace, file)
+        if dir_history:
+            for old in sorted(glob.glob(os.path.join(dir_history, '*.json')))[:-self._history]: os.remove(old)
+
+    # Save the spans so far as one run (for `tc report`), then start afresh: long-running targets (e.g., controller)
+    # save each cycle, rather than holding every span until they exit.
+    def rotate(self, dir_history, metadata = {}):
+        self.save(None, dir_history, metadata)
+        with self._lock:
+            self.events.clear()
+            self.start = time.time()
+
+    # Print the slowest spans (by total time) across the saved runs.
+    @staticmethod
+    def report(dir_history, limit = 25):
+        fps = sorted(glob.glob(os.path.join(dir_history, '*.json')))
+        if len(fps) <= 0:
+            print(f'no traces in {dir_history}')
+            return
+        stats = {}
+        for fp in fps:
+            with open(fp, 'r') as file: events = json.load(file)['traceEvents']
+            for e in events:
+                if e['ph'] != 'X': continue
+                key = (e['cat'], e['name'][:60])
+                s = stats.setdefault(key, {'count': 0, 'total': 0, 'max': 0, 'errors': 0})
+                s['count'] += 1
+                s['total'] += e['dur'] / 1e6
+                s['max'] = max(s['max'], e['dur'] / 1e6)
+                if 'error' in e['args'] or e['args'].get('rc', 0) != 0: s['errors'] += 1
+        print(f'slowest spans across {len(fps)} run(s):')
+        rows = [('CATEGORY', 'NAME', 'COUNT', 'TOTAL', 'MEAN', 'MAX', 'ERRORS')]
+        for key in sorted(stats, key=lambda k: stats[k]['total'], reverse=True)[:limit]:
+            s = stats[key]
+            rows.append((key[0], key[1], str(s['count']), f'{s["total"]:.1f}s',
+                f'{s["total"] / s["count"]:.1f}s', f'{s["max"]:.1f}s', str(s['errors'])))
+        widths = [max([len(row[c]) for row in rows]) for c in range(len(rows[0]))]
+        for row in rows:
+            print('  '.join([row[c].ljust(widths[c]) for c in range(len(row))]).rstrip())
+
+# Decorate an Instance (or Kiosk) method so that each call is recorded as a span.
+def traced(cat = 'method'):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            instance = getattr(self, 'node', self)
+            with instance.cluster.tracer.span(fn.__name__, cat, instance.name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+import os, re, json, time, uuid, signal, logging, threading, subprocess
+from collections import deque
+from modules.batch import *
+from modules.facts import *
+
+"""
+How commands & files reach an instance. Instance.exec, file copies and ssh_copy_id all go through a transport:
+ssh (one multiplexed connection per instance), local (the instance is this machine), or simulated (canned outputs
+and a modelled round-trip latency, so provisioning can be measured without any devices; see `simulation`).
+Every transport counts the commands, round trips, bytes and seconds it carries in `stats`.
+Output which is not captured is streamed line by line to a callback, keeping only its tail (see `exec.tail`).
+"""
+class Transport():
+    def __init__(self, instance):
+        self.instance = instance
+        self.cluster = instance.cluster
+        self.log = instance.log
+        self._lock = threading.Lock()
+        self.reset()
+
+    # The transport for a connection type ('ssh', 'local' or 'simulated').
+    @staticmethod
+    def create(instance, kind):
+        transports = {'ssh': SshTransport, 'local': LocalTransport, 'simulated': SimulatedTransport}
+        if not kind in transports: raise Exception(f'unknown connection type: {kind}')
+        return transports[kind](instance)
+
+    def reset(self):
+        self.stats = {'commands': 0, 'round_trips': 0, 'bytes_sent': 0, 'bytes_received': 0, 'seconds': 0}
+
+    # Record one round trip. A script piped into `bash -s` counts as one command per batch step or fact probe.
+    def _count(self, cmd, sent, received, seconds, script = None):
+        commands = (script.count(Batch._marker) + script.count(Facts._marker)) if script else 0
+        with self._lock:
+            self.stats['commands'] += max(1, commands)
+            self.stats['round_trips'] += 1
+            self.stats['bytes_sent'] += len(cmd) + sent
+            self.stats['bytes_received'] += received
+            self.stats['seconds'] += seconds
+
+    # The shell command which runs cmd on the instance.
+    def _args(self, cmd):
+        raise NotImplementedError()
+
+    # Run a command to completion (one round trip), returning the CompletedProcess (with text output).
+    # With on_line, each line of output is passed to on_line(line, is_stderr) as it arrives, and only the tail of the
+    # output is returned. Raises subprocess.TimeoutExpired (after killing the command) if it outlives the timeout.
+    def run(self, cmd, capture_output = False, input = None, timeout = None, on_line = None):
+        start = time.time()
+        received = 0
+        try:
+            if on_line:
+                r = self._stream(self._args(cmd), input, timeout, on_line)
+                received = r.received
+            else:
+                r = subprocess.run(self._args(cmd), shell=True, check=False, capture_output=capture_output,
+                    text=True, input=input, timeout=timeout)
+                if capture_output: received = len(r.stdout) + len(r.stderr)
+        finally:
+            self._count(cmd, len(input) if input else 0, received, time.time() - start, input)
+        return r
+
+    # Run a local process, passing each line of its output to on_line and keeping the last `exec.tail` lines.
+    def _stream(self, args, input, timeout, on_line):
+        tails = [deque(maxlen=self._tail()), deque(maxlen=self._tail())]
+        received = [0]
+        # A session of its own, so that a timeout kills the command's children too (which would hold the pipes open).
+        proc = subprocess.Popen(args, shell=True, text=True, bufsize=1, start_new_session=True,
+            stdin=subprocess.PIPE if input else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        def pump(pipe, is_stderr):
+            for line in pipe:
+                received[0] += len(line)
+                tails[is_stderr].append(line)
+                on_line(line.rstrip('\n'), is_stderr)
+        def feed():
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        threads = [threading.Thread(target=pump, args=(proc.stdout, False)),
+            threading.Thread(target=pump, args=(proc.stderr, True))]
+        if input: threads.append(threading.Thread(target=feed))
+        for t in threads: t.start()
+        timed_out = False
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        finally:
+            # After a timeout (or an interrupt), kill the command and its children.
+            if proc.poll() == None:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+            for t in threads: t.join()
+        if timed_out: raise subprocess.TimeoutExpired(args, timeout, "".join(tails[0]), "".join(tails[1]))
+        r = subprocess.CompletedProcess(args, proc.returncode, "".join(tails[0]), "".join(tails[1]))
+        r.received = received[0]
+        return r
+
+    # Lines of streamed output to keep (for error messages).
+    def _tail(self):
+        return int((self.cluster.config.get('exec') or {}).get('tail') or 50)
+
+    # Whether a failed command may never have reached the instance (so that an idempotent one may be retried).
+    def disconnected(self, r):
+        return False
+
+    # Start a command whose (binary) stdin/stdout the caller streams, e.g., `docker save`.
+    def popen(self, cmd, **kwargs):
+        self._count(cmd, 0, 0, 0)
+        return subprocess.Popen(self._args(cmd), shell=True, **kwargs)
+
+    # Copy a local file to the instance.
+    def upload(self, fp_local, fp_remote):
+        raise NotImplementedError()
+
+    # Copy a file from the instance to the local machine.
+    def download(self, fp_remote, fp_local):
+        raise NotImplementedError()
+
+    # Authorize the local SSH key (fp) on the instance.
+    def copy_id(self, fp):
+        self.log.warning(f'will not add SSH key because connection type is {self.instance.connect}')
+
+    # An interactive shell on the instance.
+    def interactive(self):
+        raise NotImplementedError()
+
+    # Release any connection which outlives a command.
+    def close(self):
+        pass
+
+"""
+Run everything over SSH, sharing one persistent (multiplexed) connection per instance.
+"""
+class SshTransport(Transport):
+    def __init__(self, instance):
+        super(SshTransport, self).__init__(instance)
+        self._multiplexed = False
+
+    # Options for every ssh/scp process, so that they all share one persistent (multiplexed) connection.
+    def _opts(self):
+        opts = ['-o "StrictHostKeyChecking=no"']
+        mux = self.cluster.config.get('ssh') or {}
+        if mux.get('connect_timeout'): opts.append(f'-o "ConnectTimeout={mux["connect_timeout"]}"')
+        if mux.get('multiplex'):
+            control_dir = os.path.expanduser(mux['control_dir'])
+            os.makedirs(control_dir, mode=0o700, exist_ok=True)
+            opts.append('-o "ControlMaster=auto"')
+            opts.append(f'-o "ControlPath={control_dir}/%C"')
+            opts.append(f'-o "ControlPersist={mux["persist"]}"')
+            self._multiplexed = True
+        return " ".join(opts)
+
+    def _args(self, cmd):
+        cmd = cmd.replace('"', '\\"')
+        return f'ssh {self._opts()} "{self.instance.user_address}" "{cmd}"'
+
+    # ssh exits with 255 when the connection fails (or drops).
+    def disconnected(self, r):
+        return r.returncode == 255
+
+    def _scp(self, fp_from, fp_to):
+        cmd = f'scp {self._opts()} "{fp_from}" "{fp_to}"'
+        self.log.debug(cmd)
+        start = time.time()
+        r = subprocess.run(cmd, shell=True, check=True, capture_output=self.cluster.quiet)
+        self._count(cmd, self._size(fp_from), self._size(fp_to), time.time() - start)
+        return r
+
+    # The size of a local file (0 for a remote path).
+    @staticmethod
+    def _size(fp):
+        fp = os.path.expandvars(os.path.expanduser(fp))
+        return os.path.getsize(fp) if os.path.isfile(fp) else 0
+
+    def upload(self, fp_local, fp_remote):
+        return self._scp(fp_local, f'{self.instance.user_address}:{fp_remote}')
+
+    def download(self, fp_remote, fp_local):
+        return self._scp(f'{self.instance.user_address}:{fp_remote}', fp_local)
+
+    def copy_id(self, fp):
+        if not os.path.isfile(fp):
+            self.log.warning(f'skipping adding SSH key because nothing exists at {fp}')
+            return
+        self.log.info(f'configuring SSH access for {fp} to {self.instance.user_address}...')
+        start = time.time()
+        subprocess.run(f'ssh-copy-id -i {fp} {self.instance.user_address}', shell=True, check=True)
+        self._count('ssh-copy-id', 0, 0, time.time() - start)
+
+    def interactive(self):
+        return os.system(f'ssh {self._opts()} "{self.instance.user_address}"')
+
+    # Tear down the persistent SSH connection, if one was opened.
+    def close(self):
+        if not self._multiplexed: return
+        self.log.debug('closing ssh connection...')
+        subprocess.run(f'ssh {self._opts()} -O exit "{self.instance.user_address}"',
+            shell=True, check=False, capture_output=True)
+        self._multiplexed = False
+
+"""
+Run everything on this machine (e.g., a master without `connect`).
+"""
+class LocalTransport(Transport):
+    def _args(self, cmd):
+        return cmd
+
+    def _cp(self, fp_from, fp_to):
+        start = time.time()
+        r = subprocess.run(f'cp "{fp_from}" "{fp_to}"', shell=True, check=True, capture_output=self.cluster.quiet)
+        self._count('cp', 0, 0, time.time() - start)
+        return r
+
+    def upload(self, fp_local, fp_remote):
+        return self._cp(fp_local, fp_remote)
+
+    def download(self, fp_remote, fp_local):
+        return self._cp(fp_remote, fp_local)
+
+    def interactive(self):
+        return os.system(os.environ.get('SHELL') or 'bash')
+
+"""
+Reply to every command from canned outputs (see `simulation` in defaults.yaml), as a freshly flashed device would.
+Nothing runs and no files are written; each round trip is modelled as the configured latency plus its bytes at the
+configured bandwidth (and only slept through if `sleep` is set, e.g., to watch `bootstrap` schedule its steps).
+Batch scripts report that every step succeeded, fact probes read `simulation.facts`, and the master reports every
+configured node as registered (without labels).
+"""
+class SimulatedTransport(Transport):
+    def __init__(self, instance):
+        super(SimulatedTransport, self).__init__(instance)
+        self.cfg = self.cluster.config.get('simulation') or {}
+        self.latency = float(self.cfg.get('latency') or 0)
+        self.bandwidth = float(self.cfg.get('bandwidth') or 0)
+        self.history = [] # Every command, in order.
+
+    def reset(self):
+        super(SimulatedTransport, self).reset()
+        self.history = []
+
+    # Replace {name}, {address} and {master} in a canned output.
+    def _render(self, text):
+        master = self.cluster.master.address if self.cluster.master else None
+        for key, value in {'name': self.instance.name, 'address': self.instance.address, 'master': master}.items():
+            text = text.replace('{' + key + '}', str(value))
+        return text
+
+    # The output of a facts script: each probe's marker, followed by its canned raw output.
+    def _facts(self, script):
+        facts = self.cfg.get('facts') or {}
+        out = []
+        for name in re.findall(f'echo "{Facts._marker} (\\S+)"', script):
+            out += [f'{Facts._marker} {name}', self._render(str(facts.get(name) or ''))]
+        return "\n".join(out) + "\n"
+
+    # Every configured node, registered with the master (as `kubectl get nodes -o json`).
+    def _cluster_nodes(self):
+        items = [{'metadata': {'name': cfg.get('name'), 'labels': {}}, 'spec': {}}
+            for cfg in self.cluster.inventory.nodes.values() if cfg.get('name')]
+        return json.dumps({'items': items})
+
+    # (stdout, stderr, returncode, seconds the command runs for) for a command.
+    def _respond(self, cmd, script):
+        if Facts._marker in script: return self._facts(script), '', 0, 0
+        if Batch._marker in script:
+            steps = script.count(Batch._marker)
+            return "".join([f'\n{Batch._marker} {i} 0 0\n' for i in range(steps)]), '', 0, 0
+        if cmd.startswith('kubectl get nodes -o json'): return self._cluster_nodes(), '', 0, 0
+        if cmd.endswith('random/boot_id'): return str(uuid.uuid4()) + "\n", '', 0, 0
+        for response in self.cfg.get('responses') or []:
+            if re.search(response['match'], cmd):
+                return self._render(response.get('stdout') or ''), response.get('stderr') or '', \
+                    int(response.get('rc') or 0), float(response.get('seconds') or 0)
+        return '', '', 0, 0
+
+    # Record a round trip, and how long it would have taken.
+    def _trip(self, cmd, sent, received, script = None, running = 0):
+        seconds = self.latency + running + ((sent + received) / self.bandwidth if self.bandwidth else 0)
+        with self._lock: self.history.append(cmd)
+        self._count(cmd, sent, received, seconds, script)
+        if self.cfg.get('sleep'): time.sleep(seconds)
+
+    def run(self, cmd, capture_output = False, input = None, timeout = None, on_line = None):
+        stdout, stderr, rc, running = self._respond(cmd, input or '')
+        if timeout != None and running > timeout:
+            self._trip(cmd, len(input) if input else 0, 0, input, timeout)
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        self._trip(cmd, len(input) if input else 0, len(stdout) + len(stderr), input, running)
+        if on_line:
+            for line in stdout.splitlines(): on_line(line, False)
+            for line in stderr.splitlines(): on_line(line, True)
+            tail = lambda text: "\n".join(text.splitlines()[-self._tail():])
+            stdout, stderr = tail(stdout), tail(stderr)
+        return subprocess.CompletedProcess(cmd, rc, stdout, stderr)
+
+    def disconnected(self, r):
+        return r.returncode == 255
+
+    # Streams go nowhere: the process discards its input and writes nothing.
+    def popen(self, cmd, **kwargs):
+        self._trip(cmd, 0, 0)
+        return subprocess.Popen('cat > /dev/null', shell=True, **kwargs)
+
+    def upload(self, fp_local, fp_remote):
+        self._trip(f'upload {fp_remote}', os.path.getsize(fp_local) if os.path.isfile(fp_local) else 0, 0)
+
+    def download(self, fp_remote, fp_local):
+        self._trip(f'download {fp_remote}', 0, 0)
+
+    def copy_id(self, fp):
+        self._trip('ssh-copy-id', 0, 0)
+
+    def interactive(self):
+        raise Exception('a simulated instance has no shell.')
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# Start the kiosk, then check on it: every interval, sample the page through Chromium's remote-debugging endpoint
+# (the Chrome DevTools Protocol, over a minimal websocket client) and restart the browser when it has crashed, stopped
+# drawing frames, or outgrown its JS heap. Samples & restarts are appended to a JSONL file for `tc <node> kiosk-stats`.
+# usage: kiosk-watchdog.py [options] -- <command which starts the kiosk, e.g., kiosk.sh "<url>" -f "<flags>">
+# Only the standard library is used, since this runs on the device.
+import os, json, time, signal, socket, struct, base64, argparse, subprocess, urllib.request
+
+# Evaluated in the page: a frame is requested, and the sample is returned once it is drawn (a hidden page draws none).
+SAMPLE_JS = '''new Promise(resolve => {
+  const t0 = performance.now();
+  const nav = performance.getEntriesByType('navigation')[0];
+  const done = drawn => resolve(JSON.stringify({
+    heap_mb: performance.memory ? performance.memory.usedJSHeapSize / 1048576 : null,
+    heap_limit_mb: performance.memory ? performance.memory.jsHeapSizeLimit / 1048576 : null,
+    load_s: nav && nav.loadEventEnd > 0 ? nav.loadEventEnd / 1000 : null,
+    frame_ms: drawn ? performance.now() - t0 : null,
+    dom_nodes: document.getElementsByTagName('*').length,
+    hidden: document.hidden,
+    url: location.href,
+  }));
+  if (document.hidden) done(false); else requestAnimationFrame(() => done(true));
+})'''
+
+# A websocket client which is just enough for the DevTools protocol: text frames, fragmentation, ping & close.
+class WebSocket():
+    def __init__(self, url, timeout):
+        host_port, _, path = url.split('://', 1)[1].partition('/')
+        host, _, port = host_port.partition(':')
+        self.sock = socket.create_connection((host, int(port or 80)), timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f'GET /{path} HTTP/1.1\r\nHost: {host_port}\r\nUpgrade: websocket\r\n'
+            f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = b''
+        while not b'\r\n\r\n' in response:
+            chunk = self.sock.recv(4096)
+            if not chunk: raise ConnectionError('closed during the websocket handshake')
+            response += chunk
+        if not response.startswith(b'HTTP/1.1 101'):
+            status = response.split(b'\r\n')[0].decode()
+            raise ConnectionError(f'websocket handshake failed: {status}')
+        self.buffer = response.split(b'\r\n\r\n', 1)[1]
+
+    def _read(self, n):
+        while len(self.buffer) < n:
+            chunk = self.sock.recv(65536)
+            if not chunk: raise ConnectionError('websocket closed')
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    # Client frames are always masked.
+    def _send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126: header += bytes([0x80 | len(payload)])
+        elif len(payload) < 65536: header += bytes([0x80 | 126]) + struct.pack('!H', len(payload))
+        else: header += bytes([0x80 | 127]) + struct.pack('!Q', len(payload))
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask + bytes([b ^ mask[i % 4] for i, b in enumerate(payload)]))
+
+    def send(self, text):
+        self._send_frame(0x1, text.encode())
+
+    # The next complete text message.
+    def recv(self):
+        message = b''
+        while True:
+            b0, b1 = self._read(2)
+            opcode, length = b0 & 0x0f, b1 & 0x7f
+            if length == 126: length = struct.unpack('!H', self._read(2))[0]
+            elif length == 127: length = struct.unpack('!Q', self._read(8))[0]
+            mask = self._read(4) if b1 & 0x80 else None
+            payload = self._read(length)
+            if mask: payload = bytes([b ^ mask[i % 4] for i, b in enumerate(payload)])
+            if opcode == 0x8: raise ConnectionError('websocket closed by the browser')
+            if opcode == 0x9:
+                self._send_frame(0xa, payload)
+                continue
+            if opcode in [0x0, 0x1, 0x2]: message += payload
+            if b0 & 0x80 and opcode != 0xa: return message.decode()
+
+    def close(self):
+        try:
+            self._send_frame(0x8, b'')
+        except OSError:
+            pass
+        self.sock.close()
+
+# Call one DevTools method, returning its result (events which arrive meanwhile are ignored).
+def call(ws, method, params, id = 1):
+    ws.send(json.dumps({'id': id, 'method': method, 'params': params}))
+    while True:
+        msg = json.loads(ws.recv())
+        if msg.get('id') != id: continue
+        if 'error' in msg: raise RuntimeError(msg['error'].get('message'))
+        return msg['result']
+
+# One sample of the kiosk page. Raises if the browser cannot be reached; a page which does not draw a frame within
+# `timeout` seconds is reported as stalled.
+def sample(port, timeout):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/json/list', timeout=timeout) as r:
+        pages = [t for t in json.load(r) if t.get('type') == 'page' and t.get('webSocketDebuggerUrl')]
+    if not pages: raise RuntimeError('the browser has no page open')
+    ws = WebSocket(pages[0]['webSocketDebuggerUrl'], timeout)
+    try:
+        result = call(ws, 'Runtime.evaluate', {'expression': SAMPLE_JS, 'awaitPromise': True, 'returnByValue': True})
+        if 'exceptionDetails' in result: raise RuntimeError(result['exceptionDetails'].get('text'))
+        return dict(json.loads(result['result']['value']), stalled=False)
+    except socket.timeout:
+        return {'stalled': True}
+    finally:
+        ws.close()
+
+class Watchdog():
+    def __init__(self, opts):
+        self.opts = opts
+        self.fp = os.path.expanduser(opts.stats)
+        os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+        self.lines = sum(1 for _ in open(self.fp)) if os.path.isfile(self.fp) else 0
+        self.started = None
+        self.failures = 0
+
+    # Append a record, keeping only the last `keep` records (trimmed once a fifth more have accumulated).
+    def record(self, entry):
+        entry = dict(entry, at=round(time.time(), 1))
+        with open(self.fp, 'a') as f: f.write(json.dumps(entry) + '\n')
+        self.lines += 1
+        if self.lines > self.opts.keep * 1.2:
+            with open(self.fp, 'r') as f: lines = f.readlines()[-self.opts.keep:]
+            with open(f'{self.fp}.tmp', 'w') as f: f.writelines(lines)
+            os.replace(f'{self.fp}.tmp', self.fp)
+            self.lines = len(lines)
+
+    # The browser's processes: Chromium executables with the debugging port. Only the executable is matched, since other
+    # command lines (e.g., this watchdog's) may contain the flag too, within the kiosk's command.
+    def _browser_pids(self):
+        pattern = f'^[^ ]*chrom[^ ]* .*--remote-debugging-port={self.opts.port}( |$)'
+        r = subprocess.run(['pgrep', '-f', '--', pattern], stdout=subprocess.PIPE, universal_newlines=True)
+        return [int(pid) for pid in r.stdout.split() if int(pid) != os.getpid()]
+
+    def _kill(self, sig):
+        for pid in self._browser_pids():
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def start(self, reason = None):
+        if reason:
+            self.record({'event': 'restart', 'reason': reason})
+            self._kill(signal.SIGTERM)
+            for _ in range(10):
+                if not self._browser_pids(): break
+                time.sleep(1)
+            self._kill(signal.SIGKILL)
+        subprocess.run(self.opts.command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) # kiosk.sh forks.
+        self.started = time.time()
+        self.failures = 0
+
+    # Why the browser should be restarted after this sample (or None).
+    def check(self, s):
+        opts = self.opts
+        if opts.max_hours and time.time() - self.started > opts.max_hours * 3600:
+            return f'running for more than {opts.max_hours}h'
+        if s.get('heap_mb') and opts.max_heap_mb and s['heap_mb'] > opts.max_heap_mb:
+            return f'JS heap {s["heap_mb"]:.1f} MB > {opts.max_heap_mb} MB'
+        self.failures = self.failures + 1 if s.get('error') or s.get('stalled') else 0
+        if self.failures >= opts.failures:
+            what = s.get('error') or f'no frame drawn within {opts.stall_seconds}s'
+            return f'{self.failures} failed samples ({what})'
+        return None
+
+    def run(self):
+        self.start()
+        while True:
+            time.sleep(self.opts.interval)
+            try:
+                s = sample(self.opts.port, self.opts.stall_seconds)
+            except Exception as e:
+                s = {'error': str(e) or type(e).__name__}
+            s['browser_s'] = round(time.time() - self.started)
+            self.record(s)
+            reason = self.check(s)
+            if reason: self.start(reason)
+
+def main():
+    parser = argparse.ArgumentParser('kiosk-watchdog.py')
+    parser.add_argument('--port', type=int, default=9222, help='Chromium\'s --remote-debugging-port')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between samples.')
+    parser.add_argument('--stall-seconds', type=float, default=10, help='A frame must be drawn within this long.')
+    parser.add_argument('--failures', type=int, default=3, help='Restart after this many failed samples in a row.')
+    parser.add_argument('--max-heap-mb', type=float, help='Restart once the JS heap is larger than this.')
+    parser.add_argument('--max-hours', type=float, help='Restart after this long, regardless.')
+    parser.add_argument('--stats', default='~/.cache/tiny-cluster/kiosk-stats.jsonl', help='Where to record samples.')
+    parser.add_argument('--keep', type=int, default=10000, help='How many records to keep.')
+    parser.add_argument('command', nargs='+', help='The command which starts the kiosk.')
+    Watchdog(parser.parse_args()).run()
+
+if __name__ == "__main__":
+    main()
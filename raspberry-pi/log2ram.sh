@@ -0,0 +1,36 @@
+#!/bin/bash
+# Keep /var/log in RAM, copying it to the card only when flushed (installed as /usr/local/sbin/tiny-cluster-log2ram).
+# The card's /var/log stays reachable at /var/hdd.log. Under memory pressure, tmpfs pages go to (zram) swap.
+# usage: log2ram.sh start <size> | flush | stop
+
+disk=/var/hdd.log
+
+flush() {
+  if which rsync > /dev/null; then
+    rsync -aX --delete --inplace /var/log/ $disk/
+  else
+    cp -a -u /var/log/. $disk/
+  fi
+}
+
+case "$1" in
+  start)
+    mountpoint -q /var/log && exit 0
+    mkdir -p $disk
+    mount --bind /var/log $disk && mount --make-private $disk || exit 1
+    mount -t tmpfs -o nosuid,noexec,nodev,mode=0755,size=$2 tiny-cluster-log /var/log || exit 1
+    cp -a $disk/. /var/log/
+    ;;
+  flush)
+    mountpoint -q /var/log && flush
+    ;;
+  stop)
+    mountpoint -q /var/log || exit 0
+    flush
+    umount -l /var/log && umount -l $disk
+    ;;
+  *)
+    echo "usage: $0 start <size> | flush | stop" >&2
+    exit 1
+    ;;
+esac
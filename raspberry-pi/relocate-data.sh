@@ -0,0 +1,36 @@
+#!/bin/bash
+# Move the container runtimes' data (images, layers & volumes) off the SD card, onto attached storage.
+# Each of /var/lib/docker & /var/lib/containerd is copied to <dir> and bind-mounted back (via /etc/fstab).
+# usage: relocate-data.sh <dir>, e.g., /mnt/usb
+
+dir=$1
+tag=x-tiny-cluster-storage
+
+if [ -z "$dir" ]; then
+  echo "usage: $0 <dir>" >&2
+  exit 1
+fi
+mkdir -p $dir
+if [ "$(findmnt -no SOURCE -T $dir)" == "$(findmnt -no SOURCE /)" ]; then
+  echo "$dir is on the root filesystem; mount the attached storage there first." >&2
+  exit 1
+fi
+
+systemctl stop kubelet docker docker.socket containerd 2> /dev/null
+for d in docker containerd; do
+  line="$dir/$d /var/lib/$d none bind,$tag 0 0"
+  grep -qF "$line" /etc/fstab && continue
+  echo "moving /var/lib/$d to $dir/$d..."
+  mkdir -p /var/lib/$d $dir/$d
+  cp -a /var/lib/$d/. $dir/$d/ || exit 1
+  if mountpoint -q /var/lib/$d; then umount /var/lib/$d || exit 1; fi # Previously relocated elsewhere.
+  sed -i "\\# /var/lib/$d none bind,$tag #d" /etc/fstab
+  echo "$line" >> /etc/fstab
+  mount /var/lib/$d || exit 1
+  # Free the space on the card, which is now hidden beneath the mount.
+  mkdir -p /run/tiny-cluster-sd && mount --bind / /run/tiny-cluster-sd
+  rm -rf /run/tiny-cluster-sd/var/lib/$d/* && umount /run/tiny-cluster-sd
+done
+systemctl start containerd docker 2> /dev/null
+systemctl start kubelet 2> /dev/null
+exit 0
@@ -35,7 +35,7 @@ else
 fi
 
 if [[ ! $(which exportfs) ]]; then
-  sudo apt install nfs-kernel-server
+  sudo apt-get install -qy nfs-kernel-server
 else
   echo "nfs-kernel-server already installed."
 fi
@@ -0,0 +1,25 @@
+#!/bin/bash
+# Compressed swap in RAM (installed as /usr/local/sbin/tiny-cluster-zram; see the storage profiles in defaults.yaml).
+# usage: zram.sh start <percent of RAM> <algorithm> <priority> <swappiness> | stop
+
+state=/run/tiny-cluster-zram
+
+case "$1" in
+  start)
+    modprobe zram
+    size=$(( $(awk '/MemTotal/ {print $2}' /proc/meminfo) * $2 / 100 ))
+    dev=$(zramctl --find --size ${size}KiB --algorithm $3) || exit 1
+    mkswap $dev > /dev/null && swapon --priority $4 $dev || exit 1
+    sysctl -q vm.swappiness=$5
+    echo $dev > $state
+    ;;
+  stop)
+    [ -f $state ] || exit 0
+    dev=$(cat $state)
+    swapoff $dev && zramctl --reset $dev && rm -f $state
+    ;;
+  *)
+    echo "usage: $0 start <percent> <algorithm> <priority> <swappiness> | stop" >&2
+    exit 1
+    ;;
+esac
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import os, yaml, importlib.util, pytest
+
+"""
+Reconcile a simulated fleet as its configuration is edited (see Controller).
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+spec = importlib.util.spec_from_file_location('provisioning', f'{ROOT}/benchmarks/provisioning.py')
+provisioning = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(provisioning)
+tc = provisioning.tc
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    provisioning.write_context(str(tmp_path), 2, 0)
+    monkeypatch.chdir(tmp_path)
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'controller', '-l', 'WARNING'])
+    yield cluster
+    cluster.close(save_trace=False)
+
+# Change a node's configuration in the context file.
+def edit(cluster, node_ip, **cfg):
+    with open(cluster.fp_cfg, 'r') as f: ctx = yaml.safe_load(f)
+    ctx['nodes'][node_ip].update(cfg)
+    with open(cluster.fp_cfg, 'w') as f: yaml.dump(ctx, f)
+    os.utime(cluster.fp_cfg, ns=(0, os.stat(cluster.fp_cfg).st_mtime_ns + 1)) # Invalidate the config cache.
+    cluster.reload()
+
+def test_only_changed_fields_are_applied(cluster):
+    controller = tc.Controller(cluster, cluster.config['controller'])
+    assert [plan[0] for plan in controller.reconcile().values()] == [['configure'], ['configure']]
+    assert controller.reconcile() == {}
+    edit(cluster, '10.0.0.1', labels=['tiny-cluster/rack=9'])
+    plans = controller.reconcile()
+    assert [(node.name, plan[0]) for node, plan in plans.items()] == [('node-0', ['label'])]
+
+def test_reload_closes_replaced_connections(cluster, monkeypatch):
+    instances = [cluster.master] + cluster.get_nodes()
+    closed = []
+    for instance in instances:
+        monkeypatch.setattr(instance.transport, 'close', lambda i=instance: closed.append(i))
+    cluster.reload()
+    assert closed == instances[1:] + instances[:1]
+    assert not [i for i in [cluster.master] + cluster.get_nodes() if i in instances]
+
+def test_rename_is_not_applied(cluster):
+    controller = tc.Controller(cluster, cluster.config['controller'])
+    controller.reconcile()
+    edit(cluster, '10.0.0.1', name='node-renamed')
+    assert controller.reconcile() == {}
+    assert controller._load()['10.0.0.1']['name'] == 'node-0'
+    # Once re-created under the new name (e.g., `create --force`), the rename is recorded.
+    cluster.get_node('10.0.0.1')._facts['hostname'] = 'node-renamed'
+    assert controller.reconcile() == {}
+    assert controller._load()['10.0.0.1']['name'] == 'node-renamed'
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os, sys, shutil, asyncio, builtins, threading, importlib.util, pytest
+
+"""
+Drive Discovery across a fake network (through its connect & neighbours hooks), and the scan menu.
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from modules.discovery import Discovery
+
+PI = 'dc:a6:32'
+
+"""
+A /29 whose hosts behave as configured (per port): 'open', 'refused' or 'timeout' (the default).
+Like the kernel's, the neighbour table only learns the MAC of a host which answered.
+"""
+class FakeNetwork():
+    def __init__(self, hosts):
+        self.hosts = hosts # ip => ({port: behaviour}, mac)
+        self.table = {}
+        self.probes = []
+
+    async def connect(self, ip, port, timeout):
+        self.probes.append((ip, port))
+        ports, mac = self.hosts.get(ip, ({}, None))
+        if ports.get(port, 'timeout') == 'timeout':
+            await asyncio.sleep(timeout)
+            return False
+        self.table[ip] = mac
+        return True
+
+    def neighbours(self):
+        return dict(self.table)
+
+def discover(network, ports = [22]):
+    found = []
+    discovery = Discovery([PI], {'cidr': '10.0.0.0/29', 'ports': ports, 'timeout': 0.01},
+        network.connect, network.neighbours)
+    return discovery.run(lambda ip, mac: found.append((ip, mac))), found
+
+def test_found_host():
+    network = FakeNetwork({'10.0.0.2': ({22: 'open'}, f'{PI}:00:00:01')})
+    ips, found = discover(network)
+    assert ips == ['10.0.0.2']
+    assert found == [('10.0.0.2', f'{PI}:00:00:01')]
+
+def test_timeout():
+    network = FakeNetwork({'10.0.0.2': ({22: 'timeout'}, f'{PI}:00:00:01')})
+    ips, found = discover(network)
+    assert ips == [] and found == []
+    assert len(network.probes) == 6 # Every host of the /29 was probed.
+
+def test_refused_port_proves_host_is_alive():
+    network = FakeNetwork({'10.0.0.3': ({22: 'refused'}, f'{PI}:00:00:02')})
+    ips, _ = discover(network)
+    assert ips == ['10.0.0.3']
+
+def test_mac_mismatch():
+    network = FakeNetwork({
+        '10.0.0.2': ({22: 'open'}, 'aa:bb:cc:00:00:01'),
+        '10.0.0.4': ({22: 'open'}, f'{PI.upper()}:00:00:03'),
+    })
+    ips, found = discover(network)
+    assert ips == ['10.0.0.4']
+    assert found == [('10.0.0.4', f'{PI}:00:00:03')] # OUIs match regardless of case.
+
+def test_next_port_after_timeout():
+    network = FakeNetwork({'10.0.0.5': ({22: 'timeout', 80: 'open'}, f'{PI}:00:00:04')})
+    ips, _ = discover(network, [22, 80])
+    assert ips == ['10.0.0.5']
+    assert network.probes.count(('10.0.0.6', 80)) == 1
+
+# The real connect, against this machine.
+def test_connect():
+    discovery = Discovery([PI], {'cidr': '127.0.0.1/32'})
+    async def probe():
+        server = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            opened = await discovery._connect('127.0.0.1', port, 1)
+        refused = await discovery._connect('127.0.0.1', port, 1) # The server has closed.
+        return opened, refused
+    assert asyncio.run(probe()) == (True, True)
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    (tmp_path / 'contexts').mkdir()
+    shutil.copy(f'{ROOT}/defaults.yaml', tmp_path / 'defaults.yaml')
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location('tiny_cluster', f'{ROOT}/tiny-cluster.py')
+    tc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tc)
+    cluster = tc.TinyCluster(['-c', 'test', 'master', '-l', 'WARNING'])
+    cluster.scanned = threading.Event()
+    def scan_network(ouis, on_found):
+        on_found('10.0.0.2', f'{PI}:00:00:01')
+        on_found('10.0.0.3', f'{PI}:00:00:02')
+        cluster.scanned.set()
+    monkeypatch.setattr(cluster, 'scan_network', scan_network)
+    yield cluster
+    cluster.close(save_trace=False)
+
+def test_scan_menu_rejects_unlisted_numbers(cluster, monkeypatch):
+    answers = iter(['3', 'x', '0', '2'])
+    monkeypatch.setattr(builtins, 'input', lambda prompt: cluster.scanned.wait() and next(answers))
+    assert cluster.scan_menu_input([PI]) == '10.0.0.3'
+
+def test_scan_menu_waits_for_the_scan(cluster, monkeypatch):
+    answers = iter(['', '1'])
+    monkeypatch.setattr(builtins, 'input', lambda prompt: next(answers))
+    assert cluster.scan_menu_input([PI]) == '10.0.0.2'
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import os, yaml, importlib.util, pytest
+
+"""
+Run provisioning & fleet operations against simulated fleets (see `simulation` in defaults.yaml).
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+spec = importlib.util.spec_from_file_location('provisioning', f'{ROOT}/benchmarks/provisioning.py')
+provisioning = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(provisioning)
+tc = provisioning.tc
+SIZE = 3
+
+@pytest.fixture
+def context(tmp_path, monkeypatch):
+    provisioning.write_context(str(tmp_path), SIZE, 0.01)
+    # A node which never reports Ready fails quickly, rather than hanging the test.
+    fp = f'{tmp_path}/contexts/bench.yaml'
+    with open(fp, 'r') as f: ctx = yaml.safe_load(f)
+    ctx['rolling'] = {'max_unavailable': SIZE, 'ready_timeout': 30}
+    with open(fp, 'w') as f: yaml.dump(ctx, f)
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path)
+
+@pytest.mark.parametrize('name,fn', provisioning.OPERATIONS, ids=[op[0] for op in provisioning.OPERATIONS])
+def test_operation(context, name, fn):
+    first = provisioning.measure(context, fn)
+    assert first['commands'] > 0
+    assert first['round_trips'] <= first['commands']
+    # Fresh clusters do the same work, so the counts (which --check compares) are stable.
+    second = provisioning.measure(context, fn)
+    assert [first[k] for k in ['commands', 'round_trips']] == [second[k] for k in ['commands', 'round_trips']]
+    # The benchmark's cluster saves no trace into the context it is about to delete.
+    assert not os.path.exists(f'{context}/.cache/bench/traces')
+
+def test_node_create_reaches_every_node(context):
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'master', '-l', 'WARNING'])
+    for node in cluster.get_nodes(): node.create()
+    cluster.close(save_trace=False)
+    for node in cluster.nodes.values():
+        assert any('kubeadm join' in cmd for cmd in node.transport.history)
+        assert 'sudo reboot &' in node.transport.history
+
+def test_close_is_idempotent(context):
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'master', '-l', 'WARNING'])
+    cluster.get_nodes()[0].configure()
+    cluster.close()
+    traces = os.listdir(f'{context}/.cache/bench/traces')
+    assert len(traces) == 1
+    cluster.close()
+    assert os.listdir(f'{context}/.cache/bench/traces') == traces
+
+def test_rolling_reboot(context):
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'all', 'reboot', '--rolling', '-l', 'WARNING'])
+    cluster.run() # Exits if any node fails (e.g., never reports Ready).
+    cluster.close(save_trace=False)
+    master = cluster.master.transport.history
+    for node in cluster.nodes.values():
+        assert 'sudo reboot &' in node.transport.history
+        drained = [i for i, cmd in enumerate(master) if cmd.startswith(f'kubectl drain {node.name} ')]
+        uncordoned = [i for i, cmd in enumerate(master) if cmd == f'kubectl uncordon {node.name}']
+        assert len(drained) == 1 and len(uncordoned) == 1 and drained[0] < uncordoned[0]
+
+# Over ssh, the local shell expands anything in the command line, so the script must travel on stdin.
+def test_install_bundle_over_ssh(context, monkeypatch):
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'master', '-l', 'WARNING'])
+    cluster.config['ssh'] = {}
+    node = cluster.get_nodes()[0]
+    node.transport = tc.SshTransport(node)
+    sent = []
+    def run(args, input = None, **kwargs):
+        sent.append((args, input))
+        return tc.subprocess.CompletedProcess(args, 0, '', '')
+    monkeypatch.setattr(tc.subprocess, 'run', run)
+    node.install_bundle()
+    cluster.close(save_trace=False)
+    [(args, script)] = sent
+    assert args == f'ssh -o "StrictHostKeyChecking=no" "{node.user_address}" "bash -s"'
+    assert 'B=/boot; if [ -d /boot/firmware ]; then B=/boot/firmware; fi;' in script
+    assert 'bash $B/tiny-cluster/provision.sh --reboot' in script
+
+# A device which is going down may accept the connection but never answer: keep polling.
+def test_boot_id_times_out(context, monkeypatch):
+    cluster = tc.TinyCluster(['-c', 'bench', '--transport', 'simulated', 'master', '-l', 'WARNING'])
+    node = cluster.get_nodes()[0]
+    def run(cmd, timeout = None, **kwargs): raise tc.subprocess.TimeoutExpired(cmd, timeout)
+    monkeypatch.setattr(node.transport, 'run', run)
+    assert node._get_boot_id() == None
+    cluster.close(save_trace=False)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import os, sys, json, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from modules.trace import Tracer
+
+def test_oldest_spans_are_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(Tracer, '_max_spans', 10)
+    tracer = Tracer()
+    for i in range(25): tracer.add(f'span {i}', 'command', f'node-{i % 2}', time.time(), 0.1)
+    tracer.save(f'{tmp_path}/trace.json', None)
+    with open(f'{tmp_path}/trace.json', 'r') as f: events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events if e['ph'] == 'X'] == [f'span {i}' for i in range(15, 25)]
+    assert sorted([e['args']['name'] for e in events if e['ph'] == 'M']) == ['node-0', 'node-1']
+
+def test_rotate_saves_each_cycle(tmp_path):
+    tracer = Tracer()
+    for cycle in range(3):
+        with tracer.span('reconcile', 'node', 'node-0'): pass
+        tracer.rotate(str(tmp_path), {'target': 'controller'})
+        assert len(tracer.events) == 0
+    tracer.rotate(str(tmp_path)) # Nothing was recorded, so nothing is saved.
+    runs = sorted(os.listdir(tmp_path))
+    assert len(runs) == 3
+    for fp in runs:
+        with open(f'{tmp_path}/{fp}', 'r') as f: assert len(json.load(f)['traceEvents']) == 2
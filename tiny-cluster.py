@@ -1,119 +1,271 @@
 #!/usr/bin/env python3
-import yaml, sys, argparse, os, re, logging, subprocess
+import yaml, sys, argparse, os, re, logging, subprocess, atexit, threading, pickle
+from contextlib import ExitStack
 from deepmerge import always_merger
 from modules.node import *
 from modules.master import *
+from modules.fleet import *
+from modules.scheduler import *
+from modules.inventory import *
+from modules.status import *
+from modules.controller import *
+from modules.trace import *
 
 class TinyCluster():
-    nodes = {} # Node objects keyed by IP address.
-    node_name_to_ip = {} # Reverse lookup name of a node to its IP address.
+    nodes = {} # Node objects keyed by IP address (instantiated on first use; see get_node).
+    inventory = None # Node configurations, indexed by name, address, label & MAC (see Inventory).
 
     # https://raspberrypi.stackexchange.com/questions/28365/what-are-the-possible-ouis-for-the-ethernet-mac-address
     pi_ouis = ['b8:27:eb', 'dc:a6:32']
 
+    # Load a YAML file (with the C loader, when available).
+    @staticmethod
+    def _load_yaml(fp):
+        with open(fp, 'r') as stream:
+            return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+
     def set_context(self, context):
         self.log.debug(f'Setting context to: {context}')
         self.context = context
         self.fp_cfg = f'{self.cwd}/contexts/{context}.yaml'
-        if os.path.isfile(self.fp_cfg):
-            with open(self.fp_cfg, 'r') as stream:
-                self.config_context = yaml.safe_load(stream)
-        else:
-            self.config_context = {}
+        fp_def = f'{self.cwd}/defaults.yaml'
+
+        # The merged config is cached, keyed on the size & mtime of its source files.
+        fp_cache = f'{self.cwd}/.cache/{context}/config.pickle'
+        key = [(os.stat(fp).st_mtime_ns, os.stat(fp).st_size) if os.path.isfile(fp) else None
+            for fp in [fp_def, self.fp_cfg]]
+        if os.path.isfile(fp_cache):
+            with open(fp_cache, 'rb') as f: cached = pickle.load(f)
+            if cached['key'] == key:
+                self.config = cached['config']
+                self._index_nodes()
+                return True
+
+        self.config_defaults = self._load_yaml(fp_def)
+        self.config_context = self._load_yaml(self.fp_cfg) if os.path.isfile(self.fp_cfg) else {}
         self.config = always_merger.merge(self.config_defaults, self.config_context)
+        self._index_nodes()
+        os.makedirs(os.path.dirname(fp_cache), exist_ok=True)
+        with open(f'{fp_cache}.tmp', 'wb') as f: pickle.dump({'key': key, 'config': self.config}, f)
+        os.replace(f'{fp_cache}.tmp', fp_cache)
         return True
 
-    def __init__(self):
-        self.cwd = os.getcwd() # os.path.dirname(__file__)
+    # Index the configured nodes, without instantiating any of them.
+    def _index_nodes(self):
+        self.nodes = {}
+        self.inventory = Inventory(self.fp_cfg, self.config['nodes'])
 
-        # Load defaults.yaml then merge in config.yaml if it exists
-        fp_def = f'{self.cwd}/defaults.yaml'
-        with open(fp_def, 'r') as stream: self.config_defaults = yaml.safe_load(stream)
+    def __init__(self, args = None):
+        self.cwd = os.getcwd() # os.path.dirname(__file__)
 
         script = os.path.basename(__file__)
         log_levels = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
 
-        args = sys.argv[1:]
-        methods = set()
-        methods.update([c for c in dir(Master) if not c.startswith('_')])
-        methods.update([c for c in dir(Node) if not c.startswith('_')])
+        args = sys.argv[1:] if args == None else args
 
         parser = argparse.ArgumentParser(f'{script}')
         parser.add_argument('--context', '-c', default='home')
         parser.add_argument('target', default='master',
-            help='The node name, or "master" for master node, or "create" to create a cluster.')
-        parser.add_argument('method', nargs='?', choices=methods)
+            help='The node name, "master" for master node, "all" for every node, "create" to create a cluster, '
+                '"bootstrap" to set up the master & every node at once, "status" to show the health of every node, '
+                '"controller" to apply every change to the configuration as it is made, '
+                'or "report" to summarize the slowest steps of past runs.')
+        parser.add_argument('method', nargs='?',
+            help='The method to run on the target (e.g., create, configure, update, reboot, ssh).')
+        parser.add_argument('--selector', '-s', action='append', default=[],
+            help='With the "all", "status" or "controller" targets (or master nfs-bench), only nodes matching key=value (e.g., labels=tiny-cluster/node-pi-red=true).')
+        parser.add_argument('--parallel', '-p', type=int,
+            help='With the "all" target, how many nodes to run the method on at once (default: 1). '
+                'With "bootstrap", how many steps to run at once (see defaults.yaml). '
+                'With master nfs-bench, how many nodes to benchmark from at once (default: every mounting node).')
+        parser.add_argument('--rolling', action='store_true',
+            help='With the "all" target, drain each node, run the method, then wait for it to be Ready again.')
+        parser.add_argument('--max-unavailable', type=int,
+            help='With --rolling, how many nodes may be out of service at once (see defaults.yaml).')
+        parser.add_argument('--max-failures', type=int,
+            help='With --rolling, stop starting new nodes after this many have failed (see defaults.yaml).')
+        parser.add_argument('--watch', type=float, nargs='?', const=-1, metavar='SECONDS',
+            help='With the "status" target, keep refreshing (every status.interval seconds, unless given).')
+        parser.add_argument('--json', action='store_true',
+            help='With the "status" target, print JSON (one line per refresh) instead of a table.')
+        parser.add_argument('--trace', metavar='FILE',
+            help='Write a Chrome trace (JSON) of every method, step, command and transfer to FILE.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='With label or reconcile-labels, print the changes to labels & taints without applying them. '
+                'With "controller", print the steps each node needs without running them.')
+        parser.add_argument('--timeout', type=float, metavar='SECONDS',
+            help='Fail an operation (e.g., create on one node) which runs for longer than this (see exec in defaults.yaml).')
+        parser.add_argument('--transport', choices=['ssh', 'local', 'simulated'],
+            help='Reach every configured instance this way instead of its `connect` (e.g., "simulated"; see defaults.yaml).')
+        parser.add_argument('--force', action='store_true',
+            help='Run every step, even those whose desired state is already satisfied.')
         parser.add_argument('--log-level', '-l', choices=log_levels, default='INFO', help='logging level')
         parser.add_argument('--log-format', '-f', default='[%(levelname)s] [%(name)s] %(message)s')
         self.opts = parser.parse_args(args)
+        if self.opts.method: self.opts.method = self.opts.method.replace('-', '_') # e.g., refresh-facts
 
         logging.basicConfig(format=self.opts.log_format, level=self.opts.log_level)
         self.log = logging.getLogger(self.opts.context)
 
+        self.force = self.opts.force
+        self.discovered = {} # IP address => MAC address of devices found by scan_network.
+
         # "quiet" flags are enabled unless DEBUG log mode.
         self.quiet = self.opts.log_level != 'DEBUG'
 
         # Load initial context data from configs.
         self.set_context(self.opts.context)
+        self.tracer = Tracer()
+        self._closed = False
+        atexit.register(self.close)
 
-        # Create master node:
+        self._load_master()
+
+    # Create master node:
+    def _load_master(self):
+        self.master = None
         if self.config['kubernetes'] and self.config['kubernetes']['master']:
             self.network = self.config['kubernetes']['network']
             if not self.network: self.network = {}
             self.master = Master(self, self.config['kubernetes']['master'])
 
-        # Create the node instances and run the method.
-        self.nodes = {}
-        for node_ip in self.config['nodes']:
-            self.create_node(node_ip, self.config['nodes'][node_ip])
+    # Re-read the configuration (e.g., after it was edited), replacing the master & any instantiated nodes.
+    # The replaced instances' connections (e.g., SSH ControlMaster sockets) are closed first.
+    def reload(self):
+        instances = list(self.nodes.values()) + ([self.master] if self.master else [])
+        self.set_context(self.context)
+        for instance in instances: instance.transport.close()
+        self._load_master()
 
+    # Public methods of an instance, which may be called from the command line.
+    @staticmethod
+    def _get_methods(instance):
+        return sorted([m for m in dir(instance) if not m.startswith('_') and callable(getattr(type(instance), m, None))])
+
+    # Resolve the target and call the method.
+    def run(self):
+        nfs_bench = self.opts.target == 'master' and self.opts.method == 'nfs_bench'
+        if self.opts.selector and not self.opts.target in ['all', 'status', 'controller'] and not nfs_bench:
+            raise Exception('--selector may only be used with the "all", "status" or "controller" targets '
+                '(or master nfs-bench).')
         if self.opts.target == 'master':
             self.instance = self.master
         elif self.opts.target == 'create':
             self.create()
-        elif self.opts.target in self.node_name_to_ip:
-            self.instance = self.nodes[self.node_name_to_ip[self.opts.target]]
+            return
+        elif self.opts.target == 'bootstrap':
+            if not self.bootstrap(self.get_nodes()): sys.exit(1)
+            return
+        elif self.opts.target == 'status':
+            self.status()
+            return
+        elif self.opts.target == 'controller':
+            self.controller()
+            return
+        elif self.opts.target == 'report':
+            Tracer.report(self._get_trace_dir())
+            return
+        elif self.opts.target == 'all':
+            self.run_fleet(self.opts.method)
+            return
+        elif self.inventory.address_for(self.opts.target):
+            self.instance = self.get_node(self.inventory.address_for(self.opts.target))
         else:
             raise Exception(
                 f'Cannot find node: {self.opts.target}. Please see the README to edit {self.fp_cfg}')
 
         # Call the work function.
         self.log.debug(f'run {self.opts}')
-        if self.opts.method == 'create':
-            self.instance.create()
-        else:
-            if not hasattr(self.instance, self.opts.method):
-                raise Exception(f'{self.opts.method} is not valid on {self.opts.target}.')
+        if not self.opts.method: raise Exception(f'a method is required with the "{self.opts.target}" target.')
+        if self.opts.method != 'create' and not self.opts.method in self._get_methods(self.instance):
+            methods = ", ".join([m.replace('_', '-') for m in self._get_methods(self.instance)])
+            raise Exception(f'{self.opts.method} is not valid on {self.opts.target}. Valid methods: {methods}')
+        with self.instance._operation_timeout(self.get_operation_timeout()):
             getattr(self.instance, self.opts.method)()
 
+    # Seconds which one operation on one instance may take (or None).
+    def get_operation_timeout(self):
+        return self.opts.timeout or (self.config.get('exec') or {}).get('operation_timeout')
+
+    # The nodes which match every --selector.
+    # Label selectors are answered by the inventory's index, so only matching nodes are instantiated.
+    def _select_nodes(self):
+        labels = [s.split('=', 1)[1] for s in self.opts.selector if s.startswith('labels=')]
+        return Fleet.select([self.get_node(ip) for ip in self.inventory.find(labels)], self.opts.selector)
+
+    # Run a method on every node matching the selectors, `--parallel` at a time.
+    def run_fleet(self, method):
+        if not method: raise Exception('a method is required with the "all" target.')
+        if method == 'ssh': raise Exception('ssh cannot be run against multiple nodes.')
+        nodes = self._select_nodes()
+        if len(nodes) <= 0:
+            self.log.warning(f'no nodes match {self.opts.selector}')
+            return
+        for node in nodes:
+            if not method in self._get_methods(node):
+                raise Exception(f'{method} is not valid on {node.name}.')
+        if self.opts.rolling:
+            cfg = dict(self.config['rolling'])
+            if self.opts.max_unavailable != None: cfg['max_unavailable'] = self.opts.max_unavailable
+            if self.opts.max_failures != None: cfg['max_failures'] = self.opts.max_failures
+            fleet = Rolling(self, nodes, cfg)
+        else:
+            fleet = Fleet(self, nodes, self.opts.parallel or 1)
+        if not fleet.run(method):
+            sys.exit(1)
+
+    # Show the health of every node matching the selectors (see Status).
+    def status(self):
+        cfg = self.config['status']
+        self.quiet = True
+        nodes = self._select_nodes()
+        interval = None if self.opts.watch == None else (cfg['interval'] if self.opts.watch < 0 else self.opts.watch)
+        try:
+            Status(self, nodes, self.opts.parallel or cfg['parallel']).run(self.opts.json, interval)
+        except KeyboardInterrupt:
+            pass
+
+    # Watch the configuration and apply each change to the nodes it affects (see Controller).
+    def controller(self):
+        cfg = self.config['controller']
+        self.quiet = True
+        try:
+            Controller(self, cfg, self.opts.parallel or cfg['parallel']).run()
+        except KeyboardInterrupt:
+            pass
+
     # Create a new device.
     def create(self):
         self.log.info('setting up...')
         ip_address = input('''Enter the IP address of the device.
 Leave blank to scan the network (auto-detect): ''')
         if not ip_address:
-            ip_addresses = self.scan_network(self.pi_ouis)
-            if len(ip_addresses) <= 0:
+            ip_address = self.scan_menu_input(self.pi_ouis)
+            if not ip_address:
                 self.log.error('''No Raspberry Pis could be automatically detected.
-You could run `arp -d -a` to flush the cache, or `arp -a` to ensure that the device appears.''')
+Set `discovery.cidr` to the range your devices are on, or enter the IP address manually.''')
                 return
-            ip_address = self.list_menu_input(ip_addresses, 'Select an IP address: ')
+        mac = self.discovered.get(ip_address)
+        if self.inventory.address_for_mac(mac) not in [None, ip_address]:
+            self.log.warning(f'{mac} was previously configured at {self.inventory.address_for_mac(mac)}')
 
         # Make it master?
+        create_master = False
         if not self.master or not self.master.connect:
             is_mstr = input(f'''Should {self.opts.target} be the master? [Y/n]: ''')
             if is_mstr.lower() != 'n':
                 self.master = Master(self, self.update_master_cfg(ip_address))
-                self.master.update()
-                self.master.create()
+                create_master = True
 
         # Set up node?
         c = input(f'Confirm: create node "{self.opts.target}" at {ip_address}? [Y/n] ')
-        if c.lower() == 'n': return
+        if c.lower() == 'n':
+            if create_master: self.bootstrap([])
+            return
 
         update_cfg = {'name': self.opts.target}
-        if ip_address in self.nodes:
-            node = self.nodes[ip_address]
+        if self.get_node(ip_address):
+            node = self.get_node(ip_address)
             self.log.info(f'using existing node "{node.name}" for {ip_address}')
         else:
             node = self.create_node(ip_address, update_cfg)
@@ -121,70 +273,124 @@ You could run `arp -d -a` to flush the cache, or `arp -a` to ensure that the dev
             node.ssh_copy_id()
 
         update_cfg['interface'] = node._get_best_interface(ip_address)
+        if mac: update_cfg['mac'] = mac
         self.update_node_cfg(ip_address, update_cfg)
-        self.nodes[ip_address].update()
-        self.nodes[ip_address].create()
+        if not create_master:
+            node.update()
+            node.create()
+        elif not self.bootstrap([node]):
+            sys.exit(1)
+
+    # Create the master and set up the nodes as one dependency graph of steps (see Scheduler).
+    # Node preparation overlaps with creating the master; only joining & labeling wait for the control plane.
+    # Returns True if every step succeeded.
+    def bootstrap(self, nodes):
+        if not self.master: raise Exception('bootstrap requires a Kubernetes master (see kubernetes.master).')
+        parallel = self.opts.parallel or self.config['bootstrap']['parallel']
+        self.quiet = True # Output from many instances is interleaved (with instance prefixes), so keep it terse.
+        for instance in [self.master] + nodes: instance.ssh_copy_id() # May prompt, so never in parallel.
+        scheduler = Scheduler(parallel)
+        ready = self.master._add_create_steps(scheduler)
+        steps = {node.name: node._add_create_steps(scheduler, ready) for node in nodes}
+        for node in nodes:
+            # A master node reboots last, once every other node has joined through it.
+            after = sum(steps.values(), []) + ['master:nfs'] if node._is_master() else steps[node.name]
+            scheduler.add(f'{node.name}:reboot', node._reboot_if_changed, after)
+        self.log.info(f'bootstrapping the master & {len(nodes)} node(s) with parallel={scheduler.parallel}...')
+        with ExitStack() as deadlines: # The whole bootstrap is one operation on each instance.
+            for instance in [self.master] + nodes:
+                deadlines.enter_context(instance._operation_timeout(self.get_operation_timeout()))
+            return scheduler.run()
+
+    # The instance which hosts the apt cache (see `apt_cache` in defaults.yaml).
+    def get_apt_cache_host(self):
+        name = self.config['apt_cache']['node']
+        if not name: return self.master
+        if not self.inventory.address_for(name): raise Exception(f'apt_cache.node "{name}" is not a node.')
+        return self.get_node(self.inventory.address_for(name))
+
+    # The URL of the apt cache, or None if it is not enabled.
+    def get_apt_cache_url(self):
+        cfg = self.config['apt_cache']
+        if not cfg or not cfg['enabled']: return None
+        host = self.get_apt_cache_host()
+        if not host or not host.address: raise Exception('the apt cache host has no address.')
+        return f'http://{host.address}:{cfg["port"]}'
+
+    # Where traces of past runs are kept (for `tc report`).
+    def _get_trace_dir(self):
+        return f'{self.cwd}/.cache/{self.context}/traces'
+
+    # Close any persistent connections opened during this run, and save its trace (unless save_trace is False).
+    # Runs once: at exit, unless it was called before.
+    def close(self, save_trace = True):
+        if self._closed: return
+        self._closed = True
+        atexit.unregister(self.close)
+        instances = list(self.nodes.values())
+        if self.master: instances.append(self.master)
+        for instance in instances: instance.transport.close()
+        if not save_trace: return
+        self.tracer.save(self.opts.trace, self._get_trace_dir(),
+            {'target': self.opts.target, 'method': self.opts.method, 'context': self.context})
+
+    # The node at an IP address, instantiated on first use (or None if there is no such node).
+    def get_node(self, node_ip):
+        if node_ip in self.nodes: return self.nodes[node_ip]
+        if not node_ip in self.inventory.nodes: return None
+        return self.create_node(node_ip, dict(self.inventory.nodes[node_ip]))
+
+    # Every configured node (instantiating them all).
+    def get_nodes(self):
+        return [self.get_node(node_ip) for node_ip in self.inventory.nodes]
 
     # Instantiate a node.
     def create_node(self, node_ip, cfg):
         cfg['address'] = node_ip
         node = Node(self, always_merger.merge(dict(self.config['defaults']['node']), cfg))
-        if node.name in self.node_name_to_ip:
-            raise Exception(f'''the node name {node.name} is being claimed for {node_ip}.
-It previously appeared for {self.node_name_to_ip[node_ip]}')''')
-        self.node_name_to_ip[node.name] = node_ip
+        claimed = self.inventory.address_for(node.name)
+        if claimed and claimed != node_ip:
+            raise Exception(f'the node name {node.name} is being claimed for {node_ip}.\n'
+                f'It previously appeared for {claimed}')
         self.nodes[node_ip] = node
         return node
 
     def update_master_cfg(self, ip_address, username = 'pi'):
         ks = {'address': ip_address, 'connect': 'ssh', 'username': username}
         self.log.info(f'writing out configuration for master: {username}@{ip_address}')
-        cust = {}
-        if os.path.isfile(self.fp_cfg):
-            with open(self.fp_cfg, 'r') as stream: cust = yaml.safe_load(stream)
-        if not 'kubernetes' in cust: cust['kubernetes'] = {}
-        cust['kubernetes']['master'] = ks
-        with open(self.fp_cfg, 'w') as file:
-            yaml.dump(cust, file, default_flow_style=False)
-        return ks
-
-    # Update config.yaml with a node's config (non-destructive).
+        return self.inventory.update_master(ks)
+
+    # Update the context's configuration for a node (non-destructive; values matching the defaults are omitted).
     def update_node_cfg(self, ip_address, update_cfg):
         self.log.info(f'writing out configuration for {ip_address}')
-        cust = {}
-        if os.path.isfile(self.fp_cfg):
-            with open(self.fp_cfg, 'r') as stream: cust = yaml.safe_load(stream)
-        if not 'nodes' in cust: cust['nodes'] = {}
-        if not ip_address in cust['nodes']: cust['nodes'][ip_address] = {}
-        keys = list(update_cfg)
-        def_node = self.config['defaults']['node']
-        for key in keys:
-            if key in def_node and def_node[key] == update_cfg[key]:
-                self.log.debug(f'{key} matches node default value of {update_cfg[key]}')
-                del update_cfg[key]
-        vals = always_merger.merge(cust['nodes'][ip_address], update_cfg)
-        if 'address' in vals: del vals['address']
-        cust['nodes'][ip_address] = vals
-        with open(self.fp_cfg, 'w') as file:
-            yaml.dump(cust, file, default_flow_style=False)
-
-    # Inspired by: https://github.com/TranceCat/Raspberry-Pi-orchestration
-    def scan_network(self, ouis):
-        self.log.info('scannning network...')
-        ip_addresses = set()
-        addr_matcher = re.compile('\((?P<ip>[0-9\.]*)\)\s*(?P<mac>[0-9a-z:]*)')
-        p = subprocess.Popen("arp -a | cut -f 2,4 -d ' ' ", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        for line in p.stdout.readlines():
-            line = line.decode('utf-8').strip()
-            self.log.debug(f'found device on network: {line}')
-            match = addr_matcher.match(line)
-            if not match or not match.group('mac'): continue
-            mac = match.group('mac')
-            oui_matches = [o for o in ouis if mac.startswith(o)]
-            if len(oui_matches) > 0: ip_addresses.add(match.group('ip'))
-        ip_addresses = list(ip_addresses)
-        ip_addresses.sort()
-        return ip_addresses
+        return self.inventory.update_node(ip_address, dict(update_cfg), self.config['defaults']['node'])
+
+    # Actively sweep the local network for devices with a matching OUI.
+    # on_found(ip, mac) is called as each device is discovered.
+    def scan_network(self, ouis, on_found = None):
+        from modules.discovery import Discovery # Imported here: asyncio is slow to import, and rarely needed.
+        return Discovery(ouis, self.config.get('discovery') or {}).run(on_found)
+
+    # Scan the network in the background, listing devices as they are found so one may be picked right away.
+    def scan_menu_input(self, ouis):
+        found = []
+        def on_found(ip, mac):
+            found.append(ip)
+            self.discovered[ip] = mac
+            print(f'{len(found)}) {ip} ({mac})')
+        scan = threading.Thread(target=self.scan_network, args=(ouis, on_found), daemon=True)
+        scan.start()
+        prompt = 'Select an IP address as it appears (or press enter to wait for the scan to finish): '
+        while True:
+            i = input(prompt).strip()
+            if not i:
+                scan.join()
+                if len(found) <= 0: return None
+                prompt = 'Select an IP address: '
+            elif i.isdigit() and 1 <= int(i) <= len(found):
+                return found[int(i)-1]
+            else:
+                print(f'{i} has not been listed (yet).')
 
     def list_menu_input(self, arr, prompt = ''):
         i = 0
@@ -199,3 +405,4 @@ MAIN
 """
 if __name__ == "__main__":
     cluster = TinyCluster()
+    cluster.run()